@@ -2,17 +2,19 @@ __all__ = (
     "ALL_SETUP_MODES",
     "CUSTOM_SETUP_MODES",
     "SYSTEMD_TEST_DIR",
+    "AsyncCtrCtxType",
     "CtrCtxType",
+    "aio",
     "utils",
 )
 
 import os
 from pathlib import Path
-from typing import Callable, ContextManager, Optional
+from typing import AsyncContextManager, Callable, ContextManager, Optional
 
 from python_on_whales import Container
 
-from . import utils
+from . import aio, utils
 
 
 SYSTEMD_TEST_DIR: Path = Path(__file__).resolve().parent
@@ -24,3 +26,5 @@ CUSTOM_SETUP_MODES: list[str] = [
 ALL_SETUP_MODES: list[Optional[str]] = [None] + CUSTOM_SETUP_MODES
 
 CtrCtxType = Callable[..., ContextManager[Container]]
+
+AsyncCtrCtxType = Callable[..., AsyncContextManager[aio.AsyncContainer]]
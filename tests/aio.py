@@ -0,0 +1,414 @@
+"""
+Asyncio variants of the container utilities.
+
+These allow many containers to be orchestrated concurrently from a single
+thread, e.g. booting and inspecting dozens of systemd containers at once. All
+container operations are performed via the container manager's CLI, run as
+asyncio subprocesses.
+"""
+
+from __future__ import annotations
+
+__all__ = (
+    "AsyncContainer",
+    "ctr_ctx",
+    "run_cmd",
+    "run_ctr",
+    "wait_for",
+)
+
+import asyncio
+import contextlib
+import inspect
+import json
+import logging
+import re
+import shlex
+import subprocess
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Iterable,
+    Optional,
+    Sequence,
+)
+
+from .console import BOOT_TARGET_REACHED_REGEX
+from .containers import ctr_run_cli_args
+from .exec_agent import framed_exec_script, parse_framed_exec_output
+from .utils import (
+    DEFAULT_BACKOFF,
+    Backoff,
+    CtrClient,
+    CtrException,
+    CtrInitError,
+    ExecResult,
+    Poller,
+    WaitStats,
+    strip_ansi_codes,
+)
+
+logger = logging.getLogger(__name__)
+
+
+async def run_cmd(
+    cmd: list[str],
+    *,
+    log_output: bool = False,
+    check: bool = True,
+    timeout: Optional[float] = None,
+    input: Optional[str] = None,
+) -> subprocess.CompletedProcess[str]:
+    """
+    Run a command, capturing stdout and stderr, as per utils.run_cmd().
+
+    :param cmd:
+        The command to run.
+    :param log_output:
+        Whether to log the output.
+    :param check:
+        Whether to raise if the command returns non-zero exit status.
+    :param timeout:
+        Optional timeout in seconds, after which the command is killed.
+    :param input:
+        Optional input to pass to the command's stdin.
+
+    :raise subprocess.CalledProcessError:
+        If check is set and the command returns non-zero exit status.
+    :raise subprocess.TimeoutExpired:
+        If timeout is given and the command times out.
+
+    :return:
+        Completed process object.
+    """
+    logger.debug("Running command: %r", shlex.join(cmd))
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(
+            proc.communicate(input.encode("utf-8") if input is not None else None),
+            timeout,
+        )
+    except asyncio.TimeoutError:
+        proc.kill()
+        stdout, stderr = await proc.communicate()
+        logger.debug("Command timed out")
+        raise subprocess.TimeoutExpired(
+            cmd, timeout, stdout.decode("utf-8"), stderr.decode("utf-8")
+        ) from None
+    except asyncio.CancelledError:
+        with contextlib.suppress(ProcessLookupError):
+            proc.kill()
+        await proc.wait()
+        raise
+    p = subprocess.CompletedProcess(
+        cmd, proc.returncode, stdout.decode("utf-8"), stderr.decode("utf-8")
+    )
+
+    if check and p.returncode != 0:
+        logger.debug(
+            "Command failed with exit code %s, stdout:\n%s\nstderr:\n%s",
+            p.returncode,
+            p.stdout.strip("\n"),
+            p.stderr.strip("\n"),
+        )
+        raise subprocess.CalledProcessError(p.returncode, cmd, p.stdout, p.stderr)
+    if log_output:
+        logger.debug("Command stdout:\n%s", p.stdout.strip("\n"))
+        logger.debug("Command stderr:\n%s", p.stderr.strip("\n"))
+
+    return p
+
+
+async def wait_for(
+    description: str,
+    condition: Callable[[], bool | Awaitable[bool]],
+    timeout: float,
+    interval: Optional[float] = None,
+    *,
+    exc_type: type[Exception] | None = Exception,
+    backoff: Backoff = DEFAULT_BACKOFF,
+    stats: Optional[WaitStats] = None,
+) -> WaitStats:
+    """
+    Wait for a condition to complete within the given timeout.
+
+    This is the same as utils.wait_for(), except the condition may be a
+    coroutine function and other tasks are run while waiting.
+
+    :param description:
+        Description of what's being waited for.
+    :param condition:
+        The callable representing the condition being waited for.
+    :param timeout:
+        The retry timeout in seconds.
+    :param interval:
+        A fixed retry interval in seconds, overriding the backoff schedule.
+    :param exc_type:
+        The exception type to catch from calling the condition function, or
+        None to not catch exceptions.
+    :param backoff:
+        The schedule of retry intervals.
+    :param stats:
+        Optional object to record statistics of the wait in.
+    :return:
+        The statistics of the wait.
+    :raise TimeoutError:
+        If the condition is not met within the timeout.
+    """
+    logger.info("Waiting up to %s seconds for %s", timeout, description)
+    if interval is not None:
+        backoff = Backoff.fixed(interval)
+    poller = Poller(description, timeout, backoff, stats)
+    while True:
+        ready = False
+        try:
+            ready = condition()
+            if inspect.isawaitable(ready):
+                ready = await ready
+        except Exception as e:
+            if not exc_type or not isinstance(e, exc_type):
+                raise
+            poller.exception = e
+        if poller.record_attempt(ready):
+            return poller.stats
+        sleep = poller.next_sleep()
+        if sleep is None:
+            raise poller.timeout_error() from poller.exception
+        await asyncio.sleep(sleep)
+
+
+class AsyncContainer:
+    """A container, with operations performed asynchronously via the CLI."""
+
+    def __init__(self, ctr_client: CtrClient, ctr_id: str):
+        self.ctr_client = ctr_client
+        self.id = ctr_id
+        self.attrs: dict[str, Any] = {}
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.id[:12]!r})"
+
+    @property
+    def name(self) -> str:
+        return self.attrs.get("Name", "").lstrip("/") or self.id[:12]
+
+    @property
+    def running(self) -> bool:
+        """Whether the container is running, as of the last reload."""
+        return bool(self.attrs.get("State", {}).get("Running"))
+
+    async def reload(self) -> None:
+        """Reload the container's attributes."""
+        output = (await run_cmd([self.ctr_client.exe, "inspect", self.id])).stdout
+        self.attrs = json.loads(output)[0]
+
+    async def execute(self, command: list[str], *, detach: bool = False) -> str:
+        """
+        Execute a command in the container, as per Container.execute().
+
+        :return:
+            The command's stdout, with any trailing newline removed.
+        :raise CtrException:
+            If the command returns a non-zero exit code.
+        """
+        cmd = [self.ctr_client.exe, "exec", *(["--detach"] if detach else []), self.id]
+        try:
+            p = await run_cmd([*cmd, *command])
+        except subprocess.CalledProcessError as e:
+            raise CtrException(
+                e.cmd,
+                e.returncode,
+                e.stdout.encode("utf-8"),
+                e.stderr.encode("utf-8"),
+            ) from e
+        return p.stdout.removesuffix("\n")
+
+    async def execute_batch(self, cmds: Iterable[list[str]]) -> list[ExecResult]:
+        """
+        Execute multiple commands with a single exec, see
+        exec_agent.execute_batch().
+        """
+        cmds = list(cmds)
+        if not cmds:
+            return []
+        output = await self.execute(["sh", "-c", framed_exec_script(cmds)])
+        return parse_framed_exec_output(cmds, output.splitlines())
+
+    async def logs(self, *, timestamps: bool = False) -> str:
+        """Get the container's output."""
+        cmd = [self.ctr_client.exe, "logs", *(["--timestamps"] if timestamps else [])]
+        return (await run_cmd([*cmd, self.id])).stdout
+
+    async def follow_logs(self) -> AsyncIterator[str]:
+        """
+        Follow the container's output, yielding each line as it's output.
+
+        Lines are yielded with ANSI escape codes and line endings removed, with
+        iteration ending when the container stops.
+        """
+        proc = await asyncio.create_subprocess_exec(
+            self.ctr_client.exe,
+            "logs",
+            "--follow",
+            self.id,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        try:
+            async for line in proc.stdout:
+                yield strip_ansi_codes(line.decode("utf-8", errors="replace")).rstrip(
+                    "\r\n"
+                )
+        finally:
+            with contextlib.suppress(ProcessLookupError):
+                proc.kill()
+            await proc.wait()
+
+    async def wait_for_log_line(
+        self, pattern: str | re.Pattern[str], timeout: float
+    ) -> str:
+        """
+        Wait for a line matching a pattern to be output by the container.
+
+        :param pattern:
+            The regex pattern to search for in each line (with ANSI escape
+            codes removed).
+        :param timeout:
+            The timeout in seconds.
+        :return:
+            The matching line.
+        :raise TimeoutError:
+            If no matching line is output within the timeout.
+        :raise CtrInitError:
+            If the container's output ends (i.e. it exits) without a match.
+        """
+        regex = re.compile(pattern)
+        logger.debug("Waiting up to %s seconds for log line %r", timeout, regex.pattern)
+
+        async def find_line() -> str:
+            lines = self.follow_logs()
+            try:
+                async for line in lines:
+                    if regex.search(line):
+                        return line
+            finally:
+                await lines.aclose()
+            raise CtrInitError(
+                f"Container output ended without log line {regex.pattern!r}"
+            )
+
+        try:
+            line = await asyncio.wait_for(find_line(), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(
+                f"Timed out after {timeout} seconds waiting for log line "
+                f"{regex.pattern!r}"
+            ) from None
+        logger.debug("Found log line: %s", line)
+        return line
+
+    async def remove(self, *, force: bool = False) -> None:
+        """Remove the container."""
+        await run_cmd(
+            [self.ctr_client.exe, "rm", *(["--force"] if force else []), self.id]
+        )
+
+
+async def run_ctr(
+    ctr_client: CtrClient, image: Any, command: Sequence[str] = (), **kwargs
+) -> AsyncContainer:
+    """
+    Run a detached container.
+
+    :param ctr_client:
+        The container client.
+    :param image:
+        The image, either an image object or a name/ID.
+    :param command:
+        The command to run in the container.
+    :param kwargs:
+        Arguments to the run as accepted by python-on-whales' run(), limited to
+        those used by the tests.
+    :return:
+        The container.
+    """
+    kwargs["detach"] = True
+    cmd = [
+        ctr_client.exe,
+        "run",
+        *ctr_run_cli_args(kwargs),
+        getattr(image, "id", image),
+        *command,
+    ]
+    try:
+        output = (await run_cmd(cmd)).stdout
+    except subprocess.CalledProcessError as e:
+        raise CtrException(
+            e.cmd, e.returncode, e.stdout.encode("utf-8"), e.stderr.encode("utf-8")
+        ) from e
+    ctr = AsyncContainer(ctr_client, output.strip().splitlines()[-1])
+    await ctr.reload()
+    return ctr
+
+
+@contextlib.asynccontextmanager
+async def ctr_ctx(
+    ctr_client: CtrClient,
+    image: Any,
+    *args,
+    wait: bool = True,
+    boot_timeout: float = 60,
+    **kwargs,
+) -> AsyncIterator[AsyncContainer]:
+    """
+    An async context manager for running a systemd container.
+
+    The container is run with the given arguments, as passed through to
+    run_ctr(), without any defaults being applied.
+
+    :param ctr_client:
+        The container client.
+    :param image:
+        The container image.
+    :param wait:
+        Whether to wait for boot to complete successfully.
+    :param boot_timeout:
+        The timeout for systemd to boot, in seconds.
+    :yield:
+        The container.
+    :raise CtrInitError:
+        If systemd in the container fails to start.
+    """
+    ctr = await run_ctr(ctr_client, image, *args, **kwargs)
+    try:
+        if wait:
+            try:
+                try:
+                    await ctr.wait_for_log_line(
+                        BOOT_TARGET_REACHED_REGEX, boot_timeout
+                    )
+                except TimeoutError as e:
+                    raise CtrInitError(
+                        f"Systemd container failed to boot within {boot_timeout} "
+                        "seconds"
+                    ) from e
+                try:
+                    await ctr.execute(["systemctl", "is-system-running", "--wait"])
+                except CtrException as e:
+                    raise CtrInitError(
+                        f"Systemd container failed to start: {e.stdout.strip()}"
+                    ) from e
+            except CtrInitError:
+                logger.error("Container boot logs:\n%s", await ctr.logs())
+                raise
+        yield ctr
+    finally:
+        with contextlib.suppress(CtrException, subprocess.CalledProcessError):
+            await ctr.remove(force=True)
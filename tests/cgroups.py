@@ -0,0 +1,412 @@
+"""
+Inspection of the cgroup setup inside containers and on the host.
+"""
+
+from __future__ import annotations
+
+__all__ = (
+    "CgroupMount",
+    "CgroupPath",
+    "CgroupSnapshot",
+    "ProcCgroups",
+    "get_enabled_cgroup_controllers",
+    "parse_mountinfo",
+    "parse_proc_cgroup",
+)
+
+import dataclasses
+import textwrap
+from typing import Any, Mapping, Optional
+
+from python_on_whales import Container
+
+from .utils import to_json_compatible
+
+
+def parse_proc_cgroup(proc_cgroup: str) -> dict[str, str]:
+    """
+    Parse the contents of a /proc/<pid>/cgroup file.
+
+    :param proc_cgroup:
+        The file contents, with lines of the form
+        '<hierarchy-ID>:<controller-list>:<cgroup-path>'.
+    :return:
+        A mapping of controller list (e.g. 'cpu,cpuacct' or 'name=systemd', or
+        the empty string for the cgroup v2 unified hierarchy) to cgroup path.
+    """
+    hierarchies = {}
+    for line in proc_cgroup.splitlines():
+        if line.strip():
+            _, controllers, path = line.split(":", maxsplit=2)
+            hierarchies[controllers] = path
+    return hierarchies
+
+
+@dataclasses.dataclass(frozen=True)
+class CgroupMount:
+    """A cgroup filesystem mount, as found in /proc/<pid>/mountinfo."""
+
+    path: str
+    type: str
+    root: str
+    options: tuple[str, ...]
+    super_options: tuple[str, ...]
+
+    def is_for_hierarchy(self, hierarchy: str) -> bool:
+        """
+        Check whether this is a mount of the given cgroup hierarchy.
+
+        :param hierarchy:
+            The hierarchy in the form used in /proc/<pid>/cgroup, i.e. the
+            comma-separated list of controllers (or 'name=<name>') for cgroup
+            v1, or the empty string for the cgroup v2 unified hierarchy.
+        """
+        if self.type == "cgroup2":
+            return hierarchy == ""
+        return bool(hierarchy) and set(hierarchy.split(",")) <= set(
+            self.super_options
+        )
+
+
+@dataclasses.dataclass(frozen=True)
+class CgroupPath:
+    """The path for PID 1's cgroup in a hierarchy, as visible in /sys/fs/cgroup."""
+
+    hierarchy: str
+    path: str
+    has_system_slice: bool
+    controllers: frozenset[str]
+    subtree_control: frozenset[str]
+    parent_subtree_control: frozenset[str]
+
+
+@dataclasses.dataclass(frozen=True)
+class ProcCgroups:
+    """The cgroup membership of a process."""
+
+    pid: int
+    comm: str
+    cgroups: tuple[tuple[str, str], ...]
+
+    def get_path(self, hierarchy: str) -> Optional[str]:
+        """Get the process's cgroup path in the given hierarchy, if any."""
+        return dict(self.cgroups).get(hierarchy)
+
+
+# Script to collect cgroup information from a container in a single exec, with
+# sections separated by '%%' lines (see _split_probe_sections()):
+#  1. The mountinfo for the process.
+#  2. For each pair of cgroup mount and PID 1 cgroup, the directory for PID 1's
+#     cgroup under that mount (if found), whether 'system.slice' exists
+#     alongside or under it, its available controllers, its subtree_control
+#     and its parent's subtree_control.
+#  3. The cgroups of each process, as lines of '<pid> <comm> <cgroup-line>',
+#     only if the script's first argument is '1'.
+#
+# Only the expected paths are checked, so unless processes are scanned the cost
+# doesn't depend on the size of the cgroup tree or the number of processes.
+# The mount's root is stripped from the cgroup path to handle bind mounts, and
+# up to two leading path components are additionally stripped to handle the
+# pseudo-private cgroup bind mounts used with cgroupns=host.
+_CGROUP_PROBE_SCRIPT = textwrap.dedent(
+    """
+    scan_procs=$1
+
+    read_file() {
+        value=""
+        if [ -f "$1" ]; then
+            read -r value < "$1"
+        fi
+        echo "$value"
+    }
+
+    cat /proc/self/mountinfo
+    echo "%%"
+    set -f
+    while read -r line; do
+        case "$line" in
+            *" - cgroup "*|*" - cgroup2 "*) ;;
+            *) continue ;;
+        esac
+        set -- $line
+        root=$4
+        mnt=$5
+        while IFS=: read -r _ hierarchy path; do
+            if [ "$root" != / ]; then
+                case "$path" in
+                    "$root"|"$root"/*) path=${path#"$root"} ;;
+                esac
+            fi
+            rel=${path%/}
+            for _ in 0 1 2; do
+                [ -d "$mnt$rel" ] && break
+                case "$rel" in
+                    /*/*) rel=/${rel#/*/} ;;
+                    *) rel="" ;;
+                esac
+            done
+            dir=$mnt$rel
+            [ -d "$dir" ] || continue
+            system_slice=0
+            if [ -d "$dir/system.slice" ] || [ -d "${dir%/*}/system.slice" ]; then
+                system_slice=1
+            fi
+            printf '%s\\t%s\\t%s\\t%s\\t%s\\t%s\\t%s\\n' \\
+                "$mnt" "$hierarchy" "$dir" "$system_slice" \
+                "$(read_file "$dir/cgroup.controllers")" \
+                "$(read_file "$dir/cgroup.subtree_control")" \
+                "$(read_file "${dir%/*}/cgroup.subtree_control")"
+        done < /proc/1/cgroup
+    done < /proc/self/mountinfo
+    set +f
+    echo "%%"
+    if [ "$scan_procs" = 1 ]; then
+        for proc_dir in /proc/[0-9]*; do
+            pid=${proc_dir#/proc/}
+            {
+                read -r comm < "$proc_dir/comm"
+                while read -r line; do
+                    printf '%s\\t%s\\t%s\\n' "$pid" "$comm" "$line"
+                done < "$proc_dir/cgroup"
+            } 2>/dev/null
+        done
+    fi
+    """
+)
+
+
+def _split_probe_sections(output: str, count: int) -> list[str]:
+    """
+    Split the output of a probe script into sections separated by '%%' lines.
+
+    Missing trailing sections (e.g. where an empty final section has had its
+    newline stripped) are returned as empty strings.
+
+    :param output:
+        The script output.
+    :param count:
+        The number of sections expected.
+    :return:
+        The sections.
+    :raise ValueError:
+        If there are more sections than expected.
+    """
+    sections: list[list[str]] = [[]]
+    for line in output.splitlines():
+        if line == "%%":
+            sections.append([])
+        else:
+            sections[-1].append(line)
+    if len(sections) > count:
+        raise ValueError(f"Expected {count} output sections, got {len(sections)}")
+    sections += [[]] * (count - len(sections))
+    return ["".join(f"{line}\n" for line in lines) for lines in sections]
+
+
+def parse_mountinfo(mountinfo: str) -> list[CgroupMount]:
+    """Parse the cgroup mounts from the contents of /proc/<pid>/mountinfo."""
+    mounts = []
+    for line in mountinfo.splitlines():
+        fields, _, fs_fields = line.partition(" - ")
+        fields, fs_fields = fields.split(), fs_fields.split()
+        if len(fields) < 6 or len(fs_fields) < 3:
+            continue
+        if fs_fields[0] not in ("cgroup", "cgroup2"):
+            continue
+        mounts.append(
+            CgroupMount(
+                path=fields[4],
+                type=fs_fields[0],
+                root=fields[3],
+                options=tuple(fields[5].split(",")),
+                super_options=tuple(fs_fields[2].split(",")),
+            )
+        )
+    return mounts
+
+
+@dataclasses.dataclass(frozen=True)
+class CgroupSnapshot:
+    """
+    A snapshot of the cgroup setup in a container, see capture().
+
+    Snapshots are immutable and can be compared for equality, and converted to
+    and from JSON-compatible dicts using to_dict() and from_dict().
+    """
+
+    cgroup_version: int
+    mounts: tuple[CgroupMount, ...]
+    pid_1_paths: tuple[CgroupPath, ...]
+    procs: tuple[ProcCgroups, ...]
+
+    @classmethod
+    def capture(
+        cls, ctr: Container, cgroup_version: int, *, procs: bool = False
+    ) -> CgroupSnapshot:
+        """
+        Capture a snapshot of a container's cgroup setup.
+
+        This uses a single exec into the container, whose cost is constant
+        unless the cgroups of every process are also captured.
+
+        :param ctr:
+            The container to inspect.
+        :param cgroup_version:
+            The host's cgroup version.
+        :param procs:
+            Whether to capture the cgroups of every process in the container,
+            otherwise the snapshot's 'procs' is empty.
+        :return:
+            The snapshot.
+        """
+        mountinfo, probe_output, procs_output = _split_probe_sections(
+            ctr.execute(
+                ["sh", "-c", _CGROUP_PROBE_SCRIPT, "sh", "1" if procs else "0"]
+            ),
+            3,
+        )
+        mounts = {m.path: m for m in parse_mountinfo(mountinfo)}
+
+        pid_1_paths = {}
+        for line in probe_output.splitlines():
+            (
+                mnt,
+                hierarchy,
+                path,
+                system_slice,
+                controllers,
+                subtree_control,
+                parent_subtree_control,
+            ) = line.split("\t")
+            # Only consider the mount for the given hierarchy, using the first
+            # found in the case of multiple mounts.
+            if not mounts[mnt].is_for_hierarchy(hierarchy) or hierarchy in pid_1_paths:
+                continue
+            pid_1_paths[hierarchy] = CgroupPath(
+                hierarchy=hierarchy,
+                path=path,
+                has_system_slice=system_slice == "1",
+                controllers=frozenset(controllers.split()),
+                subtree_control=frozenset(subtree_control.split()),
+                parent_subtree_control=frozenset(parent_subtree_control.split()),
+            )
+
+        proc_lines: dict[int, tuple[str, list[str]]] = {}
+        for line in procs_output.splitlines():
+            pid, comm, cgroup_line = line.split("\t", maxsplit=2)
+            proc_lines.setdefault(int(pid), (comm, []))[1].append(cgroup_line)
+        procs = tuple(
+            ProcCgroups(
+                pid=pid,
+                comm=comm,
+                cgroups=tuple(sorted(parse_proc_cgroup("\n".join(lines)).items())),
+            )
+            for pid, (comm, lines) in sorted(proc_lines.items())
+        )
+
+        return cls(
+            cgroup_version=cgroup_version,
+            mounts=tuple(mounts.values()),
+            pid_1_paths=tuple(pid_1_paths[h] for h in sorted(pid_1_paths)),
+            procs=procs,
+        )
+
+    @property
+    def enabled_controllers(self) -> frozenset[str]:
+        """
+        The cgroup controllers systemd is able to use.
+
+        On cgroups v1 these are the controllers whose hierarchy systemd has
+        created 'system.slice' in. On cgroups v2 these are the controllers
+        available in PID 1's cgroup.
+        """
+        if self.cgroup_version == 1:
+            return frozenset(
+                ctrl
+                for path in self.pid_1_paths
+                if path.has_system_slice
+                for ctrl in path.hierarchy.split(",")
+                if ctrl and not ctrl.startswith("name=")
+            )
+        else:
+            return next(
+                (p.controllers for p in self.pid_1_paths if p.hierarchy == ""),
+                frozenset(),
+            )
+
+    def get_proc(self, pid: int) -> Optional[ProcCgroups]:
+        """Get the cgroup membership of the given process, if it exists."""
+        return next((p for p in self.procs if p.pid == pid), None)
+
+    def to_dict(self) -> dict[str, Any]:
+        """Convert to a JSON-compatible dict."""
+        return to_json_compatible(self)
+
+    @classmethod
+    def from_dict(cls, data: Mapping[str, Any]) -> CgroupSnapshot:
+        """Create from a dict as returned by to_dict()."""
+        return cls(
+            cgroup_version=data["cgroup_version"],
+            mounts=tuple(
+                CgroupMount(
+                    **{
+                        **m,
+                        "options": tuple(m["options"]),
+                        "super_options": tuple(m["super_options"]),
+                    }
+                )
+                for m in data["mounts"]
+            ),
+            pid_1_paths=tuple(
+                CgroupPath(
+                    **{
+                        **p,
+                        "controllers": frozenset(p["controllers"]),
+                        "subtree_control": frozenset(p["subtree_control"]),
+                        "parent_subtree_control": frozenset(
+                            p["parent_subtree_control"]
+                        ),
+                    }
+                )
+                for p in data["pid_1_paths"]
+            ),
+            procs=tuple(
+                ProcCgroups(
+                    pid=p["pid"],
+                    comm=p["comm"],
+                    cgroups=tuple(tuple(c) for c in p["cgroups"]),
+                )
+                for p in data["procs"]
+            ),
+        )
+
+    def diff(self, other: CgroupSnapshot) -> dict[str, tuple[Any, Any]]:
+        """
+        Get the differences from another snapshot.
+
+        :param other:
+            The snapshot to compare against.
+        :return:
+            A mapping of field name to the pair of differing values (this
+            snapshot's value first), empty if the snapshots are equal.
+        """
+        return {
+            f.name: (getattr(self, f.name), getattr(other, f.name))
+            for f in dataclasses.fields(self)
+            if getattr(self, f.name) != getattr(other, f.name)
+        }
+
+
+def get_enabled_cgroup_controllers(ctr: Container, cgroup_version: int) -> set[str]:
+    """
+    Get the cgroup controllers systemd in a container is able to use.
+
+    :param ctr:
+        The container to inspect.
+    :param cgroup_version:
+        The host's cgroup version.
+    :return:
+        The set of controller names.
+    """
+    snapshot = CgroupSnapshot.capture(ctr, cgroup_version, procs=False)
+    return set(snapshot.enabled_controllers)
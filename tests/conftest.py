@@ -1,25 +1,61 @@
 from __future__ import annotations
 
+import concurrent.futures
 import contextlib
+import dataclasses
+import itertools
+import json
 import logging
+import os
+import subprocess
 import textwrap
 import time
+import uuid
 from pathlib import Path
-from typing import Any, Generator, Mapping, Optional
+from typing import (
+    Any,
+    AsyncContextManager,
+    Callable,
+    ContextManager,
+    Generator,
+    Hashable,
+    Mapping,
+    Optional,
+)
 
 import pytest
 from python_on_whales import Container
 from python_on_whales import DockerException as CtrException
 from python_on_whales import Image as CtrImage
 
-from . import utils
-from .utils import CtrClient, CtrInitError, CtrMgr, Mount
-from . import ALL_SETUP_MODES, CUSTOM_SETUP_MODES, SYSTEMD_TEST_DIR, CtrCtxType
+from . import (
+    aio,
+    console,
+    containers,
+    host,
+    matrix,
+    resources,
+    utils,
+)
+from .exec_agent import ExecAgent
+from .utils import CtrClient, CtrInitError, CtrMgr
+from . import (
+    ALL_SETUP_MODES,
+    CUSTOM_SETUP_MODES,
+    SYSTEMD_TEST_DIR,
+    AsyncCtrCtxType,
+    CtrCtxType,
+)
 
 
 logger = logging.getLogger(__name__)
 
-_PARAMETERISATIONS = ["setup_mode", "cgroupns", "cgroup_mode"]
+# Rough upper bound on the memory used by a single systemd container, used to
+# limit the number of tests run in parallel.
+_CTR_MEMORY_ESTIMATE = 256 * 1024 * 1024
+
+# The distro used for systemd images unless '--distros' is given.
+_DEFAULT_DISTRO = utils.Distro("ubuntu", "20.04")
 
 
 # -----------------------------------------------------------------------------
@@ -43,6 +79,13 @@ def pytest_addoption(parser: pytest.Parser) -> None:
         default="docker",
         help="The executable used to manage containers, defaults to 'docker'",
     )
+    pow_group.addoption(
+        "--container-api",
+        metavar="SOCKET",
+        help="Path to the container engine's API socket (e.g. "
+        "/var/run/docker.sock), to manage containers via the API rather than "
+        "the CLI",
+    )
 
     # Test-specific args
     test_group = parser.getgroup("systemd-tests")
@@ -64,11 +107,139 @@ def pytest_addoption(parser: pytest.Parser) -> None:
         help="Comma-separated list of setup modes to use, choices: "
         + ", ".join(["default"] + CUSTOM_SETUP_MODES),
     )
+
+    def parse_distros(value: str) -> list[utils.Distro]:
+        return [utils.Distro.from_str(x) for x in value.split(",")]
+
+    test_group.addoption(
+        "--distro",
+        "--distros",
+        type=parse_distros,
+        help="Comma-separated list of distro images to build systemd images "
+        f"from, defaults to {_DEFAULT_DISTRO}, supported distros: "
+        + ", ".join(utils.DISTRO_FAMILIES),
+    )
     test_group.addoption(
         "--cgroupns",
         choices=["host", "private"],
         help="Cgroupns setting to use",
     )
+    test_group.addoption(
+        "--rebuild-images",
+        action="store_true",
+        help="Rebuild container images even if their build inputs are unchanged",
+    )
+    test_group.addoption(
+        "--prebuild-images",
+        action="store_true",
+        help="Build the images for all selected setup modes in parallel at the "
+        "start of the session",
+    )
+    test_group.addoption(
+        "--exec-agent",
+        action="store_true",
+        help="Run commands in containers via a long-lived exec agent process "
+        "rather than a new exec process per command",
+    )
+    test_group.addoption(
+        "--checkpoint-boot",
+        action="store_true",
+        help="Boot each container configuration once and checkpoint it (using "
+        "CRIU), restoring new containers from the checkpoint rather than booting "
+        "them, falling back to booting if checkpointing is not supported",
+    )
+    test_group.addoption(
+        "--boot-timeout",
+        type=float,
+        default=60,
+        metavar="SECS",
+        help="Timeout for systemd containers to boot, defaults to 60 seconds",
+    )
+    test_group.addoption(
+        "--boot-timings",
+        type=Path,
+        metavar="FILE",
+        help="Record the timings of boot phases for each container to the "
+        "given JSON lines file",
+    )
+    test_group.addoption(
+        "--sample-resources",
+        type=float,
+        metavar="SECS",
+        help="Sample each container's resource usage (memory, CPU, pids and IO) "
+        "at the given interval, added to the test's user properties under "
+        "'resource_samples'",
+    )
+    test_group.addoption(
+        "--console-buffer-size",
+        type=int,
+        default=1024 * 1024,
+        metavar="BYTES",
+        help="Maximum size of each container's console output to keep in "
+        "memory, defaults to 1MiB",
+    )
+    test_group.addoption(
+        "--console-log-dir",
+        type=Path,
+        metavar="DIR",
+        help="Directory to write container console output that does not fit in "
+        "memory to, otherwise it is discarded",
+    )
+    test_group.addoption(
+        "--benchmarks",
+        action="store_true",
+        help="Run benchmark tests, which are skipped by default",
+    )
+    def parse_iterations(value: str) -> int:
+        iterations = int(value)
+        if iterations < 1:
+            raise ValueError("At least one iteration is required")
+        return iterations
+
+    test_group.addoption(
+        "--benchmark-iterations",
+        type=parse_iterations,
+        default=5,
+        metavar="N",
+        help="Number of iterations for each benchmark, defaults to 5",
+    )
+    test_group.addoption(
+        "--benchmark-output",
+        type=Path,
+        metavar="FILE",
+        help="JSON lines file to write benchmark results to",
+    )
+
+    def parse_density_steps(value: str) -> list[int]:
+        steps = [int(x) for x in value.split(",")]
+        if any(x <= 0 for x in steps):
+            raise ValueError("Density steps must be positive")
+        return steps
+
+    test_group.addoption(
+        "--density-steps",
+        type=parse_density_steps,
+        default=[10, 50, 100],
+        metavar="N,...",
+        help="Comma-separated numbers of concurrent containers to boot in each "
+        "step of the density benchmark, defaults to 10,50,100",
+    )
+    test_group.addoption(
+        "--exec-spam-threads",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Number of concurrent threads creating exec processes in "
+        "test_exec_proc_spam, defaults to 1",
+    )
+    test_group.addoption(
+        "--exec-spam-duration",
+        type=float,
+        default=2,
+        metavar="SECS",
+        help="Duration to create exec processes for in test_exec_proc_spam, "
+        "defaults to 2 seconds",
+    )
     test_group.addoption(
         "--cgroup-mode",
         choices=["legacy", "hybrid", "unified"],
@@ -76,6 +247,43 @@ def pytest_addoption(parser: pytest.Parser) -> None:
     )
 
 
+@pytest.hookimpl(tryfirst=True)
+def pytest_cmdline_main(config: pytest.Config) -> None:
+    """Pytest hook for the main command line entrypoint."""
+    # When running tests in parallel with pytest-xdist, default to grouping
+    # tests by setup mode such that each image is only built by one worker.
+    if config.getoption("numprocesses", None) and config.option.dist == "no":
+        config.option.dist = "loadgroup"
+
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_xdist_auto_num_workers(config: pytest.Config) -> Optional[int]:
+    """
+    Pytest-xdist hook for determining the number of workers with '-n auto'.
+
+    The number of parallel workers is limited based on the CPU and memory
+    available to the container manager, since each worker runs systemd
+    containers.
+    """
+    if os.environ.get("PYTEST_XDIST_AUTO_NUM_WORKERS"):
+        # Defer to pytest-xdist's handling of the env var.
+        return None
+    ctr_client = CtrClient(
+        client_exe=config.getoption("--container-exe"),
+        host=config.getoption("--container-host"),
+    )
+    cpus, memory, mem_metric = host.get_host_resources(ctr_client)
+    num_workers = max(1, min(cpus, memory // _CTR_MEMORY_ESTIMATE))
+    logger.info(
+        "Using %d workers based on %d CPUs and %d MiB memory (%s)",
+        num_workers,
+        cpus,
+        memory // (1024 * 1024),
+        mem_metric or "unknown",
+    )
+    return num_workers
+
+
 def pytest_configure(config: pytest.Config) -> None:
     """Pytest configuration hook."""
 
@@ -83,34 +291,25 @@ def pytest_configure(config: pytest.Config) -> None:
     ctr_client = CtrClient(
         client_exe=config.getoption("--container-exe"),
         host=config.getoption("--container-host"),
+        api_socket=config.getoption("--container-api"),
     )
     config.option.ctr_client = ctr_client
 
-    # Set 'cgroup_version' config value.
+    # Set 'run_id' config value, shared between pytest-xdist workers.
+    workerinput = getattr(config, "workerinput", {})
+    config.option.run_id = workerinput.get("testrunuid") or uuid.uuid4().hex
+
+    # Set 'host_probe' and 'cgroup_version' config values.
     try:
-        output = ctr_client.run(
-            "ubuntu:20.04",
-            ["stat", "-f", "/sys/fs/cgroup/", "-c", "%T"],
-            detach=False,
-            remove=True,
-        )
-    except CtrException as e:
-        pytest.exit(f"Failed to run simple container to determine cgroup version:\n{e}")
-    else:
-        output = output.strip()
-        if output == "tmpfs":
-            config.option.cgroup_version = 1
-        elif output == "cgroup2fs":
-            config.option.cgroup_version = 2
-        else:
-            pytest.exit(
-                "Unable to determine cgroup version from container's "
-                f"/sys/fs/cgroup filesystem type {output!r}"
-            )
-        logger.info("Determined cgroup version %d", config.option.cgroup_version)
+        host_probe = _get_host_probe(config, ctr_client)
+    except (CtrException, subprocess.CalledProcessError, ValueError) as e:
+        pytest.exit(f"Failed to determine container host properties:\n{e}")
+    config.option.host_probe = host_probe
+    config.option.cgroup_version = host_probe.cgroup_version
+    logger.info("Determined cgroup version %d", config.option.cgroup_version)
 
     # Register markers.
-    for param in _PARAMETERISATIONS:
+    for param in matrix.PARAMETERS:
         config.addinivalue_line(
             "markers",
             f"{param}([...]): Values for the given parameter to use in the test",
@@ -119,82 +318,101 @@ def pytest_configure(config: pytest.Config) -> None:
         "markers",
         f'ctr_mgr(MGR, reason="..."): Container manager required by the test',
     )
+    config.addinivalue_line(
+        "markers",
+        "benchmark: Benchmark test, only run when '--benchmarks' is passed",
+    )
+    config.addinivalue_line(
+        "markers",
+        "ctr_read_only: The test only inspects containers, allowing them to "
+        "be shared with other read-only tests",
+    )
 
 
 def pytest_generate_tests(metafunc: pytest.Metafunc) -> None:
+    # The 'xdist_group' mark ensures tests for a given setup mode and distro
+    # are run by a single worker when running in parallel, such that the
+    # package-scoped image fixture is only created once per setup mode.
+    # The distro is only included in test IDs when testing multiple distros.
+    distros = metafunc.config.getoption("--distros") or [_DEFAULT_DISTRO]
+    params = []
+    for distro, mode in itertools.product(distros, ALL_SETUP_MODES):
+        param_id = mode or "default"
+        if len(distros) > 1:
+            param_id += f"-{distro}"
+        params.append(
+            pytest.param(
+                distro,
+                mode,
+                marks=pytest.mark.xdist_group(f"{distro}-{mode or 'default'}"),
+                id=param_id,
+            )
+        )
     metafunc.parametrize(
-        "setup_mode",
-        ALL_SETUP_MODES,
-        ids=["default"] + CUSTOM_SETUP_MODES,
-        scope="package",
-        indirect=True,
+        ["distro", "setup_mode"], params, scope="package", indirect=True
     )
 
 
 def pytest_collection_modifyitems(
     config: pytest.Config, items: list[pytest.Item]
 ) -> None:
-    cgroup_version: int = config.option.cgroup_version
-
-    # Find paramaterisations that don't make sense and remove them from
-    # the list of tests to be run.
-    remove_not_applicable = []
-    for item in items:
-        if not isinstance(item, pytest.Function):
-            # Not sure when this would be the case?
-            continue
-        test_params: Mapping[str, Any] = item.callspec.params
-        valid_conditions = {}
-        if cgroup_version == 1:
-            valid_conditions["cgroupv1 non-unified"] = (
-                test_params["cgroup_mode"] != "unified"
-            )
-        else:
-            valid_conditions["cgroupv2 unified"] = (
-                test_params["cgroup_mode"] == "unified"
-            )
-            valid_conditions["cgroupv2 no minimal"] = (
-                test_params["setup_mode"] != "minimal"
-            )
-        if test_params["cgroupns"] == "private":
-            valid_conditions["private cgroupns setup_mode"] = test_params[
-                "setup_mode"
-            ] not in ["rebind", "cgroupns", "cgroupns_simple"]
-        for param in ["setup_mode", "cgroupns", "cgroup_mode"]:
-            marker = item.get_closest_marker(param)
-            if marker:
-                valid_conditions[param] = test_params[param] in marker.args[0]
-        if not all(valid_conditions.values()):
-            remove_not_applicable.append(item)
-
-    logger.debug(
-        "Removing %u test parameterisations that don't apply",
-        len(remove_not_applicable),
+    # Compile the rules for which paramaterisations don't make sense, and
+    # which should be removed based on CLI arguments.
+    applicable = matrix.compile_matrix(
+        matrix.APPLICABILITY_RULES,
+        {
+            "cgroup_version": config.option.cgroup_version,
+            "ctr_mgr": str(config.option.ctr_client.mgr),
+        },
     )
-    items[:] = [x for x in items if x not in remove_not_applicable]
+    cli_rules = [
+        matrix.MatrixRule(
+            "--setup-modes",
+            require={
+                "setup_mode": set(config.getoption("--setup-modes") or ALL_SETUP_MODES)
+            },
+        )
+    ]
+    if req_cgroupns := config.getoption("--cgroupns"):
+        cli_rules.append(
+            matrix.MatrixRule("--cgroupns", require={"cgroupns": {req_cgroupns}})
+        )
+    if req_cgroup_mode := config.getoption("--cgroup-mode"):
+        cli_rules.append(
+            matrix.MatrixRule(
+                "--cgroup-mode", require={"cgroup_mode": {req_cgroup_mode}}
+            )
+        )
+    requested = matrix.compile_matrix(cli_rules)
+    run_benchmarks = config.getoption("--benchmarks")
 
-    # Find paramaterisations that should be removed based on CLI arguments.
-    remove_due_to_cli_args = []
-    req_setup_modes = config.getoption("--setup-modes") or ALL_SETUP_MODES
-    req_cgroupns = config.getoption("--cgroupns")
-    req_cgroup_mode = config.getoption("--cgroup-mode")
+    kept_items = []
+    not_applicable_count = 0
+    cli_args_count = 0
     for item in items:
         if not isinstance(item, pytest.Function):
             # Not sure when this would be the case?
+            kept_items.append(item)
             continue
-        test_params: Mapping[str, Any] = item.callspec.params
-        if test_params["setup_mode"] not in req_setup_modes:
-            remove_due_to_cli_args.append(item)
-        elif req_cgroupns and test_params["cgroupns"] != req_cgroupns:
-            remove_due_to_cli_args.append(item)
-        elif req_cgroup_mode and test_params["cgroup_mode"] != req_cgroup_mode:
-            remove_due_to_cli_args.append(item)
+        combo = matrix.get_combo(item.callspec.params)
+        if combo not in applicable or not all(
+            value in marker.args[0]
+            for param, value in zip(matrix.PARAMETERS, combo)
+            if (marker := item.get_closest_marker(param))
+        ):
+            not_applicable_count += 1
+        elif combo not in requested or (
+            not run_benchmarks and item.get_closest_marker("benchmark")
+        ):
+            cli_args_count += 1
+        else:
+            kept_items.append(item)
 
     logger.debug(
-        "Removing %u test parameterisations due to CLI args",
-        len(remove_due_to_cli_args),
+        "Removing %u test parameterisations that don't apply", not_applicable_count
     )
-    items[:] = [x for x in items if x not in remove_due_to_cli_args]
+    logger.debug("Removing %u test parameterisations due to CLI args", cli_args_count)
+    items[:] = kept_items
 
     # Mark tests that cannot be executed to be skipped.
     for item in items:
@@ -205,6 +423,242 @@ def pytest_collection_modifyitems(
                 item.add_marker(pytest.mark.skip(skip_reason))
 
 
+# -----------------------------------------------------------------------------
+# Helpers
+# -----------------------------------------------------------------------------
+
+
+def _get_host_probe(config: pytest.Config, ctr_client: CtrClient) -> host.HostProbe:
+    """
+    Get the container host's properties, see host.probe_host().
+
+    The result is stored in pytest's cache, keyed on the host's setup (see
+    host.get_host_probe_key()), such that the host only needs probing when its
+    setup changes.
+    """
+    cache: Optional[pytest.Cache] = getattr(config, "cache", None)
+    if cache is None:
+        return host.probe_host(ctr_client)
+    cache_key = f"systemd-tests/host-probe/{host.get_host_probe_key(ctr_client)}"
+    if cached := cache.get(cache_key, None):
+        logger.debug("Using cached host probe %s", cache_key)
+        return host.HostProbe.from_dict(cached)
+    host_probe = host.probe_host(ctr_client)
+    cache.set(cache_key, host_probe.to_dict())
+    return host_probe
+
+
+class _CtrPool:
+    """A pool of booted containers that can be shared between tests."""
+
+    def __init__(self, exit_stack: contextlib.ExitStack):
+        self._exit_stack = exit_stack
+        self._ctrs: dict[Hashable, Container] = {}
+
+    def get(
+        self, key: Hashable, ctx_factory: Callable[[], ContextManager[Container]]
+    ) -> Container:
+        """
+        Get a container from the pool, starting one if needed.
+
+        :param key:
+            The key identifying the container configuration.
+        :param ctx_factory:
+            Called to create the context manager for starting a container if
+            there isn't one in the pool for the given key. The context is
+            exited when the pool is torn down.
+        :return:
+            The pooled container.
+        """
+        if key not in self._ctrs:
+            self._ctrs[key] = self._exit_stack.enter_context(ctx_factory())
+        else:
+            logger.info("Reusing pooled container %s", self._ctrs[key].name)
+        return self._ctrs[key]
+
+
+class _CheckpointCache:
+    """Checkpoints of booted containers, see containers.CtrCheckpoint."""
+
+    def __init__(self, ctr_client: CtrClient, directory: Path):
+        self._ctr_client = ctr_client
+        self._directory = directory
+        self._checkpoints: dict[Hashable, containers.CtrCheckpoint] = {}
+        self.supported = True
+
+    def get(self, key: Hashable) -> Optional[containers.CtrCheckpoint]:
+        """Get the checkpoint for the given container configuration, if any."""
+        return self._checkpoints.get(key) if self.supported else None
+
+    def create(
+        self,
+        key: Hashable,
+        ctr: Container,
+        image: CtrImage,
+        args: tuple,
+        kwargs: Mapping[str, Any],
+    ) -> None:
+        """
+        Checkpoint a container for the given configuration.
+
+        If checkpointing fails, it is assumed to be unsupported and no more
+        checkpoints are attempted.
+        """
+        if not self.supported or key in self._checkpoints:
+            return
+        path = self._directory / f"checkpoint-{len(self._checkpoints)}"
+        try:
+            self._checkpoints[key] = containers.CtrCheckpoint.create(
+                self._ctr_client, ctr, path, image, args, kwargs
+            )
+        except (CtrException, OSError) as e:
+            logger.warning("Checkpointing not supported, booting containers: %s", e)
+            self.supported = False
+
+
+# The commands to install systemd, by distro package manager family. The dnf
+# distros' minimal images also lack tools the tests and setup modes use, such
+# as 'pidof' (procps-ng) and 'findmnt'/'unshare' (util-linux).
+_SYSTEMD_INSTALL_CMDS = {
+    "apt": [
+        "apt-get update -y",
+        "apt-get install -y systemd",
+        "ln -sf /lib/systemd/systemd /sbin/init",
+    ],
+    "dnf": [
+        "dnf install -y systemd shadow-utils procps-ng util-linux",
+        "dnf clean all",
+        "ln -sf /usr/lib/systemd/systemd /sbin/init",
+    ],
+}
+
+
+def _get_image_build_kwargs(config: pytest.Config) -> dict[str, Any]:
+    """
+    Get the arguments for building images, see utils.build_with_dockerfile().
+
+    The test run ID is shared between parallel workers, such that with
+    '--rebuild-images' each image is only rebuilt by one worker.
+    """
+    return {
+        "use_cache": not config.getoption("--rebuild-images"),
+        "run_id": config.option.run_id,
+    }
+
+
+def _build_systemd_image(
+    ctr_client: CtrClient, distro: utils.Distro, **build_kwargs: Any
+) -> CtrImage:
+    """Build the base systemd image for a distro."""
+    # Note that systemd-resolved.service requires CAP_NET_RAW, which is not
+    # granted by podman by default. To avoid requiring this extra capability
+    # we simply mask the service - it's not clear whether it makes sense in a
+    # container anyway?
+    setup_cmds = [
+        *_SYSTEMD_INSTALL_CMDS[distro.family],
+        "systemctl mask systemd-resolved.service",
+        "systemctl set-default multi-user.target",
+    ]
+    dockerfile = f"FROM {distro}\nRUN " + " \\\n    && ".join(setup_cmds) + "\n"
+    dockerfile += textwrap.dedent(
+        """\
+        RUN echo 'root:root' | chpasswd
+        STOPSIGNAL SIGRTMIN+3
+        ENTRYPOINT ["/sbin/init"]
+        """
+    )
+    return utils.build_with_dockerfile(
+        ctr_client, dockerfile, tags=distro.image_tag(), **build_kwargs
+    )
+
+
+def _build_setup_mode_image(
+    ctr_client: CtrClient,
+    systemd_image: CtrImage,
+    distro: utils.Distro,
+    setup_mode: str,
+    **build_kwargs: Any,
+) -> CtrImage:
+    """Build the image for a custom setup mode, based on the systemd image."""
+    # The init script is copied last such that it's the only layer that differs
+    # between setup modes, with the other layers shared in the build cache.
+    dockerfile = textwrap.dedent(
+        f"""\
+        FROM {systemd_image.repo_tags[0]}
+        ENTRYPOINT ["/init_script.sh"]
+        COPY init_script.sh /init_script.sh
+        """
+    )
+    return utils.build_with_dockerfile(
+        ctr_client,
+        dockerfile,
+        build_root=SYSTEMD_TEST_DIR / "setup_modes" / setup_mode,
+        tags=distro.image_tag(setup_mode),
+        **build_kwargs,
+    )
+
+
+def _get_ctr_run_kwargs(
+    ctr_mgr: CtrMgr,
+    cgroup_version: int,
+    cgroupns: str,
+    cgroup_mode: str,
+    *,
+    systemd: Optional[bool] = None,
+    **kwargs,
+) -> dict[str, Any]:
+    """
+    Get the arguments to run a systemd test container with, applying defaults.
+
+    :param ctr_mgr:
+        The container manager in use.
+    :param cgroup_version:
+        The host's cgroup version.
+    :param cgroupns:
+        The parameterised cgroup namespace mode.
+    :param cgroup_mode:
+        The parameterised systemd cgroup mode.
+    :param systemd:
+        Whether to enable systemd mode, see the ctr_ctx fixture.
+    :param kwargs:
+        Arguments to be passed through to Container.run().
+    :return:
+        The arguments to pass to Container.run().
+    """
+    if systemd is None and ctr_mgr is CtrMgr.PODMAN:
+        # Disable podman's systemd mode by default for consistency when
+        # comparing with docker.
+        systemd = False
+    elif systemd is False and ctr_mgr is CtrMgr.DOCKER:
+        # Docker doesn't have systemd mode, so no need to pass the arg for
+        # it to be 'False'.
+        systemd = None
+    elif systemd is not None:
+        if ctr_mgr is CtrMgr.DOCKER:
+            # Skip at a per-testcase level, for explicitness.
+            pytest.fail("Systemd mode not supported by Docker")
+        kwargs["systemd"] = systemd
+    if cgroup_mode == "legacy":
+        # Force systemd to run in legacy cgroup v1 mode.
+        assert cgroup_version == 1
+        kwargs.setdefault("envs", {})[
+            "SYSTEMD_PROC_CMDLINE"
+        ] = "systemd.legacy_systemd_cgroup_controller=1"
+    kwargs.setdefault("tty", True)
+    kwargs.setdefault("interactive", True)  # not needed, helps debugging
+    if not kwargs.setdefault("detach", True):
+        raise TypeError("Running container attached is not supported")
+    if kwargs.setdefault("remove", False):
+        raise TypeError("Removing container on exit breaks logging so is not supported")
+    if kwargs.setdefault("cgroupns", cgroupns) != cgroupns:
+        raise TypeError(
+            "Cgroup namespace mode is parameterised, skip unwanted tests "
+            "rather than overriding"
+        )
+    kwargs.setdefault("name", f"systemd-tests-{uuid.uuid4().hex[:12]}")
+    return kwargs
+
+
 # -----------------------------------------------------------------------------
 # Fixtures
 # -----------------------------------------------------------------------------
@@ -229,38 +683,102 @@ def cgroup_version(pytestconfig: pytest.Config) -> int:
 
 
 @pytest.fixture(scope="session", autouse=True)
-def host_check(ctr_client: CtrClient) -> None:
+def host_check(pytestconfig: pytest.Config, ctr_client: CtrClient) -> None:
     """Check and log properties of the container host."""
     logger.info(
         "Using container manager %s, see debug logs for detailed info",
         ctr_client.mgr,
     )
-    utils.run_cmd([ctr_client.exe, "info"], log_output=True)
+    host_probe: host.HostProbe = pytestconfig.option.host_probe
+    logger.debug("Container manager info:\n%s", host_probe.engine_info.strip("\n"))
 
 
-@pytest.fixture(scope="package")
-def systemd_image(ctr_client: CtrClient) -> CtrImage:
-    # Note that systemd-resolved.service requires CAP_NET_RAW, which is not
-    # granted by podman by default. To avoid requiring this extra capability
-    # we simply mask the service - it's not clear whether it makes sense in a
-    # container anyway?
-    dockerfile = textwrap.dedent(
-        f"""\
-        FROM ubuntu:20.04
-        RUN apt-get update -y \\
-            && apt-get install -y systemd \\
-            && ln -s /lib/systemd/systemd /sbin/init \\
-            && systemctl mask systemd-resolved.service \\
-            && systemctl set-default multi-user.target
-        RUN echo 'root:root' | chpasswd
-        STOPSIGNAL SIGRTMIN+3
-        ENTRYPOINT ["/sbin/init"]
-        """
-    )
-    image = utils.build_with_dockerfile(
-        ctr_client, dockerfile, tags="ubuntu-systemd:20.04"
+@pytest.fixture(scope="session", autouse=True)
+def prebuild_images(
+    request: pytest.FixtureRequest,
+    pytestconfig: pytest.Config,
+    ctr_client: CtrClient,
+) -> dict[tuple[utils.Distro, Optional[str]], CtrImage]:
+    """
+    Build the images for all selected distros and setup modes in parallel, if
+    requested.
+
+    The base systemd images for each distro are built first, with the setup
+    mode images then only adding the init script layer.
+
+    :return:
+        A mapping of distro and setup mode to the corresponding image, empty if
+        images are not being pre-built.
+    """
+    if not pytestconfig.getoption("--prebuild-images"):
+        return {}
+    selected: set[tuple[utils.Distro, Optional[str]]] = {
+        (item.callspec.params["distro"], item.callspec.params["setup_mode"])
+        for item in request.session.items
+        if isinstance(item, pytest.Function)
+    }
+    distros = sorted({distro for distro, _ in selected})
+    build_kwargs = _get_image_build_kwargs(pytestconfig)
+    logger.info(
+        "Pre-building images for %d distros and %d setup modes",
+        len(distros),
+        len({mode for _, mode in selected}),
     )
-    yield image
+    images = {}
+    # Parallel workers all depend on these images, so avoid building them
+    # concurrently. Workers waiting on the lock then find the images already
+    # built, via their build hash.
+    with utils.interprocess_lock("systemd-image-build"):
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, len(selected))
+        ) as executor:
+            base_futures = {
+                distro: executor.submit(
+                    _build_systemd_image, ctr_client, distro, **build_kwargs
+                )
+                for distro in distros
+            }
+            images.update({(d, None): f.result() for d, f in base_futures.items()})
+            futures = {
+                (distro, mode): executor.submit(
+                    _build_setup_mode_image,
+                    ctr_client,
+                    images[(distro, None)],
+                    distro,
+                    mode,
+                    **build_kwargs,
+                )
+                for distro, mode in sorted(selected - set(images), key=str)
+            }
+            images.update({key: f.result() for key, f in futures.items()})
+    return images
+
+
+@pytest.fixture(scope="package")
+def distro(request: pytest.FixtureRequest) -> utils.Distro:
+    """
+    The distro of the systemd images, parameterising all tests at a package
+    level.
+    """
+    return request.param
+
+
+@pytest.fixture(scope="package")
+def systemd_image(
+    pytestconfig: pytest.Config,
+    ctr_client: CtrClient,
+    prebuild_images: dict[tuple[utils.Distro, Optional[str]], CtrImage],
+    distro: utils.Distro,
+) -> CtrImage:
+    """The base systemd image for the parameterised distro."""
+    if (distro, None) in prebuild_images:
+        return prebuild_images[(distro, None)]
+    # Parallel workers all depend on this image, so avoid building it
+    # concurrently.
+    with utils.interprocess_lock("systemd-image-build"):
+        return _build_systemd_image(
+            ctr_client, distro, **_get_image_build_kwargs(pytestconfig)
+        )
 
 
 @pytest.fixture(scope="package")
@@ -278,28 +796,25 @@ def setup_mode(request: pytest.FixtureRequest) -> None:
 
 @pytest.fixture(scope="package")
 def pkg_image(
+    pytestconfig: pytest.Config,
     ctr_client: CtrClient,
+    prebuild_images: dict[tuple[utils.Distro, Optional[str]], CtrImage],
     systemd_image: CtrImage,
+    distro: utils.Distro,
     setup_mode: Optional[str],
 ) -> CtrImage:
-    """The image to use for the parameterised setup mode."""
+    """The image to use for the parameterised distro and setup mode."""
     if setup_mode is None:
         return systemd_image
-
-    dockerfile = textwrap.dedent(
-        f"""\
-        FROM {systemd_image.repo_tags[0]}
-        COPY init_script.sh /init_script.sh
-        ENTRYPOINT ["/init_script.sh"]
-        """
-    )
-    image = utils.build_with_dockerfile(
+    if (distro, setup_mode) in prebuild_images:
+        return prebuild_images[(distro, setup_mode)]
+    return _build_setup_mode_image(
         ctr_client,
-        dockerfile,
-        build_root=SYSTEMD_TEST_DIR / "setup_modes" / setup_mode,
-        tags=f"ubuntu-systemd-{setup_mode}:20.04",
+        systemd_image,
+        distro,
+        setup_mode,
+        **_get_image_build_kwargs(pytestconfig),
     )
-    return image
 
 
 @pytest.fixture(scope="package", autouse=True)
@@ -312,16 +827,14 @@ def host_check_systemd(
     """
     Check properties of the container host for running systemd containers.
     """
-    if pytestconfig.getoption("--container-host"):
+    host_probe: host.HostProbe = pytestconfig.option.host_probe
+    if not host_probe.local:
         logger.warning("Unable to check mounts on remote host")
         return
     # Check /sys/fs/cgroup/systemd exists if host is on cgroups v1.
     if cgroup_version == 1:
-        mounts = [
-            Mount(*L.split()[:4]) for L in Path("/proc/mounts").read_text().splitlines()
-        ]
         if ("/sys/fs/cgroup/systemd", "cgroup") not in [
-            (m.path, m.type) for m in mounts
+            (m.path, m.type) for m in host_probe.cgroup_mounts
         ] and setup_mode is None:
             pytest.fail(
                 "Default systemd containers cannot run on a cgroup v1 host that "
@@ -329,13 +842,13 @@ def host_check_systemd(
             )
 
 
-@pytest.fixture(params=["host", "private"])
+@pytest.fixture(params=matrix.CGROUPNS_VALUES)
 def cgroupns(request: pytest.FixtureRequest) -> str:
     """Parameterise on cgroupns (host and private)."""
     return request.param
 
 
-@pytest.fixture(params=["legacy", "hybrid", "unified"])
+@pytest.fixture(params=matrix.CGROUP_MODES)
 def cgroup_mode(request: pytest.FixtureRequest) -> str:
     """Parameterise on systemd cgroup mode."""
     return request.param
@@ -367,20 +880,103 @@ def default_ctr_kwargs(ctr_mgr: CtrMgr, setup_mode: Optional[str]) -> dict[str,
         kwargs["envs"] = {"container": "docker"}
 
     # Privileged mode is required when running with Docker, unless certain
-    # custom setup is performed. Otherwise, CAP_SYS_ADMIN is sufficient.
-    if ctr_mgr is CtrMgr.DOCKER and setup_mode in [None, "inner_cgroup"]:
+    # custom setup is performed. Otherwise, CAP_SYS_ADMIN is sufficient. This
+    # is declared in the setup mode's metadata.
+    metadata = matrix.SETUP_MODE_METADATA[setup_mode]
+    if str(ctr_mgr) in metadata.privileged_ctr_mgrs:
         kwargs["privileged"] = True
     else:
-        kwargs["cap_add"] = ["sys_admin"]
+        kwargs["cap_add"] = list(metadata.capabilities)
 
     return kwargs
 
 
+@pytest.fixture(scope="session")
+def ctr_reaper(ctr_client: CtrClient) -> Generator[containers.CtrReaper, None, None]:
+    """
+    Background remover of containers, see containers.CtrReaper.
+
+    All queued containers are removed by the end of the session.
+    """
+    reaper = containers.CtrReaper(ctr_client)
+    try:
+        yield reaper
+    finally:
+        reaper.close()
+
+
+@pytest.fixture(scope="session")
+def ctr_checkpoints(
+    pytestconfig: pytest.Config,
+    ctr_client: CtrClient,
+    tmp_path_factory: pytest.TempPathFactory,
+) -> Optional[_CheckpointCache]:
+    """Checkpoints of booted containers, if '--checkpoint-boot' is given."""
+    if not pytestconfig.getoption("--checkpoint-boot"):
+        return None
+    return _CheckpointCache(ctr_client, tmp_path_factory.mktemp("checkpoints"))
+
+
+@pytest.fixture(scope="package")
+def ctr_pool(
+    ctr_reaper: containers.CtrReaper, distro: utils.Distro, setup_mode: Optional[str]
+) -> Generator[_CtrPool, None, None]:
+    """
+    Pool of containers shared between read-only tests.
+
+    The pool depends on the package-scoped 'distro' and 'setup_mode'
+    parameters, such that a new pool is used for each of their combinations,
+    with containers torn down once all tests for the combination have run
+    (before the container reaper is closed).
+    """
+    with contextlib.ExitStack() as exit_stack:
+        yield _CtrPool(exit_stack)
+
+
+@pytest.fixture
+def record_benchmark(
+    request: pytest.FixtureRequest,
+    ctr_mgr: CtrMgr,
+    distro: utils.Distro,
+    setup_mode: Optional[str],
+    cgroupns: str,
+    cgroup_mode: str,
+) -> Callable[[str, Mapping[str, Any]], None]:
+    """
+    Fixture providing a function to record benchmark results.
+
+    Results are logged, added to the test's user properties under 'benchmark'
+    and written to the file given by '--benchmark-output' (if any).
+    """
+
+    def record(name: str, results: Mapping[str, Any]) -> None:
+        record = {
+            "benchmark": name,
+            "test": request.node.nodeid,
+            "ctr_mgr": str(ctr_mgr),
+            "distro": str(distro),
+            "setup_mode": setup_mode or "default",
+            "cgroupns": cgroupns,
+            "cgroup_mode": cgroup_mode,
+            **results,
+        }
+        logger.info("Benchmark results:\n%s", json.dumps(record, indent=2))
+        request.node.user_properties.append(("benchmark", record))
+        if path := request.config.getoption("--benchmark-output"):
+            utils.append_json_line(path, record)
+
+    return record
+
+
 @pytest.fixture
 def ctr_ctx(
     request: pytest.FixtureRequest,
     ctr_client: CtrClient,
+    ctr_reaper: containers.CtrReaper,
+    ctr_pool: _CtrPool,
+    ctr_checkpoints: Optional[_CheckpointCache],
     pkg_image: CtrImage,
+    distro: utils.Distro,
     setup_mode: Optional[str],
     cgroupns: str,
     cgroup_mode: str,
@@ -390,11 +986,66 @@ def ctr_ctx(
 
     This is expected to be used by all tests, and automatically parameterises
     on the following:
+     - distro
      - setup_mode
      - cgroupns
      - cgroup_mode
+
+    Tests marked with 'ctr_read_only' are given a booted container from a
+    pool, shared with other read-only tests using the same container args.
     """
 
+    def _record_resource_samples(
+        ctr: Container, sampler: resources.CtrResourceSampler
+    ) -> None:
+        """
+        Record the resource usage samples for a container.
+
+        The record is added to the test's user properties under
+        'resource_samples', with the samples as a time series along with
+        summary statistics (see resources.CtrResourceSampler.summary()).
+        """
+        record = {
+            "test": request.node.nodeid,
+            "ctr_name": ctr.name,
+            "ctr_mgr": str(ctr_client.mgr),
+            "distro": str(distro),
+            "setup_mode": setup_mode or "default",
+            "cgroupns": cgroupns,
+            "cgroup_mode": cgroup_mode,
+            "source": sampler.source,
+            "interval": sampler.interval,
+            "summary": sampler.summary(),
+            "samples": [dataclasses.asdict(x) for x in sampler.samples],
+        }
+        logger.debug("Resource usage summary: %s", record["summary"])
+        request.node.user_properties.append(("resource_samples", record))
+
+    def _record_boot_timings(ctr: Container, **kwargs) -> console.BootTimings:
+        """
+        Record the boot timings for a container, see console.get_boot_timings().
+
+        The record is added to the test's user properties under 'boot_timings',
+        and written to the file given by '--boot-timings' (if any).
+        """
+        timings = console.get_boot_timings(ctr, **kwargs)
+        record = {
+            "test": request.node.nodeid,
+            "ctr_name": ctr.name,
+            "ctr_mgr": str(ctr_client.mgr),
+            "distro": str(distro),
+            "setup_mode": setup_mode or "default",
+            "cgroupns": cgroupns,
+            "cgroup_mode": cgroup_mode,
+            "run_start": kwargs["run_start"],
+            **dataclasses.asdict(timings),
+        }
+        logger.debug("Boot timings: %s", record)
+        request.node.user_properties.append(("boot_timings", record))
+        if path := request.config.getoption("--boot-timings"):
+            utils.append_json_line(path, record)
+        return timings
+
     @contextlib.contextmanager
     def ctr_ctx_mgr(
         image: Optional[CtrImage] = None,
@@ -402,6 +1053,10 @@ def ctr_ctx(
         systemd: Optional[bool] = None,
         log_boot_output: bool = False,
         wait: bool = True,
+        exec_agent: Optional[bool] = None,
+        record_boot_timings: Optional[bool] = None,
+        sample_resources: Optional[float] = None,
+        reap: bool = True,
         **kwargs,
     ) -> Generator[Container, None, None]:
         """
@@ -420,51 +1075,46 @@ def ctr_ctx(
             Whether to always log boot output (if waiting on boot completion).
         :param wait:
             Whether to wait for boot to complete successfully.
+        :param exec_agent:
+            Whether to run commands in the container via a long-lived exec
+            agent process (see exec_agent.ExecAgent), in which case the yielded
+            object is an ExecAgent in place of the Container. Defaults to the
+            value of the '--exec-agent' CLI option.
+        :param record_boot_timings:
+            Whether to record the boot timings (if waiting on boot completion),
+            added to the test's user properties under 'boot_timings' and set as
+            the yielded container's 'boot_timings' attribute. Defaults to
+            whether the '--boot-timings' CLI option is given.
+        :param sample_resources:
+            The interval in seconds at which to sample the container's resource
+            usage from when it's run, added to the test's user properties under
+            'resource_samples', or 0 to not sample. Defaults to the value of
+            the '--sample-resources' CLI option.
+        :param reap:
+            Whether to remove the container in the background on exit (see
+            containers.CtrReaper), otherwise it's removed before the context manager
+            exits, e.g. for timing the removal.
         :param args:
             Positional arguments passed through to Container.run().
         :param kwargs:
             Keyword arguments passed through to Container.run().
         :yield:
-            The Container object.
+            The Container object, with its logs read from the console output
+            captured since it started (see console.CtrLogCapture).
         :raise CtrInitError:
             If systemd in the container fails to start.
         """
         # Determine args to use for the container.
         if image is None:
             image = pkg_image
-        if systemd is None and ctr_client.mgr is CtrMgr.PODMAN:
-            # Disable podman's systemd mode by default for consistency when
-            # comparing with docker.
-            systemd = False
-        elif systemd is False and ctr_client.mgr is CtrMgr.DOCKER:
-            # Docker doesn't have systemd mode, so no need to pass the arg for
-            # it to be 'False'.
-            systemd = None
-        elif systemd is not None:
-            if ctr_client.mgr is CtrMgr.DOCKER:
-                # Skip at a per-testcase level, for explicitness.
-                pytest.fail("Systemd mode not supported by Docker")
-            kwargs["systemd"] = systemd
-        if cgroup_mode == "legacy":
-            # Force systemd to run in legacy cgroup v1 mode.
-            assert request.config.option.cgroup_version == 1
-            kwargs.setdefault("envs", {})[
-                "SYSTEMD_PROC_CMDLINE"
-            ] = "systemd.legacy_systemd_cgroup_controller=1"
-        kwargs.setdefault("tty", True)
-        kwargs.setdefault("interactive", True)  # not needed, helps debugging
-        if not kwargs.setdefault("detach", True):
-            raise TypeError("Running container attached is not supported")
-        if kwargs.setdefault("remove", False):
-            raise TypeError(
-                "Removing container on exit breaks logging so is not supported"
-            )
-        if kwargs.setdefault("cgroupns", cgroupns) != cgroupns:
-            raise TypeError(
-                "Cgroup namespace mode is parameterised, skip unwanted tests "
-                "rather than overriding"
-            )
-        kwargs.setdefault("name", f"systemd-tests-{time.time():.2f}")
+        kwargs = _get_ctr_run_kwargs(
+            ctr_client.mgr,
+            request.config.option.cgroup_version,
+            cgroupns,
+            cgroup_mode,
+            systemd=systemd,
+            **kwargs,
+        )
         # Log container info.
         image_repr = image.repo_tags[0] if image.repo_tags else image.id[:8]
         all_args_repr = (
@@ -476,32 +1126,109 @@ def ctr_ctx(
             image_repr,
             ", ".join(all_args_repr),
         )
+        if record_boot_timings is None:
+            record_boot_timings = bool(request.config.getoption("--boot-timings"))
+        # Restore from a checkpoint of the same configuration if possible, when
+        # the boot itself isn't being inspected.
+        checkpoint_key = None
+        checkpoint = None
+        # Only containers run with arguments supported for restoring are
+        # checkpointed, keyed on the command and the run arguments (as CLI
+        # arguments) other than the container name.
+        if (
+            ctr_checkpoints
+            and wait
+            and not (log_boot_output or record_boot_timings)
+            and len(args) <= 1
+            and containers.CTR_RUN_ARGS.issuperset(kwargs)
+        ):
+            run_kwargs = {k: v for k, v in kwargs.items() if k != "name"}
+            checkpoint_key = (
+                setup_mode,
+                cgroupns,
+                cgroup_mode,
+                image.id,
+                tuple(args[0]) if args else (),
+                tuple(sorted(containers.ctr_run_cli_args(run_kwargs))),
+            )
+            checkpoint = ctr_checkpoints.get(checkpoint_key)
         # Run the container, cleaning it up at the end.
-        ctr = ctr_client.run(image or systemd_image, *args, **kwargs)
+        run_start = time.time()
+        ctr = None
+        if checkpoint:
+            try:
+                ctr = checkpoint.restore(kwargs["name"])
+            except CtrException as e:
+                logger.warning("Failed to restore from checkpoint, booting: %s", e)
+                checkpoint = None
+        if ctr is None:
+            ctr = ctr_client.run_container(image, *args, **kwargs)
+        run_returned = time.time()
+        log_capture = None
+        sampler = None
         try:
+            # Capture the console output as it's output, such that all
+            # consumers of the logs read from the captured output.
+            spill_path = None
+            if console_log_dir := request.config.getoption("--console-log-dir"):
+                console_log_dir.mkdir(parents=True, exist_ok=True)
+                spill_path = console_log_dir / f"{ctr.name}.log"
+            log_capture = console.CtrLogCapture(
+                ctr_client,
+                ctr,
+                max_bytes=request.config.getoption("--console-buffer-size"),
+                spill_path=spill_path,
+            )
+            ctr = console.CapturedLogsContainer(ctr, log_capture)
+            if sample_resources is None:
+                sample_resources = request.config.getoption("--sample-resources")
+            if sample_resources:
+                sampler = resources.CtrResourceSampler(
+                    ctr_client,
+                    ctr,
+                    sample_resources,
+                    cgroup_mounts=request.config.option.host_probe.cgroup_mounts,
+                )
             # Wait for systemd to start up inside the container.
             if wait:
                 error_occurred = False
                 try:
-                    try_until = time.time() + 5
-                    while True:
-                        try:
-                            ctr.execute(["systemctl", "is-system-running", "--wait"])
-                        except CtrException as e:
-                            if (
-                                e.stdout.strip() == "offline"
-                                or "Failed to connect to bus" in e.stderr
-                            ) and time.time() < try_until:
-                                # Systemd not yet started, may still be in a
-                                # pre-systemd init script, so retry.
-                                time.sleep(0.1)
-                                continue
-                            error_occurred = True
-                            raise CtrInitError(
-                                f"Systemd container failed to start: {e.stdout.strip()}"
-                            ) from e
-                        else:
-                            break
+                    # Wait for systemd to report reaching the default target
+                    # on the console, which avoids repeatedly exec'ing into the
+                    # container while it may still be in a pre-systemd init
+                    # script. Then check the final state of the system.
+                    boot_timeout = request.config.getoption("--boot-timeout")
+                    try:
+                        if not checkpoint:
+                            log_capture.wait_for_line(
+                                console.BOOT_TARGET_REACHED_REGEX, boot_timeout
+                            )
+                    except TimeoutError as e:
+                        error_occurred = True
+                        raise CtrInitError(
+                            f"Systemd container failed to boot within {boot_timeout} "
+                            "seconds"
+                        ) from e
+                    except CtrInitError:
+                        error_occurred = True
+                        raise
+                    try:
+                        ctr.execute(["systemctl", "is-system-running", "--wait"])
+                    except CtrException as e:
+                        error_occurred = True
+                        raise CtrInitError(
+                            f"Systemd container failed to start: {e.stdout.strip()}"
+                        ) from e
+                    system_running = time.time()
+                    if checkpoint_key and not checkpoint:
+                        ctr_checkpoints.create(checkpoint_key, ctr, image, args, kwargs)
+                    if record_boot_timings:
+                        ctr.boot_timings = _record_boot_timings(
+                            ctr,
+                            run_start=run_start,
+                            run_returned=run_returned,
+                            system_running=system_running,
+                        )
                 finally:
                     if error_occurred:
                         logger.error("Container boot logs:\n%s", ctr.logs())
@@ -513,14 +1240,107 @@ def ctr_ctx(
                                 )
                             logger.debug("Init script logs:\n%s", init_script_logs)
                         logger.debug("Container boot logs:\n%s", ctr.logs())
-            yield ctr
+            if exec_agent is None:
+                exec_agent = request.config.getoption("--exec-agent")
+            if exec_agent:
+                agent = ExecAgent(ctr_client, ctr)
+                try:
+                    yield agent
+                finally:
+                    agent.close()
+            else:
+                yield ctr
         finally:
-            ctr.reload()
-            if not ctr.state.running:
-                logger.error(
-                    "Container exited unexpectedly, console output:\n%s", ctr.logs()
-                )
-            with contextlib.suppress(CtrException):
-                ctr.remove(force=True)
+            try:
+                if sampler:
+                    sampler.close()
+                    _record_resource_samples(ctr, sampler)
+                ctr.reload()
+                if not ctr.state.running:
+                    if log_capture:
+                        log_capture.wait_for_end(timeout=5)
+                    logger.error(
+                        "Container exited unexpectedly, console output:\n%s",
+                        ctr.logs(),
+                    )
+                # Removal (including container shutdown) is done in the
+                # background by default, to avoid slowing down the tests.
+                if reap:
+                    ctr_reaper.remove(ctr)
+                else:
+                    ctr.remove(force=True)
+            finally:
+                if log_capture:
+                    log_capture.close()
+
+    @contextlib.contextmanager
+    def pooled_ctr_ctx_mgr(*args, **kwargs) -> Generator[Container, None, None]:
+        """
+        A context manager for getting a booted systemd container from the pool.
+
+        Accepts the same arguments as ctr_ctx_mgr(), but the container is not
+        removed on exit.
+        """
+        if not kwargs.get("wait", True):
+            raise TypeError("Pooled containers must wait for boot to complete")
+        key = (
+            distro,
+            setup_mode,
+            pkg_image.id,
+            cgroupns,
+            cgroup_mode,
+            repr(args),
+            repr(sorted(kwargs.items())),
+        )
+        # Resource usage of pooled containers can't be attributed to a test.
+        yield ctr_pool.get(
+            key, lambda: ctr_ctx_mgr(*args, sample_resources=0, **kwargs)
+        )
+
+    if request.node.get_closest_marker("ctr_read_only"):
+        return pooled_ctr_ctx_mgr
+    else:
+        return ctr_ctx_mgr
+
+
+@pytest.fixture
+def async_ctr_ctx(
+    request: pytest.FixtureRequest,
+    ctr_client: CtrClient,
+    pkg_image: CtrImage,
+    cgroupns: str,
+    cgroup_mode: str,
+) -> AsyncCtrCtxType:
+    """
+    Fixture providing an async context manager for starting a systemd container.
+
+    This is the asyncio equivalent of the ctr_ctx fixture (see aio.ctr_ctx()),
+    applying the same defaults for the container arguments, allowing many
+    containers to be booted concurrently from a single thread.
+    """
+
+    def async_ctr_ctx_mgr(
+        image: Optional[CtrImage] = None,
+        *args,
+        systemd: Optional[bool] = None,
+        wait: bool = True,
+        **kwargs,
+    ) -> AsyncContextManager[aio.AsyncContainer]:
+        kwargs = _get_ctr_run_kwargs(
+            ctr_client.mgr,
+            request.config.option.cgroup_version,
+            cgroupns,
+            cgroup_mode,
+            systemd=systemd,
+            **kwargs,
+        )
+        return aio.ctr_ctx(
+            ctr_client,
+            image or pkg_image,
+            *args,
+            wait=wait,
+            boot_timeout=request.config.getoption("--boot-timeout"),
+            **kwargs,
+        )
 
-    return ctr_ctx_mgr
+    return async_ctr_ctx_mgr
@@ -0,0 +1,480 @@
+"""
+Capture and analysis of systemd containers' console output.
+
+Each container's output is streamed once into a bounded buffer, from which
+boot progress is detected and the boot output classified into sections and
+timed.
+"""
+
+from __future__ import annotations
+
+__all__ = (
+    "BOOT_TARGET_REACHED_REGEX",
+    "BootTimings",
+    "CapturedLogsContainer",
+    "CtrLogCapture",
+    "LogClassifier",
+    "LogSectionRule",
+    "get_boot_timings",
+)
+
+import codecs
+import dataclasses
+import datetime
+import itertools
+import logging
+import re
+import subprocess
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from typing import Iterable, Optional
+
+from python_on_whales import Container
+
+from .engine_api import ApiContainer
+from .exec_agent import execute_batch
+from .utils import CtrClient, CtrInitError, strip_ansi_codes
+
+logger = logging.getLogger(__name__)
+
+
+# Systemd console output when boot reaches the default target.
+BOOT_TARGET_REACHED_REGEX = re.compile(
+    r"Reached target .*(?:Multi-User System|Graphical Interface)"
+)
+
+
+# The timestamp at the start of each line of timestamped container output.
+_LOG_TIMESTAMP_PREFIX_REGEX = re.compile(r"^\d{4}-\d\d-\d\dT\S+ ", re.MULTILINE)
+
+
+class CtrLogCapture:
+    """
+    Capture of a container's console output, streamed as it is output.
+
+    A single 'logs --follow' process is run for the container (or a single API
+    request for containers accessed via the engine API), with its output read
+    by a background thread into a bounded in-memory buffer. Lines evicted
+    from the buffer are appended to a spill file if one is given, otherwise
+    they are discarded.
+
+    The output is captured with timestamps, which are stripped from the output
+    returned by logs() unless requested.
+    """
+
+    def __init__(
+        self,
+        ctr_client: CtrClient,
+        ctr: Container,
+        *,
+        max_bytes: int = 1024 * 1024,
+        spill_path: Optional[Path] = None,
+    ):
+        """
+        :param ctr_client:
+            The container client.
+        :param ctr:
+            The container to capture the output of.
+        :param max_bytes:
+            The maximum size of output to keep in memory, in bytes (of the
+            output encoded as UTF-8).
+        :param spill_path:
+            Optional file to write output evicted from the in-memory buffer to.
+        """
+        self.ctr = ctr
+        self.max_bytes = max_bytes
+        self.spill_path = spill_path
+        self._spill_file = None
+        if spill_path:
+            self._spill_file = open(spill_path, "w", encoding="utf-8")
+        self._cond = threading.Condition()
+        self._lines: deque[str] = deque()
+        # The size of the buffered lines in bytes, when encoded as UTF-8.
+        self._size = 0
+        # The total number of lines evicted from the buffer, such that each
+        # line has a stable index.
+        self._evicted = 0
+        self._partial = ""
+        self._ended = False
+        self._proc: Optional[subprocess.Popen] = None
+        if isinstance(ctr, ApiContainer):
+            self._stream = ctr.open_log_stream(timestamps=True)
+        else:
+            self._proc = subprocess.Popen(
+                [ctr_client.exe, "logs", "--follow", "--timestamps", ctr.id],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+            )
+            self._stream = self._proc.stdout
+        self._thread = threading.Thread(target=self._read_output, daemon=True)
+        self._thread.start()
+
+    def _read_output(self) -> None:
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        while True:
+            try:
+                chunk = self._stream.read1(65536)
+            except (OSError, ValueError):
+                # The stream was closed.
+                chunk = b""
+            text = decoder.decode(chunk, final=not chunk).replace("\r\n", "\n")
+            with self._cond:
+                *lines, self._partial = (self._partial + text).split("\n")
+                for line in lines:
+                    self._append_line(line + "\n")
+                if not chunk:
+                    if self._partial:
+                        self._append_line(self._partial)
+                        self._partial = ""
+                    self._ended = True
+                self._cond.notify_all()
+            if not chunk:
+                break
+
+    def _append_line(self, line: str) -> None:
+        self._lines.append(line)
+        self._size += len(line.encode("utf-8"))
+        while self._size > self.max_bytes and len(self._lines) > 1:
+            evicted = self._lines.popleft()
+            self._size -= len(evicted.encode("utf-8"))
+            self._evicted += 1
+            if self._spill_file:
+                self._spill_file.write(evicted)
+
+    @property
+    def ended(self) -> bool:
+        """Whether the container's output has ended, i.e. it has stopped."""
+        return self._ended
+
+    def logs(self, *, timestamps: bool = False) -> str:
+        """
+        Get the captured output, as per Container.logs().
+
+        :param timestamps:
+            Whether to include the timestamp at the start of each line.
+        :return:
+            The output captured so far, including output spilled to disk.
+        """
+        with self._cond:
+            text = "".join(self._lines) + self._partial
+            if self._spill_file:
+                self._spill_file.flush()
+                text = self.spill_path.read_text(encoding="utf-8") + text
+        if timestamps:
+            return text
+        return _LOG_TIMESTAMP_PREFIX_REGEX.sub("", text)
+
+    def wait_for_line(
+        self, pattern: str | re.Pattern[str], timeout: float
+    ) -> str:
+        """
+        Wait for a line matching a pattern to be output.
+
+        Lines already captured are checked first, with any that have been
+        evicted from the in-memory buffer not being checked.
+
+        :param pattern:
+            The regex pattern to search for in each line (with the timestamp
+            and ANSI escape codes removed).
+        :param timeout:
+            The timeout in seconds.
+        :return:
+            The matching line.
+        :raise TimeoutError:
+            If no matching line is output within the timeout.
+        :raise CtrInitError:
+            If the container's output ends (i.e. it exits) without a match.
+        """
+        regex = re.compile(pattern)
+        logger.debug(
+            "Waiting up to %s seconds for log line %r", timeout, regex.pattern
+        )
+        end_time = time.monotonic() + timeout
+        next_idx = 0
+        with self._cond:
+            while True:
+                next_idx = max(next_idx, self._evicted)
+                for line in itertools.islice(
+                    self._lines, next_idx - self._evicted, None
+                ):
+                    line = _LOG_TIMESTAMP_PREFIX_REGEX.sub("", line)
+                    line = strip_ansi_codes(line).rstrip("\n")
+                    if regex.search(line):
+                        logger.debug("Found log line: %s", line)
+                        return line
+                next_idx = self._evicted + len(self._lines)
+                if self._ended:
+                    raise CtrInitError(
+                        f"Container output ended without log line {regex.pattern!r}"
+                    )
+                remaining = end_time - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(
+                        f"Timed out after {timeout} seconds waiting for log line "
+                        f"{regex.pattern!r}"
+                    )
+                self._cond.wait(remaining)
+
+    def wait_for_end(self, timeout: float) -> bool:
+        """
+        Wait for the container's output to end.
+
+        :param timeout:
+            The timeout in seconds.
+        :return:
+            Whether the output ended within the timeout.
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: self._ended, timeout)
+
+    def close(self) -> None:
+        """Stop capturing output."""
+        if self._proc:
+            if self._proc.poll() is None:
+                self._proc.kill()
+            self._proc.wait()
+        else:
+            self._stream.shutdown()
+        self._thread.join()
+        self._stream.close()
+        if self._spill_file:
+            self._spill_file.close()
+
+
+class CapturedLogsContainer:
+    """
+    Wrapper for a container whose logs are read from a CtrLogCapture.
+
+    Other attributes are delegated to the underlying container, such that this
+    can be used in place of a Container.
+    """
+
+    def __init__(self, ctr: Container, log_capture: CtrLogCapture):
+        self.ctr = ctr
+        self.log_capture = log_capture
+        # The container's boot timings, if recorded (see get_boot_timings()).
+        self.boot_timings: Optional[BootTimings] = None
+
+    def __getattr__(self, name: str):
+        return getattr(self.ctr, name)
+
+    def logs(self, *, timestamps: bool = False, **kwargs) -> str:
+        """
+        Get the container's output, as per Container.logs().
+
+        The captured output is used unless arguments other than 'timestamps'
+        are passed.
+        """
+        if kwargs:
+            return self.ctr.logs(timestamps=timestamps, **kwargs)
+        return self.log_capture.logs(timestamps=timestamps)
+
+
+@dataclasses.dataclass(frozen=True)
+class LogSectionRule:
+    """
+    Rule for a section of log output, for use with LogClassifier.
+
+    :param name:
+        The name of the section.
+    :param allowed:
+        Regex patterns for lines allowed in the section, matched against the
+        full line (with ANSI escape codes removed).
+    :param end:
+        Regex pattern for the line marking the start of the next section
+        (matched against the full line), or None for the final section. The
+        marker line itself is always allowed.
+    """
+
+    name: str
+    allowed: tuple[str, ...]
+    end: Optional[str] = None
+
+
+class LogClassifier:
+    """
+    Classify log lines as expected or unexpected, according to section rules.
+
+    Each section's rules are compiled once into a single regex, so each line is
+    classified with a single match. Lines can be fed in as they arrive.
+    """
+
+    _END_GROUP = "_section_end"
+
+    def __init__(self, rules: Iterable[LogSectionRule]):
+        """
+        :param rules:
+            The rules for each section, in the order the sections are expected
+            in the logs.
+        """
+        self.rules = tuple(rules)
+        if not self.rules:
+            raise ValueError("At least one log section rule is required")
+        self._regexes = [self._compile_rule(r) for r in self.rules]
+        self._section_idx = 0
+        self.reached_sections: list[str] = [self.rules[0].name]
+        self.unexpected_lines: list[str] = []
+
+    @classmethod
+    def _compile_rule(cls, rule: LogSectionRule) -> Optional[re.Pattern[str]]:
+        alternatives = [f"(?:{p})" for p in rule.allowed]
+        if rule.end is not None:
+            # The end marker goes first so that it takes precedence.
+            alternatives.insert(0, f"(?P<{cls._END_GROUP}>{rule.end})")
+        return re.compile("|".join(alternatives)) if alternatives else None
+
+    @property
+    def section(self) -> str:
+        """The name of the current section."""
+        return self.rules[self._section_idx].name
+
+    def feed(self, line: str) -> bool:
+        """
+        Classify a log line, advancing to the next section if appropriate.
+
+        :param line:
+            The log line, which may contain ANSI escape codes.
+        :return:
+            Whether the line was expected. Blank lines are always expected.
+        """
+        stripped_line = strip_ansi_codes(line).rstrip("\r\n")
+        if not stripped_line.strip():
+            return True
+        regex = self._regexes[self._section_idx]
+        match = regex.fullmatch(stripped_line) if regex else None
+        if match is None:
+            self.unexpected_lines.append(line.rstrip("\r\n"))
+            return False
+        if self.rules[self._section_idx].end is not None:
+            if match.start(self._END_GROUP) != -1:
+                self._section_idx += 1
+                self.reached_sections.append(self.section)
+        return True
+
+    def feed_all(self, lines: Iterable[str]) -> list[str]:
+        """
+        Classify multiple log lines.
+
+        :param lines:
+            The log lines.
+        :return:
+            The unexpected lines seen so far.
+        """
+        for line in lines:
+            self.feed(line)
+        return self.unexpected_lines
+
+
+@dataclasses.dataclass
+class BootTimings:
+    """
+    Timings of the boot phases of a systemd container.
+
+    Times are in seconds relative to when the container run command was issued.
+    """
+
+    run_returned: float
+    init_script_start: Optional[float] = None
+    init_script_end: Optional[float] = None
+    systemd_start: Optional[float] = None
+    first_unit_ok: Optional[float] = None
+    last_unit_ok: Optional[float] = None
+    units_ok: int = 0
+    target_reached: Optional[float] = None
+    system_running: Optional[float] = None
+    systemd_analyze: Optional[str] = None
+
+
+def _parse_log_timestamp(timestamp: str) -> float:
+    """Parse an RFC 3339 timestamp as output by 'docker/podman logs -t'."""
+    match = re.fullmatch(
+        r"([\d-]+T[\d:]+)(?:\.(\d+))?(Z|[+-][\d:]+)", timestamp.strip()
+    )
+    if not match:
+        raise ValueError(f"Unrecognised timestamp {timestamp!r}")
+    date_time, fraction, tz = match.groups()
+    # Truncate fractional seconds to microseconds, which is all that datetime
+    # supports.
+    fraction = (fraction or "0")[:6].ljust(6, "0")
+    tz = "+00:00" if tz == "Z" else tz
+    return datetime.datetime.fromisoformat(f"{date_time}.{fraction}{tz}").timestamp()
+
+
+def _parse_init_script_timestamp(line: str) -> Optional[float]:
+    """Parse the timestamp from an init script log line, assuming UTC."""
+    match = re.match(r"(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d+): ", line)
+    if not match:
+        return None
+    return (
+        datetime.datetime.strptime(match.group(1), "%Y-%m-%d %H:%M:%S,%f")
+        .replace(tzinfo=datetime.timezone.utc)
+        .timestamp()
+    )
+
+
+def get_boot_timings(
+    ctr: Container,
+    *,
+    run_start: float,
+    run_returned: float,
+    system_running: float,
+) -> BootTimings:
+    """
+    Get the timings of the boot phases of a booted systemd container.
+
+    The timings are determined from the container's timestamped console
+    output, the init script log (if there is one) and 'systemd-analyze'.
+
+    :param ctr:
+        The booted container.
+    :param run_start:
+        The time the container run command was issued.
+    :param run_returned:
+        The time the container run command returned.
+    :param system_running:
+        The time systemd was found to have finished starting up.
+    :return:
+        The boot timings.
+    """
+    timings = BootTimings(
+        run_returned=run_returned - run_start,
+        system_running=system_running - run_start,
+    )
+    for line in ctr.logs(timestamps=True).splitlines():
+        timestamp, _, line = line.partition(" ")
+        line = strip_ansi_codes(line).strip()
+        try:
+            time_offset = _parse_log_timestamp(timestamp) - run_start
+        except ValueError:
+            continue
+        if timings.systemd_start is None:
+            if re.match(r"systemd \d+(?:\.\S+)? running in system mode", line):
+                timings.systemd_start = time_offset
+        elif timings.target_reached is None and line.startswith("[  OK  ] "):
+            if timings.first_unit_ok is None:
+                timings.first_unit_ok = time_offset
+            timings.last_unit_ok = time_offset
+            timings.units_ok += 1
+            if BOOT_TARGET_REACHED_REGEX.search(line):
+                timings.target_reached = time_offset
+
+    init_script_result, analyze_result = execute_batch(
+        ctr, [["cat", "/var/log/init_script.log"], ["systemd-analyze"]]
+    )
+    if init_script_result.returncode == 0:
+        init_script_times = [
+            t
+            for t in map(
+                _parse_init_script_timestamp, init_script_result.stdout.splitlines()
+            )
+            if t is not None
+        ]
+        if init_script_times:
+            timings.init_script_start = init_script_times[0] - run_start
+            timings.init_script_end = init_script_times[-1] - run_start
+    if analyze_result.returncode == 0:
+        timings.systemd_analyze = analyze_result.stdout.strip()
+
+    return timings
@@ -0,0 +1,316 @@
+"""
+Container lifecycle helpers: background removal and boot checkpoints.
+"""
+
+from __future__ import annotations
+
+__all__ = (
+    "CTR_RUN_ARGS",
+    "CtrCheckpoint",
+    "CtrReaper",
+    "ctr_run_cli_args",
+)
+
+import contextlib
+import logging
+import queue
+import threading
+import time
+from pathlib import Path
+from typing import Any, Mapping, Optional
+
+from python_on_whales import Container
+from python_on_whales import DockerException as CtrException
+from python_on_whales import Image as CtrImage
+
+from .utils import CtrClient, CtrMgr, run_ctr_cli
+
+logger = logging.getLogger(__name__)
+
+
+class CtrReaper:
+    """
+    Background remover of containers, removing them in batches.
+
+    Containers passed to remove() are queued and force-removed by a background
+    thread, with containers queued together being removed using a single
+    command. This keeps container shutdown (which can be slow for systemd
+    containers) out of the time taken by each test.
+    """
+
+    def __init__(
+        self, ctr_client: CtrClient, *, batch_size: int = 20, linger: float = 0.2
+    ):
+        """
+        :param ctr_client:
+            The container client.
+        :param batch_size:
+            The maximum number of containers to remove with a single command.
+        :param linger:
+            Time in seconds to wait for more containers to be queued before
+            removing a batch.
+        """
+        self.ctr_client = ctr_client
+        self.batch_size = batch_size
+        self.linger = linger
+        self.removed_count = 0
+        self.failed_ids: list[str] = []
+        self._queue: queue.SimpleQueue[Optional[str]] = queue.SimpleQueue()
+        # The number of queued containers not yet processed, see flush().
+        self._pending = 0
+        self._pending_cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def remove(self, ctr: Container) -> None:
+        """Queue a container for removal."""
+        with self._pending_cond:
+            self._pending += 1
+        self._queue.put(ctr.id)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait for the containers queued so far to be removed.
+
+        Containers that fail to be removed are recorded in 'failed_ids'.
+
+        :param timeout:
+            Optional timeout in seconds.
+        :return:
+            Whether all queued containers were processed within the timeout.
+        """
+        with self._pending_cond:
+            return self._pending_cond.wait_for(lambda: self._pending == 0, timeout)
+
+    def _get_batch(self) -> tuple[list[str], bool]:
+        """Get the next batch of IDs, and whether the reaper has been closed."""
+        batch = [self._queue.get()]
+        end_time = time.monotonic() + self.linger
+        while batch[-1] is not None and len(batch) < self.batch_size:
+            remaining = end_time - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        closed = batch[-1] is None
+        return [x for x in batch if x is not None], closed
+
+    def _run(self) -> None:
+        closed = False
+        while not closed:
+            ids, closed = self._get_batch()
+            if not ids:
+                continue
+            logger.debug("Removing %d containers", len(ids))
+            try:
+                self.ctr_client.container.remove(ids, force=True)
+            except CtrException as e:
+                # The command fails if any container fails to be removed, so
+                # retry them individually to find which failed.
+                logger.debug("Failed to remove batch of containers: %s", e)
+                for ctr_id in ids:
+                    self._remove_one(ctr_id)
+            else:
+                self.removed_count += len(ids)
+            with self._pending_cond:
+                self._pending -= len(ids)
+                self._pending_cond.notify_all()
+
+    def _remove_one(self, ctr_id: str) -> None:
+        """Remove a single container, recording whether it was removed."""
+        try:
+            self.ctr_client.container.remove(ctr_id, force=True)
+        except CtrException as e:
+            # The container may have already been removed, e.g. by the batch.
+            with contextlib.suppress(CtrException):
+                if not self.ctr_client.container.exists(ctr_id):
+                    self.removed_count += 1
+                    return
+            logger.warning("Failed to remove container %s: %s", ctr_id, e)
+            self.failed_ids.append(ctr_id)
+        else:
+            self.removed_count += 1
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """
+        Wait for all queued containers to be removed.
+
+        :param timeout:
+            Optional timeout in seconds.
+        """
+        self._queue.put(None)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.warning("Timed out waiting for containers to be removed")
+        logger.debug(
+            "Removed %d containers in the background (%d failures)",
+            self.removed_count,
+            len(self.failed_ids),
+        )
+
+
+# The container run arguments supported by ctr_run_cli_args(), by how they're
+# converted to CLI arguments.
+_CTR_RUN_FLAG_ARGS = ("detach", "interactive", "privileged", "remove", "tty")
+_CTR_RUN_VALUE_ARGS = ("cgroupns", "entrypoint", "name", "systemd")
+_CTR_RUN_LIST_ARGS = ("cap_add", "envs", "tmpfs", "volumes")
+CTR_RUN_ARGS = frozenset(
+    (*_CTR_RUN_FLAG_ARGS, *_CTR_RUN_VALUE_ARGS, *_CTR_RUN_LIST_ARGS)
+)
+
+
+def ctr_run_cli_args(kwargs: Mapping[str, Any]) -> list[str]:
+    """
+    Convert python-on-whales style container run arguments to CLI arguments.
+
+    Only the arguments used by the tests are supported, see CTR_RUN_ARGS.
+
+    :param kwargs:
+        The keyword arguments, as accepted by python-on-whales' run().
+    :return:
+        The CLI arguments.
+    :raise TypeError:
+        If an unsupported argument is given.
+    """
+    args = []
+    for key, value in kwargs.items():
+        if key in _CTR_RUN_FLAG_ARGS:
+            flag = {"remove": "--rm"}.get(key, f"--{key}")
+            if value:
+                args.append(flag)
+        elif key in _CTR_RUN_VALUE_ARGS:
+            if isinstance(value, bool):
+                value = str(value).lower()
+            if value is not None:
+                args.append(f"--{key}={value}")
+        elif key == "cap_add":
+            args.extend(f"--cap-add={x}" for x in value)
+        elif key == "envs":
+            args.extend(f"--env={k}={v}" for k, v in value.items())
+        elif key == "tmpfs":
+            args.extend(f"--tmpfs={x}" for x in value)
+        elif key == "volumes":
+            args.extend("--volume=" + ":".join(str(x) for x in vol) for vol in value)
+        else:
+            raise TypeError(f"Unsupported container run argument {key!r}")
+    return args
+
+
+class CtrCheckpoint:
+    """
+    A checkpoint of a running container, taken using CRIU.
+
+    Any number of new containers can be restored from the checkpoint, each
+    resuming from the point the checkpoint was taken. With Podman the
+    checkpoint is exported to a file, from which new containers are imported.
+    With Docker (where checkpointing is experimental) the checkpoint is kept in
+    a directory, with new containers created using the original container's
+    arguments and started from the checkpoint.
+    """
+
+    _DOCKER_CHECKPOINT_NAME = "systemd-tests"
+
+    def __init__(
+        self,
+        ctr_client: CtrClient,
+        path: Path,
+        image: CtrImage,
+        args: tuple,
+        kwargs: Mapping[str, Any],
+    ):
+        self.ctr_client = ctr_client
+        self.path = path
+        self.image = image
+        self.args = args
+        self.kwargs = kwargs
+
+    @classmethod
+    def create(
+        cls,
+        ctr_client: CtrClient,
+        ctr: Container,
+        path: Path,
+        image: CtrImage,
+        args: tuple = (),
+        kwargs: Optional[Mapping[str, Any]] = None,
+    ) -> CtrCheckpoint:
+        """
+        Checkpoint a running container, leaving it running.
+
+        :param ctr_client:
+            The container client.
+        :param ctr:
+            The container to checkpoint.
+        :param path:
+            The path to store the checkpoint at, which must not exist.
+        :param image:
+            The image the container was run from.
+        :param args:
+            The positional arguments the container was run with.
+        :param kwargs:
+            The keyword arguments the container was run with, which must be
+            supported by ctr_run_cli_args() for restoring new containers.
+        :return:
+            The checkpoint.
+        :raise ValueError:
+            If the keyword arguments include unsupported arguments.
+        :raise CtrException:
+            If checkpointing fails, e.g. due to CRIU not being available.
+        :raise OSError:
+            If creating the checkpoint directory fails.
+        """
+        kwargs = kwargs or {}
+        if unsupported := set(kwargs) - CTR_RUN_ARGS:
+            raise ValueError(
+                "Unsupported container run arguments for checkpointing: "
+                + ", ".join(sorted(unsupported))
+            )
+        logger.info("Checkpointing container %s to %s", ctr.name, path)
+        if ctr_client.mgr is CtrMgr.PODMAN:
+            cmd = ["container", "checkpoint", "--leave-running", f"--export={path}"]
+            run_ctr_cli(ctr_client, [*cmd, ctr.id])
+        else:
+            path.mkdir(parents=True)
+            cmd = ["checkpoint", "create", "--leave-running"]
+            cmd += [f"--checkpoint-dir={path}", ctr.id, cls._DOCKER_CHECKPOINT_NAME]
+            run_ctr_cli(ctr_client, cmd)
+        return cls(ctr_client, path, image, args, kwargs)
+
+    def restore(self, name: str) -> Container:
+        """
+        Restore a new container from the checkpoint.
+
+        :param name:
+            The name for the new container.
+        :return:
+            The new running container.
+        :raise CtrException:
+            If restoring fails.
+        """
+        logger.info("Restoring container %s from checkpoint %s", name, self.path)
+        if self.ctr_client.mgr is CtrMgr.PODMAN:
+            cmd = ["container", "restore", f"--import={self.path}", f"--name={name}"]
+            ctr_id = run_ctr_cli(self.ctr_client, cmd).strip().splitlines()[-1]
+        else:
+            kwargs = {**self.kwargs, "name": name, "detach": False}
+            create_cmd = [
+                "create",
+                *ctr_run_cli_args(kwargs),
+                self.image.id,
+                *(self.args[0] if self.args else []),
+            ]
+            ctr_id = run_ctr_cli(self.ctr_client, create_cmd).strip().splitlines()[-1]
+            try:
+                start_cmd = [
+                    "start",
+                    f"--checkpoint={self._DOCKER_CHECKPOINT_NAME}",
+                    f"--checkpoint-dir={self.path}",
+                ]
+                run_ctr_cli(self.ctr_client, [*start_cmd, ctr_id])
+            except CtrException:
+                with contextlib.suppress(CtrException):
+                    self.ctr_client.container.remove(ctr_id, force=True)
+                raise
+        return self.ctr_client.container.inspect(ctr_id)
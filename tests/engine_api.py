@@ -0,0 +1,535 @@
+"""
+Client for the container engine's REST API, accessed over a UNIX socket.
+
+This uses the Docker-compatible API (also provided by Podman's API service),
+avoiding the overhead of starting a CLI process for each container operation.
+Only the container operations used by the tests are supported, with the
+containers providing the same interface as python-on-whales' Container.
+"""
+
+from __future__ import annotations
+
+__all__ = (
+    "ApiContainer",
+    "EngineApiClient",
+)
+
+import http.client
+import json
+import logging
+import queue
+import re
+import socket
+import struct
+import types
+import urllib.parse
+from typing import Any, Iterable, Mapping, Optional
+
+from python_on_whales import DockerException as CtrException
+
+logger = logging.getLogger(__name__)
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection over a UNIX socket."""
+
+    def __init__(self, socket_path: str, timeout: Optional[float] = None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self) -> None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+class _ApiStream:
+    """
+    A stream of output from the API, read from a dedicated socket.
+
+    Output from containers without a TTY is multiplexed, with each frame
+    prefixed by a header giving the stream (stdout or stderr) and its length.
+    This is demultiplexed when reading.
+    """
+
+    def __init__(
+        self,
+        sock: socket.socket,
+        resp: http.client.HTTPResponse,
+        *,
+        multiplexed: bool,
+    ):
+        self._sock = sock
+        self._resp = resp
+        self._multiplexed = multiplexed
+
+    def _read_exact(self, size: int) -> bytes:
+        data = b""
+        while len(data) < size:
+            chunk = self._resp.read(size - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def read_frame(self) -> tuple[int, bytes]:
+        """
+        Read the next frame of output.
+
+        :return:
+            A tuple of the stream number (1 for stdout, 2 for stderr) and the
+            output, which is empty at the end of the stream.
+        """
+        if not self._multiplexed:
+            return 1, self._resp.read1(65536)
+        header = self._read_exact(8)
+        if len(header) < 8:
+            return 1, b""
+        stream_num, size = struct.unpack(">BxxxL", header)
+        return stream_num, self._read_exact(size)
+
+    def read1(self, size: int = -1) -> bytes:
+        """
+        Read the next available output from stdout or stderr.
+
+        :return:
+            The output, which is empty at the end of the stream.
+        """
+        return self.read_frame()[1]
+
+    def read_all(self) -> tuple[bytes, bytes]:
+        """Read until the end of the stream, returning (stdout, stderr)."""
+        outputs = {1: b"", 2: b""}
+        while True:
+            stream_num, data = self.read_frame()
+            if not data:
+                return outputs[1], outputs[2]
+            outputs[2 if stream_num == 2 else 1] += data
+
+    def shutdown(self) -> None:
+        """
+        Shut down the stream, such that any blocked read returns.
+
+        Unlike close(), this is safe to call while reading in another thread.
+        """
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self) -> None:
+        """Close the stream."""
+        self.shutdown()
+        self._resp.close()
+        self._sock.close()
+
+
+def _to_snake_case(name: str) -> str:
+    return re.sub(r"(?<=[a-z0-9])([A-Z])", r"_\1", name).lower()
+
+
+class ApiContainer:
+    """
+    A container accessed via the engine API.
+
+    This provides the subset of python-on-whales' Container interface that's
+    used by the tests.
+    """
+
+    def __init__(
+        self,
+        api: EngineApiClient,
+        ctr_id: str,
+        attrs: Optional[Mapping[str, Any]] = None,
+    ):
+        self.api = api
+        self.id = ctr_id
+        self._attrs = attrs
+        if self._attrs is None:
+            self.reload()
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.id[:12]!r})"
+
+    def reload(self) -> None:
+        """Reload the container's attributes."""
+        self._attrs = self.api.request("GET", f"/containers/{self.id}/json")
+
+    @property
+    def name(self) -> str:
+        return self._attrs["Name"].lstrip("/")
+
+    @property
+    def state(self) -> types.SimpleNamespace:
+        """The container state, as of the last reload."""
+        return types.SimpleNamespace(
+            **{_to_snake_case(k): v for k, v in self._attrs["State"].items()}
+        )
+
+    @property
+    def tty(self) -> bool:
+        return bool(self._attrs["Config"].get("Tty"))
+
+    def execute(
+        self,
+        command: list[str],
+        detach: bool = False,
+        *,
+        envs: Optional[Mapping[str, str]] = None,
+        privileged: bool = False,
+        tty: bool = False,
+        user: Optional[str] = None,
+        workdir: Optional[str] = None,
+    ) -> Optional[str]:
+        """
+        Execute a command in the container, as per Container.execute().
+
+        :return:
+            The command's stdout with any trailing newline removed, or None if
+            detached.
+        :raise CtrException:
+            If the command returns a non-zero exit code.
+        """
+        body = {
+            "Cmd": list(command),
+            "AttachStdout": not detach,
+            "AttachStderr": not detach,
+            "Tty": tty,
+            "Privileged": privileged,
+            "Env": [f"{k}={v}" for k, v in (envs or {}).items()],
+        }
+        if user:
+            body["User"] = user
+        if workdir:
+            body["WorkingDir"] = str(workdir)
+        exec_info = self.api.request("POST", f"/containers/{self.id}/exec", body=body)
+        exec_id = exec_info["Id"]
+        start_body = {"Detach": detach, "Tty": tty}
+        if detach:
+            self.api.request("POST", f"/exec/{exec_id}/start", body=start_body)
+            return None
+        stream = self.api.stream(
+            "POST", f"/exec/{exec_id}/start", body=start_body, multiplexed=not tty
+        )
+        try:
+            stdout, stderr = stream.read_all()
+        finally:
+            stream.close()
+        exit_code = self.api.request("GET", f"/exec/{exec_id}/json")["ExitCode"]
+        if exit_code != 0:
+            raise CtrException(["exec", self.id, *command], exit_code, stdout, stderr)
+        return stdout.decode("utf-8", errors="replace").removesuffix("\n")
+
+    def logs(self, *, timestamps: bool = False) -> str:
+        """Get the container's output, as per Container.logs()."""
+        stream = self.open_log_stream(timestamps=timestamps, follow=False)
+        try:
+            output = b"".join(iter(stream.read1, b""))
+        finally:
+            stream.close()
+        return output.decode("utf-8", errors="replace")
+
+    def open_log_stream(
+        self, *, timestamps: bool = False, follow: bool = True
+    ) -> _ApiStream:
+        """
+        Open a stream of the container's output.
+
+        :param timestamps:
+            Whether to include the timestamp at the start of each line.
+        :param follow:
+            Whether to keep following output until the container stops.
+        :return:
+            A stream to read the output from, which must be closed.
+        """
+        params = {
+            "stdout": 1,
+            "stderr": 1,
+            "timestamps": int(timestamps),
+            "follow": int(follow),
+        }
+        return self.api.stream(
+            "GET",
+            f"/containers/{self.id}/logs",
+            params=params,
+            multiplexed=not self.tty,
+        )
+
+    def remove(self, force: bool = False, volumes: bool = False) -> None:
+        """Remove the container."""
+        self.api.request(
+            "DELETE",
+            f"/containers/{self.id}",
+            params={"force": int(force), "v": int(volumes)},
+        )
+
+
+class EngineApiClient:
+    """
+    Client for the container engine's API, using pooled HTTP connections.
+    """
+
+    # Arguments to container run that are supported.
+    _RUN_KWARGS = frozenset(
+        {
+            "cap_add",
+            "cgroupns",
+            "detach",
+            "entrypoint",
+            "envs",
+            "interactive",
+            "name",
+            "privileged",
+            "remove",
+            "tmpfs",
+            "tty",
+            "volumes",
+        }
+    )
+
+    def __init__(
+        self,
+        socket_path: str,
+        *,
+        api_version: str = "v1.41",
+        pool_size: int = 8,
+        timeout: Optional[float] = None,
+    ):
+        """
+        :param socket_path:
+            Path to the engine's API socket.
+        :param api_version:
+            The API version to request.
+        :param pool_size:
+            The maximum number of idle connections to keep open.
+        :param timeout:
+            Socket timeout in seconds, defaults to no timeout.
+        """
+        self.socket_path = socket_path
+        self.api_version = api_version
+        self.timeout = timeout
+        self._pool: queue.LifoQueue[_UnixHTTPConnection] = queue.LifoQueue(pool_size)
+
+    def _url(self, path: str, params: Optional[Mapping[str, Any]] = None) -> str:
+        url = f"/{self.api_version}{path}"
+        if params:
+            url += "?" + urllib.parse.urlencode(params)
+        return url
+
+    def _send(
+        self,
+        conn: _UnixHTTPConnection,
+        method: str,
+        url: str,
+        body: Optional[Any],
+    ) -> http.client.HTTPResponse:
+        headers = {}
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+        conn.request(method, url, body=data, headers=headers)
+        return conn.getresponse()
+
+    @staticmethod
+    def _check_response(
+        method: str, path: str, resp: http.client.HTTPResponse, data: bytes
+    ) -> None:
+        if resp.status >= 400:
+            raise CtrException(["api", method, path], resp.status, b"", data)
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        *,
+        params: Optional[Mapping[str, Any]] = None,
+        body: Optional[Any] = None,
+    ) -> Any:
+        """
+        Make an API request using a pooled connection.
+
+        :param method:
+            The HTTP method.
+        :param path:
+            The API path, excluding the version prefix.
+        :param params:
+            Query parameters.
+        :param body:
+            Request body, to be encoded as JSON.
+        :return:
+            The decoded JSON response, or None if the response is empty.
+        :raise CtrException:
+            If the request fails.
+        """
+        url = self._url(path, params)
+        try:
+            conn = self._pool.get_nowait()
+            reused = True
+        except queue.Empty:
+            conn = _UnixHTTPConnection(self.socket_path, self.timeout)
+            reused = False
+        try:
+            resp = self._send(conn, method, url, body)
+        except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+            conn.close()
+            if not reused:
+                raise
+            # The idle connection was closed by the server, retry on a new one.
+            conn = _UnixHTTPConnection(self.socket_path, self.timeout)
+            resp = self._send(conn, method, url, body)
+        data = resp.read()
+        if resp.will_close:
+            conn.close()
+        else:
+            try:
+                self._pool.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+        self._check_response(method, path, resp, data)
+        if not data:
+            return None
+        return json.loads(data)
+
+    def stream(
+        self,
+        method: str,
+        path: str,
+        *,
+        params: Optional[Mapping[str, Any]] = None,
+        body: Optional[Any] = None,
+        multiplexed: bool = False,
+    ) -> _ApiStream:
+        """
+        Make an API request with a streamed response, on a new connection.
+
+        :param multiplexed:
+            Whether the response is multiplexed stdout/stderr output.
+        :return:
+            The stream, which must be closed.
+        :raise CtrException:
+            If the request fails.
+        """
+        conn = _UnixHTTPConnection(self.socket_path, self.timeout)
+        try:
+            # Keep a reference to the socket, which the connection drops once
+            # the response is returned.
+            conn.connect()
+            sock = conn.sock
+            resp = self._send(conn, method, self._url(path, params), body)
+            if resp.status >= 400:
+                self._check_response(method, path, resp, resp.read())
+        except BaseException:
+            conn.close()
+            raise
+        return _ApiStream(sock, resp, multiplexed=multiplexed)
+
+    def close(self) -> None:
+        """Close all pooled connections."""
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def supports_run_kwargs(self, kwargs: Iterable[str]) -> bool:
+        """Check whether the given container run arguments are supported."""
+        return self._RUN_KWARGS.issuperset(kwargs)
+
+    def get_container(self, ctr_id: str) -> ApiContainer:
+        """Get a container by ID or name."""
+        return ApiContainer(self, ctr_id)
+
+    def run(
+        self,
+        image: Any,
+        command: Iterable[str] = (),
+        *,
+        cap_add: Iterable[str] = (),
+        cgroupns: Optional[str] = None,
+        detach: bool = False,
+        entrypoint: Optional[str] = None,
+        envs: Optional[Mapping[str, str]] = None,
+        interactive: bool = False,
+        name: Optional[str] = None,
+        privileged: bool = False,
+        remove: bool = False,
+        tmpfs: Iterable[str] = (),
+        tty: bool = False,
+        volumes: Iterable[tuple[str, ...]] = (),
+    ) -> ApiContainer | str:
+        """
+        Run a container, as per python-on-whales' run().
+
+        :param image:
+            The image, either an image object or a name/ID.
+        :return:
+            The container if detached, otherwise the container's output with
+            any trailing newline removed.
+        :raise CtrException:
+            If creating or starting the container fails, or the container
+            exits with a non-zero exit code when not detached.
+        """
+        command = list(command)
+        host_config = {
+            "Privileged": privileged,
+            "CapAdd": list(cap_add),
+            "Tmpfs": {str(path): "" for path in tmpfs},
+            "Binds": [":".join(str(x) for x in vol) for vol in volumes],
+            "AutoRemove": remove and detach,
+        }
+        if cgroupns:
+            host_config["CgroupnsMode"] = cgroupns
+        body = {
+            "Image": getattr(image, "id", image),
+            "Env": [f"{k}={v}" for k, v in (envs or {}).items()],
+            "Tty": tty,
+            "OpenStdin": interactive,
+            "HostConfig": host_config,
+        }
+        if command:
+            body["Cmd"] = command
+        if entrypoint is not None:
+            body["Entrypoint"] = [entrypoint] if entrypoint else [""]
+        ctr_id = self.request(
+            "POST",
+            "/containers/create",
+            params={"name": name} if name else None,
+            body=body,
+        )["Id"]
+        ctr = ApiContainer(self, ctr_id, attrs={})
+        try:
+            self.request("POST", f"/containers/{ctr_id}/start")
+            ctr.reload()
+            if detach:
+                return ctr
+            wait_info = self.request("POST", f"/containers/{ctr_id}/wait")
+            exit_code = wait_info["StatusCode"]
+            output = ctr.logs()
+        except BaseException:
+            if not detach or remove:
+                _force_remove(ctr)
+            raise
+        if remove:
+            _force_remove(ctr)
+        if exit_code != 0:
+            raise CtrException(
+                ["run", str(body["Image"]), *command],
+                exit_code,
+                output.encode("utf-8"),
+                b"",
+            )
+        return output.removesuffix("\n")
+
+
+def _force_remove(ctr: ApiContainer) -> None:
+    """Force remove a container, logging any error."""
+    try:
+        ctr.remove(force=True)
+    except CtrException as e:
+        logger.warning("Failed to remove container %s: %s", ctr.id[:12], e)
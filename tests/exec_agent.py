@@ -0,0 +1,318 @@
+"""
+Running commands in containers with low overhead.
+
+Multiple commands are run using a single exec process by wrapping them in a
+script that frames each command's output, either with a new exec process per
+batch or via a long-lived agent process in the container.
+"""
+
+from __future__ import annotations
+
+__all__ = (
+    "ExecAgent",
+    "execute_batch",
+    "framed_exec_script",
+    "parse_framed_exec_output",
+)
+
+import base64
+import contextlib
+import logging
+import queue
+import shlex
+import subprocess
+import textwrap
+import threading
+import time
+from typing import Iterable, Optional
+
+from python_on_whales import Container
+from python_on_whales import DockerException as CtrException
+
+from .utils import CtrClient, ExecResult
+
+logger = logging.getLogger(__name__)
+
+
+# Marks the start of each command's output from a framed exec script.
+_EXEC_FRAME_BOUNDARY = "--systemd-tests-exec-frame--"
+
+
+def framed_exec_script(
+    cmds: Iterable[list[str]], *, make_tmpdir: bool = True
+) -> str:
+    """
+    Create a shell script running the given commands with framed output.
+
+    For each command, the output consists of a boundary line containing the
+    exit code, followed by a line each for base64-encoded stdout and stderr.
+
+    :param cmds:
+        The commands to run.
+    :param make_tmpdir:
+        Whether to create (and remove) the temporary directory used to capture
+        command output, otherwise the script expects the directory to be given
+        in the 'd' shell variable.
+    """
+    script = "d=$(mktemp -d)\n" if make_tmpdir else ""
+    for cmd in cmds:
+        script += (
+            f'{shlex.join(cmd)} >"$d/out" 2>"$d/err" </dev/null; rc=$?\n'
+            f'echo "{_EXEC_FRAME_BOUNDARY} $rc"\n'
+            'base64 -w0 "$d/out"; echo; base64 -w0 "$d/err"; echo\n'
+        )
+    if make_tmpdir:
+        script += 'rm -rf "$d"\n'
+    return script
+
+
+def parse_framed_exec_output(
+    cmds: list[list[str]], output_lines: Iterable[str]
+) -> list[ExecResult]:
+    """
+    Parse the output from a script created by framed_exec_script().
+
+    :param cmds:
+        The commands the script was created for.
+    :param output_lines:
+        The lines output by the script.
+    :return:
+        The result of each command.
+    :raise ValueError:
+        If the output is not framed as expected.
+    """
+    lines = iter(output_lines)
+    results = []
+    for cmd in cmds:
+        line = next(lines, "")
+        boundary, _, returncode = line.rpartition(" ")
+        if boundary != _EXEC_FRAME_BOUNDARY:
+            raise ValueError(f"Expected exec frame boundary line, got {line!r}")
+        # Note that the final empty line may have been stripped, and a single
+        # trailing newline is stripped from the command output for consistency
+        # with Container.execute().
+        stdout = base64.b64decode(next(lines, "")).decode("utf-8")
+        stderr = base64.b64decode(next(lines, "")).decode("utf-8")
+        results.append(
+            ExecResult(
+                cmd,
+                int(returncode),
+                stdout.removesuffix("\n"),
+                stderr.removesuffix("\n"),
+            )
+        )
+    return results
+
+
+def execute_batch(ctr: Container, cmds: Iterable[list[str]]) -> list[ExecResult]:
+    """
+    Execute multiple commands in a container with a single exec call.
+
+    The commands are run in sequence by a shell in the container, with the
+    output of each command captured separately. Unlike Container.execute(),
+    commands returning a non-zero exit code do not raise an exception, see
+    ExecResult.check().
+
+    :param ctr:
+        The container to run the commands in.
+    :param cmds:
+        The commands to run.
+    :return:
+        The results for each command, in the same order as the commands.
+    """
+    if isinstance(ctr, ExecAgent):
+        return ctr.execute_batch(cmds)
+    cmds = list(cmds)
+    if not cmds:
+        return []
+    output = ctr.execute(["sh", "-c", framed_exec_script(cmds)])
+    return parse_framed_exec_output(cmds, output.splitlines())
+
+
+class ExecAgent:
+    """
+    A long-lived shell in a container, used to run commands with low latency.
+
+    Commands are sent to the shell's stdin as base64-encoded framed exec
+    scripts (one per line), with the framed output read back from its stdout.
+    This avoids the overhead of starting a new exec process for each command.
+
+    Other attributes are delegated to the underlying container, such that this
+    can be used in place of a Container.
+
+    If a command's output isn't received within the timeout, the agent is
+    assumed to be wedged and is killed and restarted. The agent is similarly
+    restarted if it exits, such that subsequent commands can still be run.
+    """
+
+    _SCRIPT = textwrap.dedent(
+        """\
+        d=$(mktemp -d)
+        trap 'rm -rf "$d"' EXIT
+        while IFS= read -r line; do
+            eval "$(printf '%s' "$line" | base64 -d)"
+        done
+        """
+    )
+
+    def __init__(self, ctr_client: CtrClient, ctr: Container, *, timeout: float = 60):
+        """
+        :param ctr_client:
+            The container client.
+        :param ctr:
+            The container to run commands in.
+        :param timeout:
+            The default timeout in seconds for receiving the output of commands.
+        """
+        self.ctr_client = ctr_client
+        self.ctr = ctr
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._start()
+
+    def _start(self) -> None:
+        """Start the agent process, with a thread reading its output lines."""
+        self._proc = subprocess.Popen(
+            [self.ctr_client.exe, "exec", "-i", self.ctr.id, "sh", "-c", self._SCRIPT],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            encoding="utf-8",
+        )
+        # Output lines, with None marking the end of the output.
+        self._lines: queue.SimpleQueue[Optional[str]] = queue.SimpleQueue()
+        threading.Thread(
+            target=self._read_output,
+            args=(self._proc.stdout, self._lines),
+            name=f"exec-agent-{self.ctr.name}",
+            daemon=True,
+        ).start()
+        logger.debug("Started exec agent in container %s", self.ctr.name)
+
+    @staticmethod
+    def _read_output(stream, lines: queue.SimpleQueue[Optional[str]]) -> None:
+        with contextlib.suppress(OSError, ValueError):
+            for line in stream:
+                lines.put(line.removesuffix("\n"))
+        lines.put(None)
+
+    def __getattr__(self, name: str):
+        return getattr(self.ctr, name)
+
+    def execute_batch(
+        self, cmds: Iterable[list[str]], *, timeout: Optional[float] = None
+    ) -> list[ExecResult]:
+        """
+        Execute multiple commands in the container via the agent.
+
+        :param cmds:
+            The commands to run.
+        :param timeout:
+            The timeout in seconds for receiving the commands' output, defaults
+            to the agent's timeout.
+        :return:
+            The results for each command, in the same order as the commands.
+        :raise CtrException:
+            If the agent process exits while running the commands, in which
+            case the agent is restarted.
+        :raise TimeoutError:
+            If the output is not received within the timeout, in which case the
+            agent is restarted.
+        """
+        cmds = list(cmds)
+        if not cmds:
+            return []
+        if timeout is None:
+            timeout = self.timeout
+        script = framed_exec_script(cmds, make_tmpdir=False)
+        request = base64.b64encode(script.encode("utf-8")).decode("ascii")
+        with self._lock:
+            if self._proc.poll() is not None:
+                logger.warning(
+                    "Exec agent in container %s exited with code %s, restarting it",
+                    self.ctr.name,
+                    self._proc.returncode,
+                )
+                self._restart()
+            deadline = time.monotonic() + timeout
+            try:
+                self._proc.stdin.write(request + "\n")
+                self._proc.stdin.flush()
+                output_lines = [self._read_line(deadline) for _ in range(3 * len(cmds))]
+            except TimeoutError:
+                logger.warning(
+                    "Exec agent in container %s timed out, restarting it",
+                    self.ctr.name,
+                )
+                self._restart()
+                raise TimeoutError(
+                    f"Timed out after {timeout} seconds waiting for exec agent "
+                    f"output of: {'; '.join(shlex.join(c) for c in cmds)}"
+                ) from None
+            except (OSError, EOFError) as e:
+                returncode = self._proc.poll()
+                logger.warning(
+                    "Exec agent in container %s exited, restarting it",
+                    self.ctr.name,
+                )
+                self._restart()
+                raise CtrException(
+                    ["exec-agent", *(shlex.join(c) for c in cmds)],
+                    returncode or -1,
+                ) from e
+        return parse_framed_exec_output(cmds, output_lines)
+
+    def execute(self, command: list[str], *, detach: bool = False, **kwargs) -> str:
+        """
+        Execute a command in the container, as per Container.execute().
+
+        Commands are run via the agent unless arguments not supported by the
+        agent are passed, in which case a new exec process is used.
+
+        :raise CtrException:
+            If the command returns a non-zero exit code.
+        """
+        if detach or kwargs:
+            return self.ctr.execute(command, detach=detach, **kwargs)
+        return self.execute_batch([command])[0].check()
+
+    def close(self) -> None:
+        """Stop the agent process."""
+        with contextlib.suppress(OSError):
+            self._proc.stdin.close()
+        try:
+            self._proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self._kill()
+
+    def _restart(self) -> None:
+        """Kill the agent process and start a new one."""
+        self._kill()
+        self._start()
+
+    def _kill(self) -> None:
+        """Kill the agent process."""
+        self._proc.kill()
+        self._proc.wait()
+        with contextlib.suppress(OSError):
+            self._proc.stdin.close()
+
+    def _read_line(self, deadline: float) -> str:
+        """
+        Read a line of the agent's output.
+
+        :raise TimeoutError:
+            If no line is output before the deadline (a time.monotonic() value).
+        :raise EOFError:
+            If the output has ended.
+        """
+        try:
+            line = self._lines.get(timeout=max(0, deadline - time.monotonic()))
+        except queue.Empty:
+            raise TimeoutError from None
+        if line is None:
+            # Keep the end marker for subsequent reads.
+            self._lines.put(None)
+            raise EOFError("Exec agent output closed")
+        return line
@@ -0,0 +1,260 @@
+"""
+Probing of the container host's properties and available resources.
+"""
+
+from __future__ import annotations
+
+__all__ = (
+    "HostProbe",
+    "get_host_memory_available",
+    "get_host_probe_key",
+    "get_host_resources",
+    "probe_host",
+)
+
+import contextlib
+import dataclasses
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+from pathlib import Path
+from typing import Any, Mapping, Optional
+
+from .cgroups import CgroupMount, parse_mountinfo
+from .utils import CtrClient, CtrMgr, run_cmd, to_json_compatible
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass(frozen=True)
+class HostProbe:
+    """
+    Properties of the container host, see probe_host().
+
+    :param local:
+        Whether the containers run on the local host, in which case the cgroup
+        mounts are those of the host.
+    :param cgroup_version:
+        The host's cgroup version.
+    :param cgroup_mounts:
+        The host's cgroup mounts, if local.
+    :param engine_info:
+        The output of the container manager's 'info' command.
+    """
+
+    local: bool
+    cgroup_version: int
+    cgroup_mounts: tuple[CgroupMount, ...]
+    engine_info: str
+
+    def to_dict(self) -> dict[str, Any]:
+        """Convert to a JSON-compatible dict."""
+        return to_json_compatible(self)
+
+    @classmethod
+    def from_dict(cls, data: Mapping[str, Any]) -> HostProbe:
+        """Create from a dict as returned by to_dict()."""
+        return cls(
+            local=data["local"],
+            cgroup_version=data["cgroup_version"],
+            cgroup_mounts=tuple(
+                CgroupMount(
+                    **{
+                        **m,
+                        "options": tuple(m["options"]),
+                        "super_options": tuple(m["super_options"]),
+                    }
+                )
+                for m in data["cgroup_mounts"]
+            ),
+            engine_info=data["engine_info"],
+        )
+
+
+def _is_local_host(ctr_client: CtrClient) -> bool:
+    """
+    Whether the container manager runs containers on the local host.
+
+    Besides the container manager not being configured with a remote host, the
+    engine's reported kernel release and hostname must match the local ones,
+    since engines such as Docker Desktop and Podman machine run containers in a
+    VM while being accessed via a local socket.
+    """
+    if (
+        ctr_client.host
+        or os.environ.get("DOCKER_HOST")
+        or os.environ.get("CONTAINER_HOST")
+        or not os.path.exists("/proc/self/mountinfo")
+    ):
+        return False
+    uname = os.uname()
+    engine_host = ctr_client.engine_host
+    return (engine_host.kernel_version, engine_host.hostname) == (
+        uname.release,
+        uname.nodename,
+    )
+
+
+def get_host_probe_key(ctr_client: CtrClient) -> str:
+    """
+    Get a key identifying the container host's setup, for caching probe results.
+
+    This is based on the container manager executable and the engine's server
+    version, plus for a local host the host's boot ID and its cgroup mounts, or
+    for a remote host the container manager's full version information.
+
+    :param ctr_client:
+        The container client.
+    :return:
+        The key.
+    """
+    exe_path = shutil.which(ctr_client.exe) or ctr_client.exe
+    key_parts: list[Any] = [exe_path, ctr_client.host]
+    with contextlib.suppress(OSError):
+        key_parts.append(os.stat(exe_path).st_mtime_ns)
+    key_parts.append(ctr_client.engine_host.server_version)
+    if _is_local_host(ctr_client):
+        key_parts.append(Path("/proc/sys/kernel/random/boot_id").read_text().strip())
+        key_parts.extend(
+            line
+            for line in Path("/proc/self/mountinfo").read_text().splitlines()
+            if " - cgroup" in line
+        )
+    else:
+        version_format = "json" if ctr_client.mgr is CtrMgr.PODMAN else "{{json .}}"
+        key_parts.append(
+            run_cmd([ctr_client.exe, "version", "--format", version_format]).stdout
+        )
+    return hashlib.sha256(json.dumps(key_parts).encode("utf-8")).hexdigest()
+
+
+def probe_host(ctr_client: CtrClient) -> HostProbe:
+    """
+    Probe the properties of the container host.
+
+    For a local host the cgroup setup is read from /proc/self/mountinfo,
+    otherwise a container is run to determine the cgroup version.
+
+    :param ctr_client:
+        The container client.
+    :return:
+        The host properties.
+    :raise CtrException:
+        If running the container to check the cgroup version fails.
+    :raise ValueError:
+        If the cgroup version cannot be determined.
+    """
+    local = _is_local_host(ctr_client)
+    mounts: tuple[CgroupMount, ...] = ()
+    if local:
+        mounts = tuple(parse_mountinfo(Path("/proc/self/mountinfo").read_text()))
+        if any(m.path == "/sys/fs/cgroup" and m.type == "cgroup2" for m in mounts):
+            cgroup_version = 2
+        elif any(m.type == "cgroup" for m in mounts):
+            cgroup_version = 1
+        else:
+            raise ValueError("No cgroup mounts found under /proc/self/mountinfo")
+    else:
+        fs_type = ctr_client.run(
+            "ubuntu:20.04",
+            ["stat", "-f", "/sys/fs/cgroup/", "-c", "%T"],
+            detach=False,
+            remove=True,
+        ).strip()
+        if fs_type == "tmpfs":
+            cgroup_version = 1
+        elif fs_type == "cgroup2fs":
+            cgroup_version = 2
+        else:
+            raise ValueError(
+                "Unable to determine cgroup version from container's "
+                f"/sys/fs/cgroup filesystem type {fs_type!r}"
+            )
+    return HostProbe(
+        local=local,
+        cgroup_version=cgroup_version,
+        cgroup_mounts=mounts,
+        engine_info=run_cmd([ctr_client.exe, "info"]).stdout,
+    )
+
+
+def _read_mem_available() -> Optional[int]:
+    """Read the local host's available memory in bytes from /proc/meminfo."""
+    with contextlib.suppress(OSError, ValueError):
+        for line in Path("/proc/meminfo").read_text().splitlines():
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) * 1024
+    return None
+
+
+def get_host_memory_available(
+    ctr_client: CtrClient, *, refresh: bool = True
+) -> tuple[Optional[int], Optional[str]]:
+    """
+    Get the memory (in bytes) currently available on the container host.
+
+    This is read from /proc/meminfo ('MemAvailable') for a local host, otherwise
+    from Podman's 'info' output ('memFree', which unlike 'MemAvailable' doesn't
+    include reclaimable memory such as the page cache). Docker does not report
+    the host's available memory.
+
+    :param ctr_client:
+        The container client.
+    :param refresh:
+        Whether to re-query Podman's 'info' output, rather than using the
+        output cached by the container client (see
+        CtrClient.get_engine_info()).
+    :return:
+        A tuple of the available memory in bytes and the name of the metric it
+        was read from, or (None, None) if unknown.
+    """
+    if _is_local_host(ctr_client):
+        if (mem_available := _read_mem_available()) is not None:
+            return mem_available, "MemAvailable"
+    elif ctr_client.mgr is CtrMgr.PODMAN:
+        try:
+            info = ctr_client.get_engine_info(refresh=refresh)
+            return info["host"]["memFree"], "memFree"
+        except (subprocess.CalledProcessError, ValueError, KeyError) as e:
+            logger.warning("Unable to get container host's free memory: %s", e)
+    return None, None
+
+
+def get_host_resources(ctr_client: CtrClient) -> tuple[int, int, Optional[str]]:
+    """
+    Get the CPU count and memory (in bytes) available for running containers.
+
+    The CPU count is the minimum of the local CPU count and that reported by
+    the container manager, since the containers may be running on a different
+    host (e.g. a VM or remote host). The memory is the host's available memory
+    (see get_host_memory_available()), except with Docker on a non-local host,
+    which doesn't report the available memory, in which case the host's total
+    memory ('MemTotal') is used.
+
+    A single 'info' query of the container manager is shared between these.
+
+    :param ctr_client:
+        The container client, used to query the container manager's resources.
+    :return:
+        A tuple of (number of CPUs, memory in bytes, name of the memory metric
+        used), with the memory being 0 and the metric None if unknown.
+    """
+    cpus = os.cpu_count() or 1
+    info: Mapping[str, Any] = {}
+    try:
+        info = ctr_client.get_engine_info()
+        if ctr_client.mgr is CtrMgr.PODMAN:
+            cpus = min(cpus, info["host"]["cpus"])
+        else:
+            cpus = min(cpus, info["NCPU"])
+    except (subprocess.CalledProcessError, ValueError, KeyError) as e:
+        logger.warning("Unable to get container manager resources: %s", e)
+
+    memory, mem_metric = get_host_memory_available(ctr_client, refresh=False)
+    if memory is None and "MemTotal" in info:
+        memory, mem_metric = info["MemTotal"], "MemTotal"
+
+    return cpus, memory or 0, mem_metric
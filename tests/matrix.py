@@ -0,0 +1,261 @@
+"""
+The matrix of test parameterisations, and rules for which combinations apply.
+
+The rules are declared as data and compiled into the set of valid parameter
+combinations for a given host, such that checking whether a parameterised test
+applies is a single set lookup.
+
+Custom setup modes declare what they support in a 'metadata.json' file next to
+their 'init_script.sh', from which the rules for setup modes are generated.
+"""
+
+from __future__ import annotations
+
+__all__ = (
+    "APPLICABILITY_RULES",
+    "CGROUPNS_VALUES",
+    "CGROUP_MODES",
+    "PARAMETERS",
+    "SETUP_MODE_METADATA",
+    "CompiledMatrix",
+    "MatrixRule",
+    "ParamCombo",
+    "SetupModeMetadata",
+    "compile_matrix",
+    "get_combo",
+    "load_setup_mode_metadata",
+    "setup_mode_rules",
+)
+
+import dataclasses
+import itertools
+import json
+from typing import Any, Collection, Iterable, Mapping, Optional
+
+from . import ALL_SETUP_MODES, SYSTEMD_TEST_DIR
+
+# The parameters tests are parameterised on, in the order used for combos.
+PARAMETERS = ("setup_mode", "cgroupns", "cgroup_mode")
+
+CGROUPNS_VALUES = ["host", "private"]
+
+CGROUP_MODES = ["legacy", "hybrid", "unified"]
+
+# A combination of (setup_mode, cgroupns, cgroup_mode) parameter values.
+ParamCombo = tuple[Optional[str], str, str]
+
+
+@dataclasses.dataclass(frozen=True)
+class MatrixRule:
+    """
+    A rule restricting the valid combinations of parameters.
+
+    :param name:
+        Description of the rule.
+    :param when:
+        Conditions for the rule to apply, mapping parameter names or host
+        properties (e.g. 'cgroup_version') to the values the rule applies to.
+        The rule always applies if empty.
+    :param require:
+        Parameter values that are required when the rule applies, mapping
+        parameter names to the allowed values.
+    :param exclude:
+        Parameter values that are not allowed when the rule applies, mapping
+        parameter names to the disallowed values.
+    """
+
+    name: str
+    when: Mapping[str, Collection[Any]] = dataclasses.field(default_factory=dict)
+    require: Mapping[str, Collection[Any]] = dataclasses.field(default_factory=dict)
+    exclude: Mapping[str, Collection[Any]] = dataclasses.field(default_factory=dict)
+
+    def allows(self, values: Mapping[str, Any]) -> bool:
+        """
+        Check whether the rule allows the given values.
+
+        :param values:
+            The parameter values and host properties.
+        :return:
+            False if the rule applies and the values are not allowed.
+        """
+        if not all(values[k] in v for k, v in self.when.items()):
+            return True
+        return all(values[k] in v for k, v in self.require.items()) and not any(
+            values[k] in v for k, v in self.exclude.items()
+        )
+
+
+@dataclasses.dataclass(frozen=True)
+class SetupModeMetadata:
+    """
+    The requirements and support of a setup mode, as declared in its metadata.
+
+    :param cgroup_versions:
+        The host cgroup versions the setup mode supports.
+    :param cgroupns:
+        The cgroupns values the setup mode supports.
+    :param capabilities:
+        The capabilities required by the setup mode when not privileged.
+    :param ctr_mgrs:
+        The container managers the setup mode supports.
+    :param privileged_ctr_mgrs:
+        The container managers that require the container to be privileged.
+    """
+
+    cgroup_versions: tuple[int, ...] = (1, 2)
+    cgroupns: tuple[str, ...] = tuple(CGROUPNS_VALUES)
+    capabilities: tuple[str, ...] = ("sys_admin",)
+    ctr_mgrs: tuple[str, ...] = ("docker", "podman")
+    privileged_ctr_mgrs: tuple[str, ...] = ()
+
+    @classmethod
+    def from_dict(cls, data: Mapping[str, Any]) -> SetupModeMetadata:
+        """
+        Create from a dictionary of the metadata file's fields.
+
+        :raise ValueError:
+            If there are unrecognised fields.
+        """
+        field_names = {f.name for f in dataclasses.fields(cls)}
+        if unknown := set(data) - field_names:
+            raise ValueError(f"Unrecognised setup mode metadata: {sorted(unknown)}")
+        return cls(**{k: tuple(v) for k, v in data.items()})
+
+
+def load_setup_mode_metadata(setup_mode: Optional[str]) -> SetupModeMetadata:
+    """
+    Load a setup mode's metadata.
+
+    The default setup mode (None) has no setup mode directory, with its metadata
+    defined here: it requires privileged mode with Docker.
+
+    :param setup_mode:
+        The setup mode name, or None for the default setup mode.
+    :return:
+        The setup mode metadata, with defaults for any fields not declared.
+    :raise ValueError:
+        If the metadata file is invalid.
+    """
+    if setup_mode is None:
+        return SetupModeMetadata(privileged_ctr_mgrs=("docker",))
+    path = SYSTEMD_TEST_DIR / "setup_modes" / setup_mode / "metadata.json"
+    try:
+        data = json.loads(path.read_text())
+    except FileNotFoundError:
+        return SetupModeMetadata()
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Invalid setup mode metadata file {path}: {e}") from e
+    return SetupModeMetadata.from_dict(data)
+
+
+SETUP_MODE_METADATA: dict[Optional[str], SetupModeMetadata] = {
+    mode: load_setup_mode_metadata(mode) for mode in ALL_SETUP_MODES
+}
+
+
+def setup_mode_rules(
+    metadata: Mapping[Optional[str], SetupModeMetadata] = SETUP_MODE_METADATA,
+) -> list[MatrixRule]:
+    """
+    Generate the rules for which parameterisations each setup mode supports.
+
+    The rules have conditions on the 'cgroup_version' and 'ctr_mgr' host
+    properties.
+
+    :param metadata:
+        The metadata of each setup mode.
+    :return:
+        The generated rules.
+    """
+    rules = []
+    for mode, md in metadata.items():
+        mode_name = mode or "default"
+        rules.append(
+            MatrixRule(
+                f"{mode_name} setup_mode support",
+                when={"setup_mode": {mode}},
+                require={
+                    "cgroup_version": set(md.cgroup_versions),
+                    "cgroupns": set(md.cgroupns),
+                    "ctr_mgr": set(md.ctr_mgrs),
+                },
+            )
+        )
+    return rules
+
+
+# Rules for which parameterisations make sense to run.
+APPLICABILITY_RULES: list[MatrixRule] = [
+    MatrixRule(
+        "cgroupv1 non-unified",
+        when={"cgroup_version": {1}},
+        require={"cgroup_mode": {"legacy", "hybrid"}},
+    ),
+    MatrixRule(
+        "cgroupv2 unified",
+        when={"cgroup_version": {2}},
+        require={"cgroup_mode": {"unified"}},
+    ),
+    *setup_mode_rules(),
+]
+
+
+@dataclasses.dataclass(frozen=True)
+class CompiledMatrix:
+    """
+    The result of compiling matrix rules, see compile_matrix().
+
+    :param valid:
+        The valid parameter combinations.
+    :param reasons:
+        The names of the rules disallowing each invalid combination.
+    """
+
+    valid: frozenset[ParamCombo]
+    reasons: Mapping[ParamCombo, tuple[str, ...]]
+
+    def __contains__(self, combo: ParamCombo) -> bool:
+        return combo in self.valid
+
+
+def compile_matrix(
+    rules: Iterable[MatrixRule],
+    host_properties: Optional[Mapping[str, Any]] = None,
+    *,
+    setup_modes: Iterable[Optional[str]] = ALL_SETUP_MODES,
+    cgroupns_values: Iterable[str] = CGROUPNS_VALUES,
+    cgroup_modes: Iterable[str] = CGROUP_MODES,
+) -> CompiledMatrix:
+    """
+    Compile rules into the set of valid parameter combinations.
+
+    :param rules:
+        The rules to apply.
+    :param host_properties:
+        Properties of the host that rules may have conditions on, such as
+        'cgroup_version' and 'ctr_mgr'.
+    :param setup_modes:
+        All setup mode values.
+    :param cgroupns_values:
+        All cgroupns values.
+    :param cgroup_modes:
+        All cgroup mode values.
+    :return:
+        The compiled matrix.
+    """
+    rules = list(rules)
+    valid = set()
+    reasons = {}
+    for combo in itertools.product(setup_modes, cgroupns_values, cgroup_modes):
+        values = {**(host_properties or {}), **dict(zip(PARAMETERS, combo))}
+        failed = tuple(rule.name for rule in rules if not rule.allows(values))
+        if failed:
+            reasons[combo] = failed
+        else:
+            valid.add(combo)
+    return CompiledMatrix(frozenset(valid), reasons)
+
+
+def get_combo(params: Mapping[str, Any]) -> ParamCombo:
+    """Get the parameter combination from a test's parameters."""
+    return tuple(params[p] for p in PARAMETERS)
@@ -0,0 +1,294 @@
+"""
+Sampling of containers' resource usage over time.
+"""
+
+from __future__ import annotations
+
+__all__ = (
+    "CtrResourceSampler",
+    "ResourceSample",
+)
+
+import dataclasses
+import logging
+import re
+import threading
+import time
+from pathlib import Path
+from typing import Any, Iterable, Optional
+
+from python_on_whales import Container
+from python_on_whales import DockerException as CtrException
+
+from .cgroups import CgroupMount, parse_proc_cgroup
+from .utils import CtrClient, run_ctr_cli, summarise_samples
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass(frozen=True)
+class ResourceSample:
+    """
+    A sample of a container's resource usage.
+
+    Values are None where not available from the source being sampled.
+
+    :param time:
+        The time of the sample, in seconds since sampling started.
+    :param memory_current:
+        The current memory usage in bytes.
+    :param memory_peak:
+        The peak memory usage in bytes.
+    :param cpu_usage_usec:
+        The cumulative CPU usage in microseconds.
+    :param pids_current:
+        The current number of processes/threads.
+    :param io_read_bytes:
+        The cumulative bytes read from block devices.
+    :param io_write_bytes:
+        The cumulative bytes written to block devices.
+    """
+
+    time: float
+    memory_current: Optional[int] = None
+    memory_peak: Optional[int] = None
+    cpu_usage_usec: Optional[int] = None
+    pids_current: Optional[int] = None
+    io_read_bytes: Optional[int] = None
+    io_write_bytes: Optional[int] = None
+
+
+# Units used by the 'stats' command for sizes, e.g. '12.5MiB' or '1.2kB'.
+_STATS_SIZE_UNITS = {
+    "B": 1,
+    "kB": 1000,
+    "KB": 1000,
+    "MB": 1000**2,
+    "GB": 1000**3,
+    "TB": 1000**4,
+    "KiB": 1024,
+    "MiB": 1024**2,
+    "GiB": 1024**3,
+    "TiB": 1024**4,
+}
+
+
+_STATS_SIZE_REGEX = re.compile(r"([\d.]+)\s*([a-zA-Z]+)")
+
+
+def _parse_stats_size(value: str) -> Optional[int]:
+    """Parse a size as output by the 'stats' command, None if not available."""
+    match = _STATS_SIZE_REGEX.fullmatch(value.strip())
+    if not match or match.group(2) not in _STATS_SIZE_UNITS:
+        return None
+    return int(float(match.group(1)) * _STATS_SIZE_UNITS[match.group(2)])
+
+
+def _read_cgroup_int(path: Path) -> Optional[int]:
+    """Read a single-value cgroup file, None if not available (or 'max')."""
+    try:
+        return int(path.read_text().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _read_cgroup_file(path: Path) -> list[str]:
+    """Read the lines of a cgroup file, empty if not available."""
+    try:
+        return path.read_text().splitlines()
+    except OSError:
+        return []
+
+
+def _find_ctr_cgroup_dirs(
+    ctr_id: str, pid: int, cgroup_mounts: Iterable[CgroupMount]
+) -> dict[str, Path]:
+    """
+    Find the host directories of a container's cgroups.
+
+    :param ctr_id:
+        The container ID.
+    :param pid:
+        The host PID of a process in the container.
+    :param cgroup_mounts:
+        The host's cgroup mounts.
+    :return:
+        A mapping of hierarchy (as in /proc/<pid>/cgroup) to the container's
+        cgroup directory in that hierarchy.
+    :raise OSError:
+        If the process's cgroups cannot be read.
+    """
+    cgroup_mounts = [m for m in cgroup_mounts if m.root == "/"]
+    dirs = {}
+    for hierarchy, path in parse_proc_cgroup(
+        Path(f"/proc/{pid}/cgroup").read_text()
+    ).items():
+        # The container's init may have moved itself into a child cgroup (e.g.
+        # systemd's init.scope), so use the cgroup named after the container.
+        parts = path.split("/")
+        for i in range(len(parts), 0, -1):
+            if ctr_id in parts[i - 1]:
+                path = "/".join(parts[:i])
+                break
+        for mount in cgroup_mounts:
+            if mount.is_for_hierarchy(hierarchy):
+                dirs[hierarchy] = Path(mount.path + path)
+                break
+    return dirs
+
+
+class CtrResourceSampler:
+    """
+    Samples a container's resource usage at an interval in a background thread.
+
+    Where the container runs on the local host the container's cgroup files are
+    read directly from the host's cgroup mounts, otherwise the container
+    manager's 'stats' command is used.
+    """
+
+    def __init__(
+        self,
+        ctr_client: CtrClient,
+        ctr: Container,
+        interval: float,
+        *,
+        cgroup_mounts: Iterable[CgroupMount] = (),
+    ):
+        """
+        :param ctr_client:
+            The container client.
+        :param ctr:
+            The container to sample.
+        :param interval:
+            The interval between samples in seconds.
+        :param cgroup_mounts:
+            The host's cgroup mounts, if local.
+        """
+        self.ctr_client = ctr_client
+        self.ctr = ctr
+        self.interval = interval
+        self.samples: list[ResourceSample] = []
+        self._cgroup_dirs: dict[str, Path] = {}
+        cgroup_mounts = tuple(cgroup_mounts)
+        if cgroup_mounts and ctr.state.pid:
+            try:
+                self._cgroup_dirs = _find_ctr_cgroup_dirs(
+                    ctr.id, ctr.state.pid, cgroup_mounts
+                )
+            except OSError as e:
+                logger.debug("Unable to find cgroups of container %s: %s", ctr.name, e)
+        self.source = "cgroup" if self._cgroup_dirs else "stats"
+        self._start = time.monotonic()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name=f"resource-sampler-{ctr.name}", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                sample = (
+                    self._sample_cgroups()
+                    if self.source == "cgroup"
+                    else self._sample_stats()
+                )
+            except (CtrException, ValueError) as e:
+                # Expected once the container has stopped.
+                logger.debug("Failed to sample container %s: %s", self.ctr.name, e)
+            else:
+                self.samples.append(sample)
+            if self._stop.wait(self.interval):
+                return
+
+    def _controller_dir(self, controller: str) -> Optional[Path]:
+        """Get the cgroup directory for a controller, preferring cgroup v1."""
+        for hierarchy, path in self._cgroup_dirs.items():
+            if controller in hierarchy.split(","):
+                return path
+        return self._cgroup_dirs.get("")
+
+    def _sample_cgroups(self) -> ResourceSample:
+        """Take a sample by reading the container's cgroup files."""
+        values: dict[str, Optional[int]] = {}
+        path = self._controller_dir("memory")
+        if path and (path / "memory.current").exists():
+            values["memory_current"] = _read_cgroup_int(path / "memory.current")
+            values["memory_peak"] = _read_cgroup_int(path / "memory.peak")
+        elif path:
+            values["memory_current"] = _read_cgroup_int(path / "memory.usage_in_bytes")
+            values["memory_peak"] = _read_cgroup_int(path / "memory.max_usage_in_bytes")
+        path = self._controller_dir("cpuacct")
+        if path and (path / "cpuacct.usage").exists():
+            usage_nsec = _read_cgroup_int(path / "cpuacct.usage")
+            if usage_nsec is not None:
+                values["cpu_usage_usec"] = usage_nsec // 1000
+        elif path:
+            for line in _read_cgroup_file(path / "cpu.stat"):
+                key, _, value = line.partition(" ")
+                if key == "usage_usec":
+                    values["cpu_usage_usec"] = int(value)
+        if path := self._controller_dir("pids"):
+            values["pids_current"] = _read_cgroup_int(path / "pids.current")
+        path = self._controller_dir("blkio")
+        if path and (path / "blkio.throttle.io_service_bytes").exists():
+            values["io_read_bytes"] = values["io_write_bytes"] = 0
+            for line in _read_cgroup_file(path / "blkio.throttle.io_service_bytes"):
+                fields = line.split()
+                if len(fields) == 3 and fields[1] in ("Read", "Write"):
+                    values[f"io_{fields[1].lower()}_bytes"] += int(fields[2])
+        elif (path := self._controller_dir("io")) and (path / "io.stat").exists():
+            values["io_read_bytes"] = values["io_write_bytes"] = 0
+            for line in _read_cgroup_file(path / "io.stat"):
+                stats = dict(f.split("=", 1) for f in line.split()[1:] if "=" in f)
+                values["io_read_bytes"] += int(stats.get("rbytes", 0))
+                values["io_write_bytes"] += int(stats.get("wbytes", 0))
+        return ResourceSample(time.monotonic() - self._start, **values)
+
+    def _sample_stats(self) -> ResourceSample:
+        """Take a sample using the container manager's 'stats' command."""
+        fmt = "{{.MemUsage}}\t{{.PIDs}}\t{{.BlockIO}}"
+        output = run_ctr_cli(
+            self.ctr_client, ["stats", "--no-stream", "--format", fmt, self.ctr.id]
+        )
+        mem_usage, pids, block_io = output.strip().split("\t")
+        io_read, _, io_write = block_io.partition("/")
+        return ResourceSample(
+            time.monotonic() - self._start,
+            memory_current=_parse_stats_size(mem_usage.partition("/")[0]),
+            pids_current=int(pids) if pids.strip().isdigit() else None,
+            io_read_bytes=_parse_stats_size(io_read),
+            io_write_bytes=_parse_stats_size(io_write),
+        )
+
+    def summary(self) -> dict[str, Any]:
+        """
+        Get summary statistics of the samples.
+
+        :return:
+            A dict containing summary statistics (see utils.summarise_samples()) for
+            memory and pids usage, the peak memory usage, and the totals over
+            the sampling period for the cumulative CPU and IO counters.
+        """
+        summary: dict[str, Any] = {
+            "memory_current": summarise_samples(
+                s.memory_current for s in self.samples
+            ),
+            "pids_current": summarise_samples(s.pids_current for s in self.samples),
+        }
+        peaks = [
+            s.memory_peak if s.memory_peak is not None else s.memory_current
+            for s in self.samples
+        ]
+        if peaks := [x for x in peaks if x is not None]:
+            summary["memory_peak"] = max(peaks)
+        for field in ("cpu_usage_usec", "io_read_bytes", "io_write_bytes"):
+            values = [getattr(s, field) for s in self.samples]
+            if values := [x for x in values if x is not None]:
+                summary[f"{field}_total"] = values[-1] - values[0]
+        return summary
+
+    def close(self, timeout: float = 5) -> None:
+        """Stop sampling, waiting for any in-progress sample."""
+        self._stop.set()
+        self._thread.join(timeout)
@@ -0,0 +1,183 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections import Counter
+from typing import Any, Callable, Mapping
+
+import pytest
+
+from . import console, containers, host, utils
+from . import AsyncCtrCtxType, CtrCtxType
+
+
+logger = logging.getLogger(__name__)
+
+pytestmark = pytest.mark.benchmark
+
+
+def test_boot_latency(
+    request: pytest.FixtureRequest,
+    ctr_ctx: CtrCtxType,
+    default_ctr_kwargs: dict[str, Any],
+    record_benchmark: Callable[[str, Mapping[str, Any]], None],
+):
+    """
+    Benchmark the time taken for systemd containers to boot and be removed.
+
+    Boots the container '--benchmark-iterations' times, recording the time
+    until systemd reports the system is running, the time spent in the
+    pre-systemd init script and the time taken to tear the container down
+    (including its removal, which is done synchronously rather than in the
+    background).
+    """
+    iterations: int = request.config.getoption("--benchmark-iterations")
+    samples: dict[str, list[float]] = {
+        "time_to_running": [],
+        "time_to_systemd": [],
+        "init_script": [],
+        "teardown": [],
+    }
+    failures = 0
+    for i in range(iterations):
+        logger.info("Boot latency iteration %d of %d", i + 1, iterations)
+        try:
+            with ctr_ctx(
+                **default_ctr_kwargs, record_boot_timings=True, reap=False
+            ) as ctr:
+                timings: console.BootTimings = ctr.boot_timings
+                teardown_start = time.monotonic()
+        except utils.CtrInitError:
+            logger.exception("Container failed to boot")
+            failures += 1
+            continue
+        samples["teardown"].append(time.monotonic() - teardown_start)
+        samples["time_to_running"].append(timings.system_running)
+        samples["time_to_systemd"].append(timings.systemd_start)
+        if timings.init_script_start is not None:
+            samples["init_script"].append(
+                timings.init_script_end - timings.init_script_start
+            )
+
+    record_benchmark(
+        "boot_latency",
+        {
+            "iterations": iterations,
+            "failures": failures,
+            **{k: utils.summarise_samples(v) for k, v in samples.items()},
+        },
+    )
+    assert failures < iterations, "All container boots failed"
+
+
+def _remove_leftover_ctrs(ctr_client: utils.CtrClient, ctr_ids: list[str]) -> None:
+    """Force remove any of the given containers that still exist."""
+    output = utils.run_cmd(
+        [ctr_client.exe, "ps", "--all", "--quiet", "--no-trunc"]
+    ).stdout
+    existing = set(output.split())
+    if leftover := [x for x in ctr_ids if x in existing]:
+        logger.warning("Removing %d leftover containers", len(leftover))
+        ctr_client.container.remove(leftover, force=True)
+
+
+def test_boot_density(
+    request: pytest.FixtureRequest,
+    ctr_client: utils.CtrClient,
+    ctr_reaper: containers.CtrReaper,
+    async_ctr_ctx: AsyncCtrCtxType,
+    default_ctr_kwargs: dict[str, Any],
+    record_benchmark: Callable[[str, Mapping[str, Any]], None],
+):
+    """
+    Benchmark how boot time and failures scale with many concurrent containers.
+
+    For each step of '--density-steps', boots that many containers at once,
+    recording the time for each to boot, the number that fail to boot and the
+    host's available memory once all have booted, before removing them. Each
+    step starts once containers from previous tests and steps are removed.
+    Steps stop being run once a step has every container fail to boot.
+    """
+    steps: list[int] = request.config.getoption("--density-steps")
+
+    async def hold_ctr(
+        boot_done: asyncio.Future, release: asyncio.Event, ctr_ids: list[str]
+    ) -> None:
+        start = time.monotonic()
+        try:
+            async with async_ctr_ctx(**default_ctr_kwargs) as ctr:
+                ctr_ids.append(ctr.id)
+                boot_done.set_result(time.monotonic() - start)
+                await release.wait()
+        except Exception as e:
+            if boot_done.done():
+                raise
+            boot_done.set_exception(e)
+
+    async def run_step(num_ctrs: int, ctr_ids: list[str]) -> dict[str, Any]:
+        mem_before, mem_metric = host.get_host_memory_available(ctr_client)
+        loop = asyncio.get_running_loop()
+        release = asyncio.Event()
+        boot_futures = [loop.create_future() for _ in range(num_ctrs)]
+        step_start = time.monotonic()
+        tasks = [
+            asyncio.create_task(hold_ctr(f, release, ctr_ids)) for f in boot_futures
+        ]
+        try:
+            results = await asyncio.gather(*boot_futures, return_exceptions=True)
+            step_time = time.monotonic() - step_start
+            mem_booted, _ = host.get_host_memory_available(ctr_client)
+        finally:
+            release.set()
+            teardown_results = await asyncio.gather(*tasks, return_exceptions=True)
+        boot_times = [x for x in results if not isinstance(x, BaseException)]
+        errors = Counter(
+            type(x).__name__ for x in results if isinstance(x, BaseException)
+        )
+        for e in teardown_results:
+            if isinstance(e, BaseException):
+                logger.warning("Container teardown failed: %s", e)
+        mem_per_ctr = None
+        if boot_times and mem_before is not None and mem_booted is not None:
+            mem_per_ctr = (mem_before - mem_booted) // len(boot_times)
+        return {
+            "containers": num_ctrs,
+            "failures": num_ctrs - len(boot_times),
+            "failure_rate": (num_ctrs - len(boot_times)) / num_ctrs,
+            "errors": dict(errors),
+            "step_time": step_time,
+            "boot_time": utils.summarise_samples(boot_times),
+            "mem_metric": mem_metric,
+            "mem_available_before": mem_before,
+            "mem_available_booted": mem_booted,
+            "mem_per_ctr": mem_per_ctr,
+        }
+
+    results = []
+    for num_ctrs in steps:
+        # Wait for containers from previous tests to be removed, such that they
+        # don't affect the boot times or available memory.
+        if not ctr_reaper.flush(timeout=300):
+            logger.warning("Timed out waiting for previous containers to be removed")
+        logger.info("Booting %d containers concurrently", num_ctrs)
+        ctr_ids: list[str] = []
+        try:
+            step_results = asyncio.run(run_step(num_ctrs, ctr_ids))
+        finally:
+            # Containers are removed on exiting their context, but removal
+            # errors are suppressed.
+            _remove_leftover_ctrs(ctr_client, ctr_ids)
+        logger.info(
+            "Booted %d of %d containers in %.1f seconds",
+            num_ctrs - step_results["failures"],
+            num_ctrs,
+            step_results["step_time"],
+        )
+        results.append(step_results)
+        if step_results["failures"] == num_ctrs:
+            logger.warning("All containers failed to boot, stopping at this step")
+            break
+
+    record_benchmark("boot_density", {"steps": results})
+    assert results[0]["failures"] < steps[0], "All container boots failed"
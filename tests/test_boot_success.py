@@ -1,80 +1,92 @@
 from __future__ import annotations
 
 import logging
-import re
 
 import pytest
 
-from . import utils
-from .utils import CtrInitError, CtrMgr
+from . import console
+from .utils import CtrInitError, CtrMgr, Distro
 from . import CUSTOM_SETUP_MODES, CtrCtxType
 
 
 logger = logging.getLogger(__name__)
 
 
+# The console banner line (the first line of /etc/issue) of each distro, keyed on
+# image name. The Debian-based distros' banner is '<name> <version> \n \l' (the
+# hostname and TTY), while the others' is their PRETTY_NAME from os-release.
+_CONSOLE_BANNER_REGEXES = {
+    "almalinux": r"AlmaLinux \d+(?:\.\d+)* \(.+\)",
+    "debian": r"Debian GNU/Linux \S+ \S+ console",
+    "fedora": r"Fedora(?: Linux)? \d+ \(.+\)",
+    "rockylinux": r"Rocky Linux \d+(?:\.\d+)* \(.+\)",
+    "ubuntu": r"Ubuntu \d+\.\d+(?:\.\d+)?(?: LTS)? \S+ console",
+}
+
+
+def _get_boot_log_rules(distro: Distro) -> tuple[console.LogSectionRule, ...]:
+    """
+    Get the rules for the sections of a distro's boot logs, in order:
+     1. Any output before systemd starts, up to 'systemd <version> ...'
+     2. Systemd startup messages, up to the first '[  OK  ] ...'
+     3. Unit output, up to the distro's console banner
+     4. Startup completed, waiting for the login prompt
+     5. Login prompt reached
+    """
+    return (
+        console.LogSectionRule(
+            name="pre-systemd",
+            allowed=(r".*",),
+            end=r"systemd \d+(?:\.\S+)? running in system mode.*",
+        ),
+        console.LogSectionRule(
+            name="systemd-startup",
+            allowed=(
+                r"Detected virtualization .*",
+                r"Detected architecture .*",
+                r"Welcome .*",
+                r"Set hostname .*",
+                r"Initializing machine ID .*",
+            ),
+            end=r"\[  OK  \] .*",
+        ),
+        console.LogSectionRule(
+            name="units",
+            allowed=(
+                r"\[  OK  \] \S.*",
+                r"         \S.*",
+                r"modprobe@\w+\.service: Succeeded\.",
+            ),
+            end=_CONSOLE_BANNER_REGEXES[distro.name],
+        ),
+        console.LogSectionRule(
+            name="console",
+            allowed=(r"Kernel \S+ on an? \S+ \(console\)",),
+            end=r"\w+ login: ",
+        ),
+        console.LogSectionRule(name="login", allowed=(r"\w+ login: ",)),
+    )
+
+
 def _check_ctr_boot_logs(
-    ctr_logs: str, *, expect_login_prompt: bool = False
+    ctr_logs: str, distro: Distro, *, expect_login_prompt: bool = False
 ) -> list[str]:
     """
     Check for unexpected warnings/messages in the container's boot logs.
 
     :param ctr_logs:
         The systemd container logs to check.
+    :param distro:
+        The distro the container is running.
     :return:
         A list of unexpected boot log lines.
     :raise CtrInitError:
         If the logs unexpectedly do not include the login prompt section.
     """
-    # Split the boot logs into sections:
-    #  1. First systemd output 'systemd <version> ...'
-    #  2. Unit output from first '[  OK  ] ...'
-    #  3. Startup completed, login prompt
-    boot_log_lines = ctr_logs.splitlines()
-    section = 0
-    unexpected_lines = []
-    reached_login_prompt = False
-    for line in boot_log_lines:
-        coloured_line = line
-        line = utils.strip_ansi_codes(line)
-        if not line.strip():
-            continue
-        if section == 0:
-            allowed_line_regexes = [r".*"]
-            if re.match(r"systemd \d+(?:\.\S+)? running in system mode", line):
-                section = 1
-                continue
-        elif section == 1:
-            allowed_line_regexes = [
-                rf"Detected virtualization .*",
-                r"Detected architecture .*",
-                r"Welcome .*",
-                r"Set hostname .*",
-                r"Initializing machine ID .*",
-            ]
-            if line.startswith("[  OK  ] "):
-                section = 2
-                continue
-        elif section == 2:
-            allowed_line_regexes = [
-                r"\[  OK  \] \S.*",
-                r"         \S.*",
-                r"modprobe@\w+\.service: Succeeded\.",
-            ]
-            if re.fullmatch(r"Ubuntu .* console", line):
-                section = 3
-                continue
-        elif section == 3:
-            allowed_line_regexes = [
-                r"\w+ login: ",
-            ]
-            if re.fullmatch(r"\w+ login: ", line):
-                reached_login_prompt = True
-
-        if not any(re.fullmatch(rgx, line) for rgx in allowed_line_regexes):
-            unexpected_lines.append(coloured_line)
-
-    if expect_login_prompt and not reached_login_prompt:
+    classifier = console.LogClassifier(_get_boot_log_rules(distro))
+    unexpected_lines = classifier.feed_all(ctr_logs.splitlines())
+
+    if expect_login_prompt and "login" not in classifier.reached_sections:
         msg = "Login prompt not found in boot logs"
         if unexpected_lines:
             msg += " - unexpected lines:\n" + "\n".join(unexpected_lines)
@@ -83,16 +95,16 @@ def _check_ctr_boot_logs(
     return unexpected_lines
 
 
-def _warn_unexpected_boot_logs(ctr_logs: str) -> None:
+def _warn_unexpected_boot_logs(ctr_logs: str, distro: Distro) -> None:
     """Warn if there are unexpected lines in the boot logs."""
-    unexpected_boot_lines = _check_ctr_boot_logs(ctr_logs)
+    unexpected_boot_lines = _check_ctr_boot_logs(ctr_logs, distro)
     if unexpected_boot_lines:
         logger.warning(
             "Unexpected boot log lines:\n%s", "\n".join(unexpected_boot_lines)
         )
 
 
-def test_privileged(ctr_ctx: CtrCtxType, ctr_mgr: CtrMgr):
+def test_privileged(ctr_ctx: CtrCtxType, ctr_mgr: CtrMgr, distro: Distro):
     """Test running the container in privileged mode."""
     envs = {}
     if ctr_mgr is CtrMgr.DOCKER:
@@ -106,11 +118,11 @@ def test_privileged(ctr_ctx: CtrCtxType, ctr_mgr: CtrMgr):
         envs=envs,
         log_boot_output=True,
     ) as ctr:
-        _warn_unexpected_boot_logs(ctr.logs())
+        _warn_unexpected_boot_logs(ctr.logs(), distro)
 
 
 @pytest.mark.setup_mode(set(CUSTOM_SETUP_MODES) - {"inner_cgroup"})
-def test_non_priv(ctr_ctx: CtrCtxType, ctr_mgr: CtrMgr):
+def test_non_priv(ctr_ctx: CtrCtxType, ctr_mgr: CtrMgr, distro: Distro):
     """Test running in non-privileged mode, requiring custom setup."""
     envs = {}
     if ctr_mgr is CtrMgr.DOCKER:
@@ -125,7 +137,7 @@ def test_non_priv(ctr_ctx: CtrCtxType, ctr_mgr: CtrMgr):
         envs=envs,
         log_boot_output=True,
     ) as ctr:
-        _warn_unexpected_boot_logs(ctr.logs())
+        _warn_unexpected_boot_logs(ctr.logs(), distro)
 
 
 @pytest.mark.setup_mode([None])
@@ -134,6 +146,7 @@ def test_non_priv_with_host_cgroup_passthrough(
     ctr_ctx: CtrCtxType,
     ctr_mgr: CtrMgr,
     cgroup_version: int,
+    distro: Distro,
 ):
     """
     Non-privileged systemd container passing through the host's cgroupfs.
@@ -166,11 +179,11 @@ def test_non_priv_with_host_cgroup_passthrough(
         envs=envs,
         log_boot_output=True,
     ) as ctr:
-        _warn_unexpected_boot_logs(ctr.logs())
+        _warn_unexpected_boot_logs(ctr.logs(), distro)
 
 
 @pytest.mark.ctr_mgr(CtrMgr.PODMAN, reason="Systemd mode not supported by Docker")
-def test_non_priv_systemd_mode(ctr_ctx: CtrCtxType):
+def test_non_priv_systemd_mode(ctr_ctx: CtrCtxType, distro: Distro):
     """
     Test running with Podman's systemd mode, which automatically sets up the
     container for running systemd in non-privileged.
@@ -180,15 +193,15 @@ def test_non_priv_systemd_mode(ctr_ctx: CtrCtxType):
         systemd=True,
         log_boot_output=True,
     ) as ctr:
-        _warn_unexpected_boot_logs(ctr.logs())
+        _warn_unexpected_boot_logs(ctr.logs(), distro)
 
 
 @pytest.mark.ctr_mgr(CtrMgr.PODMAN, reason="Systemd mode not supported by Docker")
-def test_privileged_systemd_mode(ctr_ctx: CtrCtxType):
+def test_privileged_systemd_mode(ctr_ctx: CtrCtxType, distro: Distro):
     """Test running the container in privileged with Podman's systemd mode."""
     with ctr_ctx(
         privileged=True,
         systemd=True,
         log_boot_output=True,
     ) as ctr:
-        _warn_unexpected_boot_logs(ctr.logs())
+        _warn_unexpected_boot_logs(ctr.logs(), distro)
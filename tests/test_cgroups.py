@@ -3,12 +3,17 @@ from __future__ import annotations
 import logging
 from typing import Any, Optional
 
-from . import utils
+import pytest
+
+from . import cgroups, exec_agent
 from . import CtrCtxType
 
 
 logger = logging.getLogger(__name__)
 
+# These tests only inspect the container, so can share booted containers.
+pytestmark = pytest.mark.ctr_read_only
+
 
 def test_cgroup_dir(
     ctr_ctx: CtrCtxType,
@@ -25,9 +30,15 @@ def test_cgroup_mounts(
     cgroup_version: int,
 ):
     with ctr_ctx(**default_ctr_kwargs) as ctr:
-        output = ctr.execute(["findmnt", "-R", "/sys/fs/cgroup", "--notruncate"])
-        logger.debug("Cgroup mounts:\n%s", output)
-        cgroup_mount_type = ctr.execute(["stat", "-f", "/sys/fs/cgroup/", "-c", "%T"])
+        mounts_result, mount_type_result = exec_agent.execute_batch(
+            ctr,
+            [
+                ["findmnt", "-R", "/sys/fs/cgroup", "--notruncate"],
+                ["stat", "-f", "/sys/fs/cgroup/", "-c", "%T"],
+            ],
+        )
+        logger.debug("Cgroup mounts:\n%s", mounts_result.check())
+        cgroup_mount_type = mount_type_result.check()
         if cgroup_version == 1:
             assert cgroup_mount_type == "tmpfs"
         else:
@@ -39,9 +50,11 @@ def test_cgroup_paths(
     default_ctr_kwargs: dict[str, Any],
 ):
     with ctr_ctx(**default_ctr_kwargs) as ctr:
-        output = ctr.execute(["cat", "/proc/1/cgroup"])
-        logger.debug("Got PID 1 cgroups:\n%s", output)
-        journald_ctr_pid = int(ctr.execute(["pidof", "systemd-journald"]))
+        pid_1_result, journald_pid_result = exec_agent.execute_batch(
+            ctr, [["cat", "/proc/1/cgroup"], ["pidof", "systemd-journald"]]
+        )
+        logger.debug("Got PID 1 cgroups:\n%s", pid_1_result.check())
+        journald_ctr_pid = int(journald_pid_result.check())
         output = ctr.execute(["cat", f"/proc/{journald_ctr_pid}/cgroup"])
         logger.debug(
             "Got systemd-journald (PID %d) cgroups:\n%s", journald_ctr_pid, output
@@ -55,7 +68,9 @@ def test_cgroup_controllers(
     setup_mode: Optional[str],
 ):
     with ctr_ctx(**default_ctr_kwargs) as ctr:
-        enabled_controllers = utils.get_enabled_cgroup_controllers(ctr, cgroup_version)
+        snapshot = cgroups.CgroupSnapshot.capture(ctr, cgroup_version, procs=True)
+        logger.debug("Cgroup snapshot: %s", snapshot.to_dict())
+        enabled_controllers = snapshot.enabled_controllers
         logger.debug("Enabled controllers: %s", enabled_controllers)
         if setup_mode != "minimal":
             assert enabled_controllers >= {"memory", "pids"}
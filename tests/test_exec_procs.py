@@ -1,15 +1,17 @@
 from __future__ import annotations
 
+import concurrent.futures
 import functools
 import logging
 import time
-from typing import Any, Optional
+from collections import Counter
+from typing import Any, Callable, Mapping, Optional
 
 import pytest
 from python_on_whales import DockerException as CtrException
 from python_on_whales import Image as CtrImage
 
-from . import utils
+from . import cgroups, exec_agent, utils
 from .utils import CtrInitError
 from . import CtrCtxType
 
@@ -27,6 +29,17 @@ def delayed_start_ctr_ctx(ctr_ctx: CtrCtxType, pkg_image: CtrImage) -> CtrCtxTyp
     )
 
 
+def _get_systemd_cgroup_path(proc_cgroup: str) -> str:
+    """
+    Get the systemd cgroup path from the contents of a /proc/<pid>/cgroup file.
+
+    This is the path in the 'name=systemd' hierarchy on cgroups v1, or the
+    unified hierarchy on cgroups v2.
+    """
+    hierarchies = cgroups.parse_proc_cgroup(proc_cgroup)
+    return hierarchies.get("name=systemd", hierarchies.get("", ""))
+
+
 def test_late_exec_proc(
     ctr_ctx: CtrCtxType,
     default_ctr_kwargs: dict[str, Any],
@@ -36,7 +49,9 @@ def test_late_exec_proc(
     with ctr_ctx(**default_ctr_kwargs) as ctr:
         output = ctr.execute(["cat", "/proc/self/cgroup"])
         logger.debug("Got exec proc cgroups:\n%s", output)
-        enabled_controllers = utils.get_enabled_cgroup_controllers(ctr, cgroup_version)
+        enabled_controllers = cgroups.get_enabled_cgroup_controllers(
+            ctr, cgroup_version
+        )
         logger.debug("Enabled controllers: %s", enabled_controllers)
         if setup_mode != "minimal":
             assert enabled_controllers >= {"memory", "pids"}
@@ -55,8 +70,14 @@ def test_early_exec_proc(
         exec_proc_ctr_pid = max(int(p) for p in ctr.execute(["pidof", "sleep"]).split())
         output = ctr.execute(["cat", f"/proc/{exec_proc_ctr_pid}/cgroup"])
         logger.debug("Got exec proc cgroups before systemd starts:\n%s", output)
-        # Wait for systemd boot to complete inside the container.
-        time.sleep(1)  # wait for the 1 sec sleep to finish
+        # Wait for the 1 sec sleep to finish and the entrypoint to be exec'd,
+        # then for systemd boot to complete inside the container.
+        utils.wait_for(
+            "container entrypoint to start",
+            lambda: ctr.execute(["cat", "/proc/1/comm"]) != "bash",
+            timeout=10,
+            exc_type=CtrException,
+        )
         try:
             ctr.execute(["systemctl", "is-system-running", "--wait"])
         except CtrException as e:
@@ -64,7 +85,9 @@ def test_early_exec_proc(
             raise CtrInitError("Systemd container failed to start") from e
         output = ctr.execute(["cat", f"/proc/{exec_proc_ctr_pid}/cgroup"])
         logger.debug("Got exec proc cgroups after systemd started:\n%s", output)
-        enabled_controllers = utils.get_enabled_cgroup_controllers(ctr, cgroup_version)
+        enabled_controllers = cgroups.get_enabled_cgroup_controllers(
+            ctr, cgroup_version
+        )
         logger.debug("Enabled controllers: %s", enabled_controllers)
         if setup_mode != "minimal":
             assert enabled_controllers >= {"memory", "pids"}
@@ -73,18 +96,42 @@ def test_early_exec_proc(
 
 
 def test_exec_proc_spam(
+    request: pytest.FixtureRequest,
     delayed_start_ctr_ctx: CtrCtxType,
     default_ctr_kwargs: dict[str, Any],
     cgroup_version: int,
     setup_mode: Optional[str],
+    record_benchmark: Callable[[str, Mapping[str, Any]], None],
 ):
+    """
+    Spam creating exec processes while the container boots.
+
+    This doubles as a benchmark of exec throughput, recording the rate of exec
+    processes created, the latency of each exec call and which cgroups the
+    exec processes end up in. The number of concurrent exec client threads and
+    the duration are set with '--exec-spam-threads' and '--exec-spam-duration'.
+    """
+    num_threads: int = request.config.getoption("--exec-spam-threads")
+    duration: float = request.config.getoption("--exec-spam-duration")
+
     with delayed_start_ctr_ctx(**default_ctr_kwargs, wait=False) as ctr:
-        # Spam creating sleeping exec processes for 2 seconds - 1 second before
-        # systemd starts and 1 second while it starts up.
-        end_time = time.time() + 2
-        while time.time() < end_time:
-            try:
+
+        def spam_exec_procs() -> list[float]:
+            latencies = []
+            while time.monotonic() < end_time:
+                exec_start = time.monotonic()
                 ctr.execute(["sleep", "inf"], detach=True)
+                latencies.append(time.monotonic() - exec_start)
+            return latencies
+
+        # Spam creating sleeping exec processes, by default for 2 seconds - 1
+        # second before systemd starts and 1 second while it starts up.
+        start_time = time.monotonic()
+        end_time = start_time + duration
+        with concurrent.futures.ThreadPoolExecutor(num_threads) as executor:
+            futures = [executor.submit(spam_exec_procs) for _ in range(num_threads)]
+            try:
+                exec_latencies = [t for f in futures for t in f.result()]
             except CtrException as exc:
                 ctr.reload()
                 if not ctr.state.running:
@@ -93,6 +140,7 @@ def test_exec_proc_spam(
                         "exec processes during initialisation"
                     ) from exc
                 raise
+        spam_duration = time.monotonic() - start_time
         # Wait for systemd boot to complete inside the container.
         try:
             ctr.execute(["systemctl", "is-system-running", "--wait"])
@@ -102,15 +150,40 @@ def test_exec_proc_spam(
         exec_proc_ctr_pids = sorted(
             int(p) for p in ctr.execute(["pidof", "sleep"]).split()
         )
-        output = ctr.execute(["cat", "/proc/1/cgroup"])
-        logger.debug("Got PID 1 cgroups:\n%s", output)
+        pid_1_result, *exec_proc_results = exec_agent.execute_batch(
+            ctr,
+            [["cat", f"/proc/{pid}/cgroup"] for pid in [1, *exec_proc_ctr_pids]],
+        )
+        logger.debug("Got PID 1 cgroups:\n%s", pid_1_result.check())
+        pid_1_cgroup = _get_systemd_cgroup_path(pid_1_result.check())
+        exec_proc_cgroup_counts: Counter[str] = Counter()
         prev_exec_proc_cgroups = None
-        for pid in exec_proc_ctr_pids:
-            output = ctr.execute(["cat", f"/proc/{pid}/cgroup"])
+        for pid, result in zip(exec_proc_ctr_pids, exec_proc_results):
+            output = result.check()
+            exec_proc_cgroup_counts[_get_systemd_cgroup_path(output)] += 1
             if output != prev_exec_proc_cgroups:
                 logger.debug("Got exec proc %d cgroups:\n%s", pid, output)
                 prev_exec_proc_cgroups = output
-        enabled_controllers = utils.get_enabled_cgroup_controllers(ctr, cgroup_version)
+
+        record_benchmark(
+            "exec_proc_spam",
+            {
+                "threads": num_threads,
+                "duration": spam_duration,
+                "execs": len(exec_latencies),
+                "execs_per_second": len(exec_latencies) / spam_duration,
+                "exec_latency": utils.summarise_samples(exec_latencies),
+                "pid_1_cgroup": pid_1_cgroup,
+                # Exec processes that ended up in PID 1's cgroup, i.e. the
+                # 'init.scope' cgroup once systemd has started.
+                "in_pid_1_cgroup": exec_proc_cgroup_counts[pid_1_cgroup],
+                "cgroup_counts": dict(exec_proc_cgroup_counts),
+            },
+        )
+
+        enabled_controllers = cgroups.get_enabled_cgroup_controllers(
+            ctr, cgroup_version
+        )
         logger.debug("Enabled controllers: %s", enabled_controllers)
         if setup_mode != "minimal":
             assert enabled_controllers >= {"memory", "pids"}
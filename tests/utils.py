@@ -1,20 +1,42 @@
 from __future__ import annotations
 
 __all__ = (
+    "BUILD_HASH_LABEL",
+    "BUILD_RUN_LABEL",
+    "Backoff",
     "CtrClient",
     "CtrInitError",
     "CtrMgr",
+    "DEFAULT_BACKOFF",
+    "DISTRO_FAMILIES",
+    "Distro",
+    "EngineHost",
+    "ExecResult",
     "Mount",
+    "Poller",
+    "WaitStats",
+    "append_json_line",
     "build_with_dockerfile",
-    "get_enabled_cgroup_controllers",
+    "interprocess_lock",
     "run_cmd",
+    "run_ctr_cli",
     "strip_ansi_codes",
+    "summarise_samples",
+    "to_json_compatible",
     "wait_for",
 )
 
+import contextlib
+import dataclasses
 import enum
+import fcntl
+import functools
+import hashlib
+import itertools
+import json
 import logging
 import os.path
+import random
 import re
 import shlex
 import subprocess
@@ -22,13 +44,14 @@ import tempfile
 import time
 from collections import namedtuple
 from pathlib import Path
-from typing import Iterable, Optional, Callable
+from typing import Any, Callable, Iterator, Iterable, Mapping, Optional
 
-from python_on_whales import Container
 from python_on_whales import DockerClient as POWCtrClient
 from python_on_whales import DockerException as CtrException
 from python_on_whales import Image as CtrImage
 
+from .engine_api import EngineApiClient
+
 logger = logging.getLogger(__name__)
 
 
@@ -52,7 +75,14 @@ class CtrMgr(str, enum.Enum):
 
 
 class CtrClient(POWCtrClient):
-    def __init__(self, *args, client_exe: str, host: Optional[str], **kwargs):
+    def __init__(
+        self,
+        *args,
+        client_exe: str,
+        host: Optional[str],
+        api_socket: Optional[str] = None,
+        **kwargs,
+    ):
         self.exe: str = client_exe
         self.host: Optional[str] = host
         self.mgr: CtrMgr = CtrMgr.from_exe(client_exe)
@@ -71,10 +101,161 @@ class CtrClient(POWCtrClient):
 
         super().__init__(*args, client_call=[client_exe], **kwargs)
 
+        # Client for the engine API, used by run_container() if a socket is
+        # given.
+        self.api: Optional[EngineApiClient] = None
+        if api_socket:
+            self.api = EngineApiClient(api_socket)
+
+        # The engine's parsed 'info' output, see get_engine_info().
+        self._engine_info: Optional[dict[str, Any]] = None
+
+    def run_container(self, image: Any, *args, **kwargs) -> Any:
+        """
+        Run a container, as per run(), via the engine API where possible.
+
+        The CLI is used if no API socket was given, if the API client doesn't
+        support the arguments, or if the image needs pulling.
+        """
+        if self.api is None:
+            return self.run(image, *args, **kwargs)
+        if not self.api.supports_run_kwargs(kwargs):
+            logger.debug("Running container via CLI for args: %s", list(kwargs))
+            return self.run(image, *args, **kwargs)
+        try:
+            return self.api.run(image, *args, **kwargs)
+        except CtrException as e:
+            if e.return_code != 404 or "/containers/create" not in e.docker_command:
+                raise
+            # The image is not available locally, the CLI handles pulling it.
+            logger.debug("Running container via CLI to pull image %s", image)
+            return self.run(image, *args, **kwargs)
+
+    def get_engine_info(self, *, refresh: bool = False) -> dict[str, Any]:
+        """
+        Get the container engine's 'info' output, parsed from JSON.
+
+        The output is cached, such that it's shared between all users of the
+        engine's properties, with the query only repeated for values that
+        change over time (e.g. free memory) if refresh is set.
+
+        :param refresh:
+            Whether to re-run the 'info' command, updating the cached output.
+        :return:
+            The parsed output, in the engine's own format (e.g. Docker's
+            'ServerVersion' or Podman's 'host.memFree').
+        :raise subprocess.CalledProcessError:
+            If the engine's 'info' command fails.
+        :raise ValueError:
+            If the engine's 'info' output is not a JSON object.
+        """
+        if self._engine_info is None or refresh:
+            info_format = "json" if self.mgr is CtrMgr.PODMAN else "{{json .}}"
+            output = run_cmd([self.exe, "info", "--format", info_format]).stdout
+            info = json.loads(output)
+            if not isinstance(info, dict):
+                raise ValueError(f"Unexpected container engine info output: {output!r}")
+            self._engine_info = info
+        return self._engine_info
+
+    @functools.cached_property
+    def engine_host(self) -> EngineHost:
+        """
+        The container engine's version and the host it runs containers on.
+
+        :raise subprocess.CalledProcessError:
+            If the engine's 'info' command fails.
+        :raise ValueError:
+            If the engine's 'info' output is not as expected.
+        """
+        info = self.get_engine_info()
+        try:
+            if self.mgr is CtrMgr.PODMAN:
+                return EngineHost(
+                    info["version"]["Version"],
+                    info["host"]["kernel"],
+                    info["host"]["hostname"],
+                )
+            return EngineHost(
+                info["ServerVersion"], info["KernelVersion"], info["Name"]
+            )
+        except KeyError as e:
+            raise ValueError(f"Missing container engine info field: {e}") from e
+
+
+# The container engine's server version, and the kernel release and hostname of
+# the host it runs containers on (e.g. a VM for Docker Desktop/Podman machine).
+EngineHost = namedtuple("EngineHost", "server_version, kernel_version, hostname")
+
 
 Mount = namedtuple("Mount", "name, path, type, opts")
 
 
+# The package manager family of each supported distro, keyed on image name.
+DISTRO_FAMILIES = {
+    "almalinux": "dnf",
+    "debian": "apt",
+    "fedora": "dnf",
+    "rockylinux": "dnf",
+    "ubuntu": "apt",
+}
+
+
+class Distro(namedtuple("Distro", "name, version")):
+    """A distro to build systemd images for, from its '<name>:<version>' image."""
+
+    def __str__(self) -> str:
+        return f"{self.name}:{self.version}"
+
+    @classmethod
+    def from_str(cls, value: str) -> Distro:
+        """
+        Parse a distro from its image, e.g. 'ubuntu:20.04'.
+
+        :raise ValueError:
+            If the value is not of the form '<name>:<version>' or the distro is
+            not supported.
+        """
+        name, _, version = value.partition(":")
+        if not name or not version:
+            raise ValueError(f"Expected distro in the form NAME:VERSION, got {value!r}")
+        if name not in DISTRO_FAMILIES:
+            raise ValueError(
+                f"Unsupported distro {name!r}, choices: " + ", ".join(DISTRO_FAMILIES)
+            )
+        return cls(name, version)
+
+    @property
+    def family(self) -> str:
+        """The distro's package manager family, 'apt' or 'dnf'."""
+        return DISTRO_FAMILIES[self.name]
+
+    def image_tag(self, setup_mode: Optional[str] = None) -> str:
+        """The tag for the distro's systemd image, for the given setup mode."""
+        suffix = f"-{setup_mode}" if setup_mode else ""
+        return f"{self.name}-systemd{suffix}:{self.version}"
+
+
+class ExecResult(namedtuple("ExecResult", "cmd, returncode, stdout, stderr")):
+    """The result of running a command in a container."""
+
+    def check(self) -> str:
+        """
+        Check the command succeeded, returning its stdout.
+
+        :raise CtrException:
+            If the command returned a non-zero exit code.
+        """
+        if self.returncode != 0:
+            raise CtrException(
+                self.cmd,
+                self.returncode,
+                self.stdout.encode("utf-8"),
+                self.stderr.encode("utf-8"),
+            )
+        return self.stdout
+
+
 def run_cmd(
     cmd: list[str], *, log_output: bool = False, **kwargs
 ) -> subprocess.CompletedProcess[str]:
@@ -152,14 +333,159 @@ def run_cmd(
     return p
 
 
+def run_ctr_cli(ctr_client: CtrClient, args: list[str]) -> str:
+    """Run a container CLI command, raising CtrException on failure."""
+    try:
+        return run_cmd([ctr_client.exe, *args]).stdout
+    except subprocess.CalledProcessError as e:
+        raise CtrException(
+            e.cmd, e.returncode, e.stdout.encode("utf-8"), e.stderr.encode("utf-8")
+        ) from e
+
+
+@dataclasses.dataclass(frozen=True)
+class Backoff:
+    """
+    Schedule of sleeps between attempts when polling for a condition.
+
+    The first 'fast_attempts' retries are made after the initial interval,
+    after which the interval grows exponentially up to the maximum, with
+    random jitter applied to avoid many pollers retrying in lockstep.
+
+    :param initial:
+        The initial interval in seconds.
+    :param factor:
+        The factor to grow the interval by after the fast-start phase.
+    :param max_interval:
+        The maximum interval in seconds.
+    :param jitter:
+        The fraction of each interval to randomly vary it by.
+    :param fast_attempts:
+        The number of retries to make at the initial interval.
+    """
+
+    initial: float = 0.01
+    factor: float = 2.0
+    max_interval: float = 1.0
+    jitter: float = 0.1
+    fast_attempts: int = 3
+
+    @classmethod
+    def fixed(cls, interval: float) -> Backoff:
+        """A schedule with a fixed interval."""
+        return cls(
+            initial=interval,
+            factor=1,
+            max_interval=interval,
+            jitter=0,
+            fast_attempts=0,
+        )
+
+    def intervals(self) -> Iterator[float]:
+        """Generate the intervals to sleep for between attempts."""
+        interval = self.initial
+        for attempt in itertools.count():
+            if attempt >= self.fast_attempts:
+                interval = min(interval * self.factor, self.max_interval)
+            jitter = random.uniform(-self.jitter, self.jitter) * interval
+            yield min(interval + jitter, self.max_interval)
+
+
+DEFAULT_BACKOFF = Backoff()
+
+
+@dataclasses.dataclass
+class WaitStats:
+    """
+    Statistics of waiting for a condition, see wait_for().
+
+    :param attempts:
+        The number of times the condition was checked.
+    :param elapsed:
+        The time in seconds until the condition was met, or until timing out.
+    :param slept:
+        The total time in seconds spent sleeping between attempts.
+    :param ready:
+        Whether the condition was met.
+    """
+
+    attempts: int = 0
+    elapsed: float = 0
+    slept: float = 0
+    ready: bool = False
+
+
+class Poller:
+    """
+    The polling logic shared between wait_for() and aio.wait_for().
+
+    This tracks the attempts made and determines how long to sleep before the
+    next attempt, never sleeping past the deadline. A final attempt is always
+    made at the deadline.
+    """
+
+    def __init__(
+        self,
+        description: str,
+        timeout: float,
+        backoff: Backoff,
+        stats: Optional[WaitStats],
+    ):
+        self.description = description
+        self.timeout = timeout
+        self.stats = stats if stats is not None else WaitStats()
+        self._intervals = backoff.intervals()
+        self._start_time = time.monotonic()
+        self._end_time = self._start_time + timeout
+        self.exception: Optional[Exception] = None
+
+    def record_attempt(self, ready: bool) -> bool:
+        """Record an attempt, returning whether the condition was met."""
+        self.stats.attempts += 1
+        self.stats.elapsed = time.monotonic() - self._start_time
+        if ready:
+            self.stats.ready = True
+            logger.debug(
+                "Ready condition met after %d attempts in %.3f seconds",
+                self.stats.attempts,
+                self.stats.elapsed,
+            )
+        return ready
+
+    def next_sleep(self) -> Optional[float]:
+        """Get the time to sleep before the next attempt, or None on timeout."""
+        remaining = self._end_time - time.monotonic()
+        if remaining <= 0:
+            return None
+        sleep = min(next(self._intervals), remaining)
+        # Log with decreasing frequency to avoid noise from long waits.
+        if self.stats.attempts & (self.stats.attempts - 1) == 0:
+            logger.debug(
+                "Condition not met after %d attempts, trying again in %.3f seconds",
+                self.stats.attempts,
+                sleep,
+            )
+        self.stats.slept += sleep
+        return sleep
+
+    def timeout_error(self) -> TimeoutError:
+        """Get the error to raise on timing out."""
+        return TimeoutError(
+            f"Timed out after {self.timeout} seconds waiting for {self.description} "
+            f"({self.stats.attempts} attempts)"
+        )
+
+
 def wait_for(
     description: str,
     condition: Callable[[], bool],
     timeout: float,
-    interval: float = 0.2,
+    interval: Optional[float] = None,
     *,
     exc_type: type[Exception] | None = Exception,
-) -> None:
+    backoff: Backoff = DEFAULT_BACKOFF,
+    stats: Optional[WaitStats] = None,
+) -> WaitStats:
     """
     Wait for a condition to complete within the given timeout.
 
@@ -167,6 +493,11 @@ def wait_for(
     raise an exception of the type given in 'exc_type' for retry, or raise
     another exception type on unexpected error.
 
+    The condition is retried according to the given backoff schedule, starting
+    with short intervals such that quick conditions are detected quickly, and
+    backing off such that slow conditions are checked less often. The final
+    sleep is cut short at the timeout, when a final attempt is made.
+
     :param description:
         Description of what's being waited for.
     :param condition:
@@ -174,42 +505,103 @@ def wait_for(
     :param timeout:
         The retry timeout in seconds.
     :param interval:
-        The retry interval in seconds.
+        A fixed retry interval in seconds, overriding the backoff schedule.
     :param exc_type:
         The exception type to catch from calling the condition function, or
         None to not catch exceptions.
+    :param backoff:
+        The schedule of retry intervals.
+    :param stats:
+        Optional object to record statistics of the wait in, which is useful
+        for getting the statistics when timing out.
+    :return:
+        The statistics of the wait.
+    :raise TimeoutError:
+        If the condition is not met within the timeout.
     """
     logger.info("Waiting up to %s seconds for %s", timeout, description)
-    exception: exc_type | None = None
-    end_time = time.monotonic() + timeout
-    ready = False
+    if interval is not None:
+        backoff = Backoff.fixed(interval)
+    poller = Poller(description, timeout, backoff, stats)
     while True:
+        ready = False
         if exc_type:
             try:
                 ready = condition()
             except exc_type as e:
-                exception = e
+                poller.exception = e
         else:
             ready = condition()
-        if ready:
-            logger.debug("Ready condition met")
-            return
-        if time.monotonic() >= end_time:
-            break
-        logger.debug("Trying again in %s seconds...", interval)
-        time.sleep(interval)
-
-    msg = f"Timed out after {timeout} seconds waiting for {description}"
-    if exception:
-        raise TimeoutError(msg) from exception
-    else:
-        raise TimeoutError(msg)
+        if poller.record_attempt(ready):
+            return poller.stats
+        sleep = poller.next_sleep()
+        if sleep is None:
+            raise poller.timeout_error() from poller.exception
+        time.sleep(sleep)
+
+
+_ANSI_CODE_REGEX = re.compile("\x1b" + r"\[\d+(?:;\d+)*m")
 
 
 def strip_ansi_codes(text: str) -> str:
     """Strip all ANSI escape codes from given text."""
-    ansi_code = re.compile("\x1b" + r"\[\d+(?:;\d+)*m")
-    return ansi_code.sub("", text)
+    return _ANSI_CODE_REGEX.sub("", text)
+
+
+@contextlib.contextmanager
+def interprocess_lock(name: str) -> Iterator[None]:
+    """
+    Hold an exclusive lock shared between processes on the local host.
+
+    This is used to serialise operations between parallel pytest workers, such
+    as building a container image that multiple workers depend on.
+
+    :param name:
+        The name of the lock, used to create a lock file in the temp directory.
+    """
+    lock_path = Path(tempfile.gettempdir()) / f"systemd-tests-{name}.lock"
+    with open(lock_path, "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+# Image label used to store the hash of the inputs an image was built from.
+BUILD_HASH_LABEL = "systemd-tests.build-hash"
+
+
+# Image label used to store the ID of the test run an image was built in.
+BUILD_RUN_LABEL = "systemd-tests.build-run"
+
+
+def _get_build_hash(
+    ctr_client: CtrClient, dockerfile: str, build_root: Path | None
+) -> str:
+    """
+    Get a hash of the inputs for building an image.
+
+    This covers the Dockerfile text, the contents of the build root and the
+    build hashes of any base images that were themselves built by us (other
+    base images are only identified by name).
+    """
+    build_hash = hashlib.sha256()
+    build_hash.update(dockerfile.encode("utf-8"))
+    for match in re.finditer(r"^FROM\s+(\S+)", dockerfile, re.I | re.M):
+        base_image = match.group(1)
+        if ctr_client.image.exists(base_image):
+            labels = ctr_client.image.inspect(base_image).config.labels or {}
+            base_hash = labels.get(BUILD_HASH_LABEL)
+            if base_hash:
+                build_hash.update(base_hash.encode("utf-8"))
+    if build_root:
+        for path in sorted(Path(build_root).rglob("*")):
+            if path.is_file():
+                build_hash.update(str(path.relative_to(build_root)).encode("utf-8"))
+                build_hash.update(oct(path.stat().st_mode).encode("utf-8"))
+                build_hash.update(path.read_bytes())
+    return build_hash.hexdigest()
 
 
 def build_with_dockerfile(
@@ -218,48 +610,116 @@ def build_with_dockerfile(
     *,
     tags: str | Iterable[str] = (),
     build_root: Path | None = None,
+    use_cache: bool = True,
+    run_id: Optional[str] = None,
     **kwargs,
 ) -> CtrImage:
-    """Build a container image using a dockerfile in string form."""
-    with tempfile.TemporaryDirectory(prefix="ctr-build-root-") as tmpdir:
-        dockerfile_path = Path(tmpdir) / "Dockerfile"
-        dockerfile_path.write_text(dockerfile)
-        if not build_root:
-            build_root = tmpdir
-        logger.debug("Building image using Dockerfile:\n%s", dockerfile.strip())
-        return ctr_client.legacy_build(
-            build_root, file=dockerfile_path, tags=tags, **kwargs
-        )
+    """
+    Build a container image using a dockerfile in string form.
+
+    The image is labelled with a hash of the build inputs, and if an image with
+    the given tags already exists with a matching hash then the build is
+    skipped (unless 'use_cache' is False).
+
+    Builds of the same tags are serialised between processes, such that when
+    parallel workers need the same image only one of them builds it, with the
+    others finding the built image via its build hash. If 'run_id' is given the
+    image is also labelled with it, and an image built in the same run is
+    reused even if 'use_cache' is False, such that images are only rebuilt once
+    per test run.
+    """
+    tags = [tags] if isinstance(tags, str) else list(tags)
+    lock_name = "image-build-" + re.sub(r"[^\w.-]", "_", ",".join(tags) or "untagged")
+    with interprocess_lock(lock_name):
+        build_hash = _get_build_hash(ctr_client, dockerfile, build_root)
+        if (use_cache or run_id) and tags:
+            images = [
+                ctr_client.image.inspect(t)
+                for t in tags
+                if ctr_client.image.exists(t)
+            ]
+            if len(images) == len(tags) and all(
+                (labels := image.config.labels or {}).get(BUILD_HASH_LABEL)
+                == build_hash
+                and (use_cache or labels.get(BUILD_RUN_LABEL) == run_id)
+                for image in images
+            ):
+                logger.debug(
+                    "Skipping build of %s, found image with build hash %s",
+                    ", ".join(tags),
+                    build_hash[:12],
+                )
+                return images[0]
+
+        kwargs["labels"] = {**kwargs.get("labels", {}), BUILD_HASH_LABEL: build_hash}
+        if run_id:
+            kwargs["labels"][BUILD_RUN_LABEL] = run_id
+        with tempfile.TemporaryDirectory(prefix="ctr-build-root-") as tmpdir:
+            dockerfile_path = Path(tmpdir) / "Dockerfile"
+            dockerfile_path.write_text(dockerfile)
+            if not build_root:
+                build_root = tmpdir
+            logger.debug("Building image using Dockerfile:\n%s", dockerfile.strip())
+            return ctr_client.legacy_build(
+                build_root, file=dockerfile_path, tags=tags, **kwargs
+            )
 
 
-def get_enabled_cgroup_controllers(ctr: Container, cgroup_version: int) -> set[str]:
-    if cgroup_version == 1:
-        controllers = set()
-        cgroup_paths = ctr.execute(
-            ["find", "/sys/fs/cgroup", "-type", "d", "-name", "system.slice"]
-        ).splitlines()
+def _percentile(sorted_values: list[float], percent: float) -> float:
+    """Get a percentile from sorted values, using linear interpolation."""
+    index = (len(sorted_values) - 1) * percent / 100
+    lower = int(index)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (
+        (sorted_values[upper] - sorted_values[lower]) * (index - lower)
+    )
+
+
+def summarise_samples(samples: Iterable[float]) -> dict[str, float]:
+    """
+    Get summary statistics for a set of samples, e.g. benchmark timings.
+
+    :param samples:
+        The sample values, with None values ignored.
+    :return:
+        A dict containing the count, min, max, mean, p50, p95 and p99 (empty
+        if there are no samples).
+    """
+    values = sorted(x for x in samples if x is not None)
+    if not values:
+        return {}
+    return {
+        "count": len(values),
+        "min": values[0],
+        "max": values[-1],
+        "mean": sum(values) / len(values),
+        "p50": _percentile(values, 50),
+        "p95": _percentile(values, 95),
+        "p99": _percentile(values, 99),
+    }
+
+
+def append_json_line(path: Path, record: Mapping[str, Any]) -> None:
+    """
+    Append a record to a JSON lines file.
+
+    The record is written with a single write call, such that records from
+    parallel test workers are not interleaved.
+    """
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def to_json_compatible(value: Any) -> Any:
+    """Convert a value built from dataclasses, tuples and sets for JSON."""
+    if dataclasses.is_dataclass(value):
         return {
-            p.removeprefix("/sys/fs/cgroup/").split("/")[0] for p in cgroup_paths
-        } - {"systemd", "unified"}
+            f.name: to_json_compatible(getattr(value, f.name))
+            for f in dataclasses.fields(value)
+        }
+    elif isinstance(value, (set, frozenset)):
+        return sorted(value)
+    elif isinstance(value, (tuple, list)):
+        return [to_json_compatible(x) for x in value]
     else:
-        assert cgroup_version == 2
-        pid_1_cgroup_relpath = (
-            ctr.execute(["grep", "0::", "/proc/1/cgroup"]).split(":")[2].lstrip("/")
-        )
-        # Workaround for the pseudo-private cgroup bind mounts used in
-        # cgroupns=host mode, finding the path that's actually visible inside
-        # the container.
-        try:
-            ctr.execute(["ls", "/sys/fs/cgroup/" + pid_1_cgroup_relpath])
-        except CtrException:
-            *_, pid_1_cgroup_relpath = pid_1_cgroup_relpath.split("/", maxsplit=2)
-        return set(
-            ctr.execute(
-                [
-                    "cat",
-                    os.path.join(
-                        "/sys/fs/cgroup", pid_1_cgroup_relpath, "cgroup.controllers"
-                    ),
-                ]
-            ).split()
-        )
+        return value
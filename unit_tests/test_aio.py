@@ -0,0 +1,91 @@
+"""
+Tests for the asyncio container utilities, run against a stub container engine
+executable.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import stat
+import types
+from pathlib import Path
+
+import pytest
+from python_on_whales import DockerException as CtrException
+
+from tests.aio import AsyncContainer
+from tests.utils import CtrInitError
+
+# Stub of the engine's 'exec <ctr> <cmd>...' (running the command on the host)
+# and 'logs --follow <ctr>' (outputting the file given by STUB_LOGS, then
+# hanging if STUB_LOGS_HANG is set, as for a running container).
+_STUB_EXE = """\
+#!/bin/sh
+case "$1" in
+exec)
+    shift 2
+    exec "$@"
+    ;;
+logs)
+    cat "$STUB_LOGS"
+    [ -n "$STUB_LOGS_HANG" ] && exec sleep 10
+    exit 0
+    ;;
+esac
+exit 125
+"""
+
+
+@pytest.fixture
+def logs_path(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    path = tmp_path / "logs"
+    path.write_text("")
+    monkeypatch.setenv("STUB_LOGS", str(path))
+    return path
+
+
+@pytest.fixture
+def ctr(tmp_path: Path, logs_path: Path) -> AsyncContainer:
+    exe = tmp_path / "ctr-engine"
+    exe.write_text(_STUB_EXE)
+    exe.chmod(exe.stat().st_mode | stat.S_IXUSR)
+    return AsyncContainer(types.SimpleNamespace(exe=str(exe)), "abc")
+
+
+def test_execute_batch(ctr: AsyncContainer):
+    results = asyncio.run(
+        ctr.execute_batch(
+            [["echo", "foo"], ["sh", "-c", "echo bar >&2; exit 3"], ["true"]]
+        )
+    )
+    assert [r.returncode for r in results] == [0, 3, 0]
+    assert results[0].stdout == "foo"
+    assert results[1].stderr == "bar"
+    assert results[2].stdout == ""
+    with pytest.raises(CtrException):
+        results[1].check()
+
+
+def test_execute_batch_empty(ctr: AsyncContainer):
+    assert asyncio.run(ctr.execute_batch([])) == []
+
+
+def test_wait_for_log_line(ctr: AsyncContainer, logs_path: Path):
+    logs_path.write_text("Starting...\n\x1b[1mReached target\x1b[0m Graphical\n")
+    line = asyncio.run(ctr.wait_for_log_line(r"Reached target \w+", timeout=5))
+    assert line == "Reached target Graphical"
+
+
+def test_wait_for_log_line_output_ended(ctr: AsyncContainer, logs_path: Path):
+    logs_path.write_text("Starting...\n")
+    with pytest.raises(CtrInitError, match="output ended"):
+        asyncio.run(ctr.wait_for_log_line("Reached target", timeout=5))
+
+
+def test_wait_for_log_line_timeout(
+    ctr: AsyncContainer, logs_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setenv("STUB_LOGS_HANG", "1")
+    logs_path.write_text("Starting...\n")
+    with pytest.raises(TimeoutError):
+        asyncio.run(ctr.wait_for_log_line("Reached target", timeout=0.2))
@@ -0,0 +1,65 @@
+"""
+Tests for the container lifecycle helpers, run against a stub container client.
+"""
+
+from __future__ import annotations
+
+import types
+from typing import Union
+
+from python_on_whales import DockerException as CtrException
+
+from tests.containers import CtrReaper
+
+
+class _StubContainerCLI:
+    """Stub of the container client's 'container' commands."""
+
+    def __init__(self, ids: set[str], stuck_ids: set[str]):
+        self.ids = ids
+        self.stuck_ids = stuck_ids
+        self.remove_calls: list[list[str]] = []
+
+    def remove(self, ids: Union[str, list[str]], *, force: bool) -> None:
+        ids = [ids] if isinstance(ids, str) else list(ids)
+        self.remove_calls.append(ids)
+        # Like 'rm --force', fail if any container doesn't exist or can't be
+        # removed, having removed the others.
+        missing = [x for x in ids if x not in self.ids]
+        self.ids -= set(ids) - self.stuck_ids
+        if missing or self.stuck_ids.intersection(ids):
+            raise CtrException(["rm", *ids], 1, stderr=b"failed")
+
+    def exists(self, ctr_id: str) -> bool:
+        return ctr_id in self.ids
+
+
+def _make_reaper(ids: set[str], stuck_ids: set[str]) -> CtrReaper:
+    container = _StubContainerCLI(ids, stuck_ids)
+    return CtrReaper(types.SimpleNamespace(container=container), linger=0.05)
+
+
+def _ctr(ctr_id: str) -> types.SimpleNamespace:
+    return types.SimpleNamespace(id=ctr_id)
+
+
+def test_reaper_batches():
+    reaper = _make_reaper({"a", "b", "c"}, set())
+    for ctr_id in ["a", "b", "c"]:
+        reaper.remove(_ctr(ctr_id))
+    assert reaper.flush(timeout=5)
+    reaper.close(timeout=5)
+    assert reaper.ctr_client.container.remove_calls == [["a", "b", "c"]]
+    assert reaper.removed_count == 3
+    assert reaper.failed_ids == []
+
+
+def test_reaper_batch_failure():
+    reaper = _make_reaper({"a", "b", "c"}, {"b"})
+    for ctr_id in ["a", "b", "c"]:
+        reaper.remove(_ctr(ctr_id))
+    assert reaper.flush(timeout=5)
+    reaper.close(timeout=5)
+    # Only the container that failed to be removed is recorded as failed.
+    assert reaper.removed_count == 2
+    assert reaper.failed_ids == ["b"]
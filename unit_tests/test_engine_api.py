@@ -0,0 +1,246 @@
+"""
+Tests for the engine API client, run against a stub API server.
+"""
+
+from __future__ import annotations
+
+import http.server
+import json
+import logging
+import socketserver
+import struct
+import tempfile
+import threading
+from pathlib import Path
+from typing import Callable, Generator, Optional
+
+import pytest
+from python_on_whales import DockerException as CtrException
+
+from tests import engine_api
+from tests.engine_api import ApiContainer, EngineApiClient
+
+API_PREFIX = "/v1.41"
+
+RouteHandler = Callable[["_StubHandler"], None]
+
+
+class _StubHandler(http.server.BaseHTTPRequestHandler):
+    """Request handler dispatching to the routes registered on the server."""
+
+    protocol_version = "HTTP/1.1"
+    server: _StubApiServer
+
+    def _handle(self) -> None:
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length)) if length else None
+        path = self.path.removeprefix(API_PREFIX)
+        self.server.requests.append((self.command, path, body))
+        route = self.server.routes.get((self.command, path.split("?")[0]))
+        if route:
+            route(self)
+        else:
+            self.send_json(404, {"message": f"no such route: {path}"})
+
+    do_GET = do_POST = do_DELETE = _handle
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def send_json(self, status: int, obj: Optional[object]) -> None:
+        """Send a JSON response, or an empty response if obj is None."""
+        data = b"" if obj is None else json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_chunked(self, status: int, chunks: list[bytes]) -> None:
+        """Send a response using chunked transfer encoding, closing after."""
+        self.send_response(status)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for chunk in chunks:
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+        self.close_connection = True
+
+
+class _StubApiServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Stub of the engine API, serving registered routes on a UNIX socket."""
+
+    daemon_threads = True
+
+    def __init__(self, socket_path: str):
+        super().__init__(socket_path, _StubHandler)
+        # Handlers keyed on (method, path), with the path excluding the API
+        # version prefix and query string.
+        self.routes: dict[tuple[str, str], RouteHandler] = {}
+        # The (method, path, body) of each request received.
+        self.requests: list[tuple[str, str, Optional[object]]] = []
+
+    def route(self, method: str, path: str, status: int, obj: object) -> None:
+        """Register a route returning a fixed JSON response."""
+        self.routes[(method, path)] = lambda h: h.send_json(status, obj)
+
+
+def _frame(stream_num: int, data: bytes) -> bytes:
+    return struct.pack(">BxxxL", stream_num, len(data)) + data
+
+
+@pytest.fixture
+def api_server() -> Generator[_StubApiServer, None, None]:
+    # Use a short path, since UNIX socket paths are limited to ~100 chars.
+    with tempfile.TemporaryDirectory() as tmpdir:
+        server = _StubApiServer(str(Path(tmpdir) / "api.sock"))
+        thread = threading.Thread(
+            target=server.serve_forever, args=(0.01,), daemon=True
+        )
+        thread.start()
+        try:
+            yield server
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+
+@pytest.fixture
+def api_client(
+    api_server: _StubApiServer,
+) -> Generator[EngineApiClient, None, None]:
+    client = EngineApiClient(api_server.server_address, timeout=5)
+    try:
+        yield client
+    finally:
+        client.close()
+
+
+def test_request_json(api_server: _StubApiServer, api_client: EngineApiClient):
+    api_server.route("GET", "/containers/abc/json", 200, {"Id": "abc"})
+    api_server.route("POST", "/containers/abc/start", 204, None)
+    assert api_client.request("GET", "/containers/abc/json") == {"Id": "abc"}
+    # The pooled connection is reused for the next request.
+    assert api_client.request("POST", "/containers/abc/start") is None
+    assert api_client._pool.qsize() == 1
+    assert api_server.requests == [
+        ("GET", "/containers/abc/json", None),
+        ("POST", "/containers/abc/start", None),
+    ]
+
+
+def test_request_params_and_body(
+    api_server: _StubApiServer, api_client: EngineApiClient
+):
+    api_server.route("POST", "/containers/create", 201, {"Id": "abc"})
+    resp = api_client.request(
+        "POST", "/containers/create", params={"name": "foo"}, body={"Tty": True}
+    )
+    assert resp == {"Id": "abc"}
+    assert api_server.requests == [
+        ("POST", "/containers/create?name=foo", {"Tty": True})
+    ]
+
+
+@pytest.mark.parametrize("status", [404, 409, 500])
+def test_request_error_status(
+    api_server: _StubApiServer, api_client: EngineApiClient, status: int
+):
+    api_server.route("DELETE", "/containers/abc", status, {"message": "failed"})
+    with pytest.raises(CtrException) as exc_info:
+        api_client.request("DELETE", "/containers/abc")
+    assert exc_info.value.return_code == status
+    assert exc_info.value.docker_command == ["api", "DELETE", "/containers/abc"]
+    assert "failed" in exc_info.value.stderr
+    # The connection is still returned to the pool for reuse.
+    api_server.route("DELETE", "/containers/abc", 204, None)
+    assert api_client.request("DELETE", "/containers/abc") is None
+
+
+def test_stream_chunked_multiplexed(
+    api_server: _StubApiServer, api_client: EngineApiClient
+):
+    output = _frame(1, b"out1\n") + _frame(2, b"err\n") + _frame(1, b"out2\n")
+    # Split the frames across chunk boundaries, including within a header.
+    chunks = [output[:3], output[3:10], output[10:20], output[20:]]
+    api_server.routes[("GET", "/containers/abc/logs")] = lambda h: h.send_chunked(
+        200, chunks
+    )
+    stream = api_client.stream("GET", "/containers/abc/logs", multiplexed=True)
+    try:
+        assert stream.read_all() == (b"out1\nout2\n", b"err\n")
+    finally:
+        stream.close()
+
+
+def test_stream_chunked_raw(api_server: _StubApiServer, api_client: EngineApiClient):
+    chunks = [b"line 1\n", b"line", b" 2\n"]
+    api_server.routes[("GET", "/containers/abc/logs")] = lambda h: h.send_chunked(
+        200, chunks
+    )
+    stream = api_client.stream("GET", "/containers/abc/logs", multiplexed=False)
+    try:
+        assert b"".join(iter(stream.read1, b"")) == b"line 1\nline 2\n"
+    finally:
+        stream.close()
+
+
+def test_stream_error_status(api_server: _StubApiServer, api_client: EngineApiClient):
+    api_server.route("GET", "/containers/abc/logs", 404, {"message": "no such"})
+    with pytest.raises(CtrException) as exc_info:
+        api_client.stream("GET", "/containers/abc/logs")
+    assert exc_info.value.return_code == 404
+
+
+def test_container_execute(api_server: _StubApiServer, api_client: EngineApiClient):
+    api_server.route("POST", "/containers/abc/exec", 201, {"Id": "e1"})
+    api_server.routes[("POST", "/exec/e1/start")] = lambda h: h.send_chunked(
+        200, [_frame(1, b"hello\n"), _frame(2, b"warning\n")]
+    )
+    api_server.route("GET", "/exec/e1/json", 200, {"ExitCode": 0})
+    ctr = ApiContainer(api_client, "abc", attrs={})
+    assert ctr.execute(["echo", "hello"], envs={"FOO": "1"}) == "hello"
+    assert api_server.requests[0][2]["Env"] == ["FOO=1"]
+
+    api_server.route("GET", "/exec/e1/json", 200, {"ExitCode": 3})
+    with pytest.raises(CtrException) as exc_info:
+        ctr.execute(["false"])
+    assert exc_info.value.return_code == 3
+    assert exc_info.value.stderr == "warning\n"
+
+
+def test_force_remove(api_server: _StubApiServer, api_client: EngineApiClient):
+    api_server.route("DELETE", "/containers/abc", 204, None)
+    ctr = ApiContainer(api_client, "abc", attrs={})
+    engine_api._force_remove(ctr)
+    assert api_server.requests == [("DELETE", "/containers/abc?force=1&v=0", None)]
+
+
+def test_force_remove_error(
+    api_server: _StubApiServer,
+    api_client: EngineApiClient,
+    caplog: pytest.LogCaptureFixture,
+):
+    api_server.route("DELETE", "/containers/abc", 500, {"message": "busy"})
+    ctr = ApiContainer(api_client, "abc", attrs={})
+    with caplog.at_level(logging.WARNING, logger=engine_api.__name__):
+        engine_api._force_remove(ctr)
+    assert "Failed to remove container abc" in caplog.text
+
+
+def test_run_removes_on_start_failure(
+    api_server: _StubApiServer, api_client: EngineApiClient
+):
+    api_server.route("POST", "/containers/create", 201, {"Id": "abc"})
+    api_server.route("POST", "/containers/abc/start", 500, {"message": "failed"})
+    api_server.route("DELETE", "/containers/abc", 204, None)
+    with pytest.raises(CtrException):
+        api_client.run("image", ["true"], detach=True, remove=True)
+    assert api_server.requests[-1] == ("DELETE", "/containers/abc?force=1&v=0", None)
+    create_body = api_server.requests[0][2]
+    assert create_body["Cmd"] == ["true"]
+    assert create_body["Env"] == []
+    assert create_body["HostConfig"]["CapAdd"] == []
@@ -0,0 +1,69 @@
+"""
+Tests for the exec agent, run against a stub container engine executable.
+"""
+
+from __future__ import annotations
+
+import stat
+import types
+from pathlib import Path
+from typing import Generator
+
+import pytest
+from python_on_whales import DockerException as CtrException
+
+from tests.exec_agent import ExecAgent
+
+# Stub of '<exe> exec -i <ctr> <cmd>...', running the command on the host.
+_STUB_EXE = """\
+#!/bin/sh
+[ "$1" = exec ] || exit 125
+shift 3
+exec "$@"
+"""
+
+
+@pytest.fixture
+def agent(tmp_path: Path) -> Generator[ExecAgent, None, None]:
+    exe = tmp_path / "ctr-engine"
+    exe.write_text(_STUB_EXE)
+    exe.chmod(exe.stat().st_mode | stat.S_IXUSR)
+    ctr_client = types.SimpleNamespace(exe=str(exe))
+    ctr = types.SimpleNamespace(id="abc", name="abc")
+    agent = ExecAgent(ctr_client, ctr, timeout=10)
+    try:
+        yield agent
+    finally:
+        agent.close()
+
+
+def test_execute(agent: ExecAgent):
+    assert agent.execute(["echo", "hello"]) == "hello"
+    results = agent.execute_batch(
+        [["echo", "foo"], ["sh", "-c", "echo bar >&2; exit 3"]]
+    )
+    assert [r.returncode for r in results] == [0, 3]
+    assert results[0].stdout == "foo"
+    assert results[1].stderr == "bar"
+    with pytest.raises(CtrException):
+        results[1].check()
+
+
+def test_restart_after_exit(agent: ExecAgent):
+    agent._proc.kill()
+    agent._proc.wait()
+    assert agent.execute(["echo", "hello"]) == "hello"
+
+
+def test_restart_after_exit_during_command(agent: ExecAgent):
+    with pytest.raises(CtrException):
+        agent.execute(["kill", "-9", str(agent._proc.pid)])
+    assert agent.execute(["echo", "hello"]) == "hello"
+
+
+def test_restart_after_timeout(agent: ExecAgent):
+    pid = agent._proc.pid
+    with pytest.raises(TimeoutError):
+        agent.execute_batch([["sleep", "5"]], timeout=0.1)
+    assert agent._proc.pid != pid
+    assert agent.execute(["echo", "hello"]) == "hello"
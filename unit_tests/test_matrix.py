@@ -0,0 +1,203 @@
+"""
+Tests for compiling the test parameterisation matrix.
+"""
+
+from __future__ import annotations
+
+import json
+from pathlib import Path
+
+import pytest
+
+from tests import matrix
+from tests.matrix import MatrixRule, SetupModeMetadata
+
+
+def _write_metadata(test_dir: Path, setup_mode: str, text: str) -> None:
+    mode_dir = test_dir / "setup_modes" / setup_mode
+    mode_dir.mkdir(parents=True)
+    (mode_dir / "metadata.json").write_text(text)
+
+
+def test_rule_allows():
+    rule = MatrixRule(
+        "test rule",
+        when={"cgroup_version": {1}},
+        require={"cgroup_mode": {"legacy", "hybrid"}},
+        exclude={"cgroupns": {"private"}},
+    )
+    values = {"cgroup_version": 1, "cgroup_mode": "hybrid", "cgroupns": "host"}
+    assert rule.allows(values)
+    assert not rule.allows({**values, "cgroup_mode": "unified"})
+    assert not rule.allows({**values, "cgroupns": "private"})
+    # The rule doesn't apply when its conditions aren't met.
+    assert rule.allows({**values, "cgroup_version": 2, "cgroupns": "private"})
+
+
+def test_rule_without_conditions_always_applies():
+    rule = MatrixRule("always", require={"cgroupns": {"host"}})
+    assert rule.allows({"cgroupns": "host"})
+    assert not rule.allows({"cgroupns": "private"})
+
+
+def test_compile_matrix_reasons():
+    rules = [
+        MatrixRule("host only", require={"cgroupns": {"host"}}),
+        MatrixRule("not legacy", exclude={"cgroup_mode": {"legacy"}}),
+    ]
+    compiled = matrix.compile_matrix(
+        rules, setup_modes=[None, "foo"], cgroup_modes=["legacy", "unified"]
+    )
+    assert compiled.valid == {(None, "host", "unified"), ("foo", "host", "unified")}
+    assert (None, "host", "unified") in compiled
+    assert (None, "private", "unified") not in compiled
+    assert compiled.reasons[(None, "private", "legacy")] == ("host only", "not legacy")
+    assert compiled.reasons[("foo", "host", "legacy")] == ("not legacy",)
+    assert len(compiled.valid) + len(compiled.reasons) == 2 * 2 * 2
+
+
+def test_compile_matrix_host_properties():
+    rules = [
+        MatrixRule(
+            "podman only", when={"setup_mode": {"foo"}}, require={"ctr_mgr": {"podman"}}
+        )
+    ]
+    kwargs = dict(setup_modes=[None, "foo"], cgroupns_values=["host"])
+    docker = matrix.compile_matrix(rules, {"ctr_mgr": "docker"}, **kwargs)
+    podman = matrix.compile_matrix(rules, {"ctr_mgr": "podman"}, **kwargs)
+    assert ("foo", "host", "hybrid") not in docker
+    assert (None, "host", "hybrid") in docker
+    assert ("foo", "host", "hybrid") in podman
+
+
+@pytest.mark.parametrize(
+    ["host_properties", "combo", "expected_reasons"],
+    [
+        pytest.param(
+            {"cgroup_version": 1, "ctr_mgr": "docker"},
+            (None, "host", "hybrid"),
+            None,
+            id="v1-default",
+        ),
+        pytest.param(
+            {"cgroup_version": 1, "ctr_mgr": "docker"},
+            (None, "host", "unified"),
+            ("cgroupv1 non-unified",),
+            id="v1-unified",
+        ),
+        pytest.param(
+            {"cgroup_version": 2, "ctr_mgr": "podman"},
+            (None, "private", "unified"),
+            None,
+            id="v2-default",
+        ),
+        pytest.param(
+            {"cgroup_version": 2, "ctr_mgr": "podman"},
+            (None, "private", "legacy"),
+            ("cgroupv2 unified",),
+            id="v2-legacy",
+        ),
+        pytest.param(
+            {"cgroup_version": 2, "ctr_mgr": "docker"},
+            ("minimal", "host", "unified"),
+            ("minimal setup_mode support",),
+            id="v2-minimal",
+        ),
+        pytest.param(
+            {"cgroup_version": 1, "ctr_mgr": "docker"},
+            ("rebind", "private", "legacy"),
+            ("rebind setup_mode support",),
+            id="v1-rebind-private",
+        ),
+        pytest.param(
+            {"cgroup_version": 2, "ctr_mgr": "podman"},
+            ("rebind", "host", "unified"),
+            None,
+            id="v2-rebind-host",
+        ),
+    ],
+)
+def test_applicability_rules(host_properties, combo, expected_reasons):
+    compiled = matrix.compile_matrix(matrix.APPLICABILITY_RULES, host_properties)
+    if expected_reasons is None:
+        assert combo in compiled
+    else:
+        assert combo not in compiled
+        assert compiled.reasons[combo] == expected_reasons
+
+
+def test_setup_mode_rules():
+    metadata = {
+        None: SetupModeMetadata(),
+        "foo": SetupModeMetadata(cgroup_versions=(2,), ctr_mgrs=("podman",)),
+    }
+    rules = matrix.setup_mode_rules(metadata)
+    assert [r.name for r in rules] == [
+        "default setup_mode support",
+        "foo setup_mode support",
+    ]
+    values = {"setup_mode": "foo", "cgroupns": "host", "ctr_mgr": "podman"}
+    assert rules[1].allows({**values, "cgroup_version": 2})
+    assert not rules[1].allows({**values, "cgroup_version": 1})
+    assert not rules[1].allows({**values, "cgroup_version": 2, "ctr_mgr": "docker"})
+    # Rules only apply to their own setup mode.
+    assert rules[0].allows({**values, "cgroup_version": 1})
+
+
+def test_get_combo():
+    params = {"cgroup_mode": "hybrid", "setup_mode": None, "cgroupns": "host", "x": 1}
+    assert matrix.get_combo(params) == (None, "host", "hybrid")
+
+
+def test_metadata_from_dict():
+    metadata = SetupModeMetadata.from_dict(
+        {"cgroup_versions": [1], "privileged_ctr_mgrs": ["docker"]}
+    )
+    assert metadata == SetupModeMetadata(
+        cgroup_versions=(1,), privileged_ctr_mgrs=("docker",)
+    )
+
+
+def test_metadata_from_dict_unknown_fields():
+    with pytest.raises(ValueError, match=r"Unrecognised.*\['foo'\]"):
+        SetupModeMetadata.from_dict({"cgroup_versions": [1], "foo": [], "cgroupns": []})
+
+
+def test_load_metadata(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
+    monkeypatch.setattr(matrix, "SYSTEMD_TEST_DIR", tmp_path)
+    _write_metadata(tmp_path, "foo", json.dumps({"cgroupns": ["host"]}))
+    assert matrix.load_setup_mode_metadata("foo") == SetupModeMetadata(
+        cgroupns=("host",)
+    )
+
+
+def test_load_metadata_default_mode():
+    metadata = matrix.load_setup_mode_metadata(None)
+    assert metadata.privileged_ctr_mgrs == ("docker",)
+
+
+def test_load_metadata_missing_file(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
+    monkeypatch.setattr(matrix, "SYSTEMD_TEST_DIR", tmp_path)
+    assert matrix.load_setup_mode_metadata("foo") == SetupModeMetadata()
+
+
+def test_load_metadata_invalid_json(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
+    monkeypatch.setattr(matrix, "SYSTEMD_TEST_DIR", tmp_path)
+    _write_metadata(tmp_path, "foo", '{"cgroupns": ["host"],}')
+    with pytest.raises(ValueError, match="Invalid setup mode metadata file"):
+        matrix.load_setup_mode_metadata("foo")
+
+
+def test_load_metadata_unknown_fields(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
+    monkeypatch.setattr(matrix, "SYSTEMD_TEST_DIR", tmp_path)
+    _write_metadata(tmp_path, "foo", json.dumps({"cgroup_version": [2]}))
+    with pytest.raises(ValueError, match="Unrecognised setup mode metadata"):
+        matrix.load_setup_mode_metadata("foo")
+
+
+def test_shipped_metadata():
+    # Every setup mode's metadata is valid, with no mode excluded everywhere.
+    for mode, metadata in matrix.SETUP_MODE_METADATA.items():
+        assert metadata.cgroup_versions, mode
+        assert metadata.cgroupns, mode
+        assert metadata.ctr_mgrs, mode